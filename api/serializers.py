@@ -1,8 +1,12 @@
+from django.db.models import (Manager, Prefetch, Subquery, OuterRef, Sum,
+    Count, FloatField)
+
 from rest_framework.serializers import (ModelSerializer, Serializer,
     SerializerMethodField, RelatedField as _RelatedField, CharField,
     DateTimeField, ListSerializer, ManyRelatedField)
 
-from home.models import Course, Professor, Review, Grade
+from home.models import (Course, Professor, Review, Grade, CourseGradeRollup,
+    GradeQuerySet)
 
 
 # our entire api is read only
@@ -36,14 +40,19 @@ class ProfessorField(RelatedField):
 
 class ManyProfessorField(ManyRelatedField):
     def to_representation(self, iterable):
-        iterable = iterable.filter(status=Professor.Status.VERIFIED)
+        # filter in python instead of with `.filter`, which would throw away
+        # any prefetched professors and hit the database again.
+        iterable = [p for p in iterable if p.status == Professor.Status.VERIFIED]
         return super().to_representation(iterable)
 
 # only return verified reviews and professors
 # https://stackoverflow.com/a/28354281/12164878
 class ReviewListSerializer(ListSerializer):
     def to_representation(self, data):
-        data = data.filter(status=Review.Status.VERIFIED)
+        # see `ManyProfessorField` for why this isn't a `.filter`
+        if isinstance(data, Manager):
+            data = data.all()
+        data = [r for r in data if r.status == Review.Status.VERIFIED]
         return super().to_representation(data)
 
 class ProfessorListSerializer(ListSerializer):
@@ -81,15 +90,48 @@ class ReviewsSerializer(ModelSerializer):
             response["expected_grade"] = ""
         return response
 
+# Serializers of more than one instance should pass their queryset through
+# the serializer's `prefetch` first. It annotates and prefetches everything the
+# serializer reads, so serializing a page takes a constant number of queries
+# instead of several per row. Serializers fall back to querying for instances
+# which weren't prefetched.
+
+def _reviews_prefetch():
+    reviews = Review.verified.select_related("course", "professor")
+    return Prefetch("review_set", queryset=reviews)
+
 class CourseSerializer(ModelSerializer):
     average_gpa = SerializerMethodField()
     professors = ProfessorField(many=True)
 
     class Meta:
         model = Course
-        exclude = ["created_at", "id"]
+        exclude = ["created_at", "updated_at", "id"]
+
+    @staticmethod
+    def prefetch(courses):
+        # the same calculation as `Course.average_gpa`
+        average_gpa = (
+            CourseGradeRollup.recent
+            .filter(course=OuterRef("pk"))
+            .values("course")
+            .annotate(average_gpa=GradeQuerySet.average_gpa_expression())
+            .values("average_gpa")
+        )
+        return (
+            courses
+            .annotate(
+                annotated_average_gpa=Subquery(average_gpa,
+                    output_field=FloatField())
+            )
+            .prefetch_related(
+                Prefetch("professors", queryset=Professor.verified.all())
+            )
+        )
 
     def get_average_gpa(self, course):
+        if hasattr(course, "annotated_average_gpa"):
+            return course.annotated_average_gpa
         return course.average_gpa()
 
 
@@ -100,10 +142,34 @@ class ProfessorSerializer(ModelSerializer):
 
     class Meta:
         model = Professor
-        exclude = ["id", "status", "created_at"]
+        exclude = ["id", "status", "created_at", "updated_at"]
         list_serializer_class = ProfessorListSerializer
 
+    @staticmethod
+    def prefetch(professors):
+        # the same calculation as `Professor.average_rating`
+        average_rating = (
+            Review.verified
+            .filter(professor=OuterRef("pk"))
+            .values("professor")
+            .annotate(
+                average_rating=Sum("rating", output_field=FloatField()) /
+                    Count("*")
+            )
+            .values("average_rating")
+        )
+        return (
+            professors
+            .annotate(
+                annotated_average_rating=Subquery(average_rating,
+                    output_field=FloatField())
+            )
+            .prefetch_related("course_set")
+        )
+
     def get_average_rating(self, professor):
+        if hasattr(professor, "annotated_average_rating"):
+            return professor.annotated_average_rating
         return professor.average_rating
 
     def get_type(self, professor):
@@ -116,9 +182,19 @@ class ProfessorSerializer(ModelSerializer):
 class ProfessorWithReviewsSerializer(ProfessorSerializer):
     reviews = ReviewsSerializer(many=True, source="review_set")
 
+    @staticmethod
+    def prefetch(professors):
+        professors = ProfessorSerializer.prefetch(professors)
+        return professors.prefetch_related(_reviews_prefetch())
+
 class CourseWithReviewsSerializer(CourseSerializer):
     reviews = ReviewsSerializer(many=True, source="review_set")
 
+    @staticmethod
+    def prefetch(courses):
+        courses = CourseSerializer.prefetch(courses)
+        return courses.prefetch_related(_reviews_prefetch())
+
 
 class SearchResultSerializer(Serializer):
     type = SerializerMethodField()
@@ -126,23 +202,60 @@ class SearchResultSerializer(Serializer):
     slug = SerializerMethodField()
 
     def get_type(self, result):
-        if isinstance(result, Course):
-            return "course"
-        return "professor"
+        return result.type
 
     def get_slug(self, result):
-        if isinstance(result, Course):
-            return result.name
         return result.slug
 
 
+# (field, output key) pairs for `grade_rows`, in the order `GradeSerializer`
+# outputs them.
+GRADE_ROW_FIELDS = (
+    ("course__name", "course"),
+    ("professor__name", "professor"),
+    ("semester", "semester"),
+    ("section", "section"),
+    ("a_plus", "A+"),
+    ("a", "A"),
+    ("a_minus", "A-"),
+    ("b_plus", "B+"),
+    ("b", "B"),
+    ("b_minus", "B-"),
+    ("c_plus", "C+"),
+    ("c", "C"),
+    ("c_minus", "C-"),
+    ("d_plus", "D+"),
+    ("d", "D"),
+    ("d_minus", "D-"),
+    ("f", "F"),
+    ("w", "W"),
+    ("other", "Other")
+)
+_GRADE_ROW_VALUES = tuple(field for (field, _key) in GRADE_ROW_FIELDS)
+_GRADE_ROW_KEYS = tuple(key for (_field, key) in GRADE_ROW_FIELDS)
+_SEMESTER_INDEX = _GRADE_ROW_VALUES.index("semester")
+
+def grade_rows(grades):
+    """
+    The same data as `GradeSerializer(grades, many=True).data`, but fetched
+    with a single `values_list` query and built directly into dicts. Much
+    faster for large numbers of grades.
+    """
+    rows = []
+    for values in grades.values_list(*_GRADE_ROW_VALUES):
+        row = dict(zip(_GRADE_ROW_KEYS, values))
+        # `Semester` objects serialize as their number, as a string
+        row["semester"] = str(values[_SEMESTER_INDEX])
+        rows.append(row)
+    return rows
+
 class GradeSerializer(ModelSerializer):
     course = CourseField()
     professor = ProfessorField()
 
     class Meta:
         model = Grade
-        exclude = ["id", "num_students"]
+        exclude = ["id", "num_students", "updated_at"]
 
     # maintain backwards compatability
     def to_representation(self, instance):
@@ -1,4 +1,21 @@
+from functools import wraps
+import json
+import time
+
+from django.db.models import Q
+from django.http import StreamingHttpResponse, HttpResponse
+
 from rest_framework.exceptions import ValidationError as ValidationError_
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from home.utils import (_response_cache, response_cache_metrics,
+    TTLCacheBackend)
 
 
 class ValidationError(ValidationError_):
@@ -47,3 +64,163 @@ def param_bool(request, name, *, default=sentry):
         return val
 
     return val == "true"
+
+def param_list(request, name, *, max_length=100):
+    """
+    A required comma separated list parameter, without duplicates or empty
+    items, in the order they were passed.
+    """
+    val = param(request, name)
+    items = [item.strip() for item in val.split(",")]
+    items = list(dict.fromkeys(item for item in items if item))
+
+    if not items:
+        raise ValidationError(f"{name} parameter must not be empty")
+    if len(items) > max_length:
+        raise ValidationError(f"{name} parameter must have no more than "
+            f"{max_length} items")
+
+    return items
+
+def render_json(data):
+    """
+    `data` as json, byte for byte identical to what our `JSONRenderer` settings
+    (compact, unicode, strict) produce, but several times faster when orjson
+    is installed. Only for data made of dicts, lists, strings, ints, and
+    `None`; floats may be formatted differently.
+    """
+    if orjson is not None:
+        content = orjson.dumps(data)
+    else:
+        content = json.dumps(data, ensure_ascii=False, allow_nan=False,
+            separators=(",", ":")).encode()
+    # like `JSONRenderer`, escape the two characters which are valid in json
+    # strings but not in javascript
+    return (
+        content
+        .replace("\u2028".encode(), b"\\u2028")
+        .replace("\u2029".encode(), b"\\u2029")
+    )
+
+def json_response(request, data):
+    """
+    A response of `data` rendered with `render_json`, skipping drf's content
+    negotiation and renderers. Falls back to a normal drf `Response` if the
+    client asked for indented output.
+    """
+    if "indent=" in request.META.get("HTTP_ACCEPT", ""):
+        return Response(data)
+    return HttpResponse(render_json(data), content_type="application/json")
+
+def _render(response):
+    if isinstance(response, Response):
+        return JSONRenderer().render(response.data)
+    return response.content
+
+# how long `cache_response` keeps responses for when `_response_cache` is only
+# local to this process. The same as `home.middleware.http_cache.MAX_AGE`.
+LOCAL_MAX_AGE = 60
+
+def cache_response(max_age, *, params, depends_on):
+    """
+    Caches the rendered json of an api view's `get` for at most `max_age`
+    seconds, or until any of the tags in `depends_on` (see `ttl_cache`) are
+    invalidated. `depends_on` may also be a function which takes the request
+    and returns the tags.
+
+    Responses are cached by the values of the query parameters in `params`,
+    regardless of their order; other parameters are ignored. Errors aren't
+    cached, and neither are requests for indented output.
+
+    Unless `TTL_CACHE_BACKEND = "django"`, invalidations only reach the
+    worker which made the change, so responses are only cached for
+    `LOCAL_MAX_AGE` seconds.
+    """
+    def decorator(get):
+
+        @wraps(get)
+        def wrapper(self, request, *args, **kwargs):
+            if "indent=" in request.META.get("HTTP_ACCEPT", ""):
+                return get(self, request, *args, **kwargs)
+
+            start = time.perf_counter()
+            cache_max_age = max_age
+            # invalidations only reach other workers through a shared backend.
+            # With an in-process one, don't let other workers serve stale
+            # responses for longer than clients may cache them anyway.
+            if not _response_cache.shared:
+                cache_max_age = min(max_age, LOCAL_MAX_AGE)
+
+            query_params = request.query_params
+            key = (
+                "api",
+                f"{type(self).__module__}.{type(self).__qualname__}",
+                tuple((name, tuple(query_params.getlist(name)))
+                    for name in sorted(params) if name in query_params)
+            )
+            tags = depends_on(request) if callable(depends_on) else depends_on
+            tags = (TTLCacheBackend.ALL, *tags)
+
+            entry = _response_cache.get(key, tags)
+            hit = (entry is not None and
+                entry[0] >= time.time() // cache_max_age)
+            if hit:
+                content = entry[1]
+            else:
+                # unlike `ttl_cache`, don't serve stale responses while
+                # recomputing in the background; a newly verified review
+                # should show up in the very next response.
+                compute = lambda: _render(get(self, request, *args, **kwargs))
+                content = _response_cache.compute(key, tags, cache_max_age,
+                    compute, register=False)
+
+            response_cache_metrics.record(hit, time.perf_counter() - start)
+            return HttpResponse(content, content_type="application/json")
+
+        return wrapper
+    return decorator
+
+def keyset(queryset, fields, values):
+    """
+    The rows of `queryset` which come strictly after `values` when ordered by
+    `fields`, in that order. Unlike `offset`, this stays an index range scan no
+    matter how deep into the results you are.
+    """
+    after = Q()
+    for i, field in enumerate(fields):
+        condition = Q(**{f"{field}__gt": values[i]})
+        for (previous_field, value) in zip(fields[:i], values[:i]):
+            condition &= Q(**{previous_field: value})
+        after |= condition
+    return queryset.filter(after).order_by(*fields)
+
+def stream_ndjson(queryset, serializer_class, fields, *, values=None,
+    chunk_size=500):
+    """
+    A streaming response of every row in `queryset` (after `values`, if
+    passed), serialized with `serializer_class`, one json object per line.
+
+    Rows are read in keyset ordered chunks of `chunk_size`, and only one chunk
+    is held in memory at a time, so this is safe to use on whole tables.
+    """
+    renderer = JSONRenderer()
+
+    def lines():
+        after = values
+        while True:
+            if after is None:
+                chunk = queryset.order_by(*fields)
+            else:
+                chunk = keyset(queryset, fields, after)
+            chunk = list(chunk[:chunk_size])
+            if not chunk:
+                return
+
+            for instance in chunk:
+                yield renderer.render(serializer_class(instance).data) + b"\n"
+            # a partial chunk is the last one, so don't ask for another
+            if len(chunk) < chunk_size:
+                return
+            after = [getattr(chunk[-1], field) for field in fields]
+
+    return StreamingHttpResponse(lines(), content_type="application/x-ndjson")
@@ -1,18 +1,22 @@
+from collections import defaultdict
+
 from django.views.generic import TemplateView
 from django.urls import reverse
+from django.utils.functional import cached_property
 
 from rest_framework.views import APIView
 from rest_framework.generics import ListAPIView
 from rest_framework.response import Response
 
 from home.models import (Course as CourseModel, Professor as ProfessorModel,
-    Grade as GradeModel)
+    Grade as GradeModel, Review, ProfessorCourse)
 from home import queries
-from home.utils import Semester
+from home.utils import Semester, cache_tag, TTLCache, TTLCacheBackend
 from api.serializers import (CourseSerializer, ProfessorSerializer,
     ProfessorWithReviewsSerializer, CourseWithReviewsSerializer,
-    SearchResultSerializer, GradeSerializer)
-from api.utils import param, param_int, param_bool, ValidationError
+    SearchResultSerializer, grade_rows)
+from api.utils import (param, param_int, param_bool, param_list,
+    ValidationError, keyset, stream_ndjson, json_response, cache_response)
 
 
 class Docs(TemplateView):
@@ -28,7 +32,84 @@ class Meta(APIView):
         return Response(data)
 
 
+# the models each view reads from, for `home.middleware.HttpCacheMiddleware`.
+COURSE_MODELS = [CourseModel, ProfessorModel, ProfessorCourse, Review,
+    GradeModel]
+PROFESSOR_MODELS = [ProfessorModel, CourseModel, ProfessorCourse, Review]
+
+# how long to cache rendered responses for. Changes to the underlying data
+# invalidate them sooner; see `cache_response`.
+CACHE_MAX_AGE = 60 * 60
+# the tags of every model which appears in course and professor responses,
+# for views which aren't specific to a single course.
+LIST_TAGS = [cache_tag("course"), cache_tag("professor"), cache_tag("review"),
+    cache_tag("grade"), cache_tag("professorcourse")]
+
+# the stored name of course names clients have asked for, eg `cmsc131` ->
+# `CMSC131`. Kept small and apart from `_ttl_cache`, so that arbitrary client
+# supplied names can't evict the values our own pages depend on.
+_course_names = TTLCache(max_size=1000, max_bytes=1024 * 1024)
+
+def _course_name(name):
+    # the database compares names case insensitively, so eg `cmsc131` finds
+    # CMSC131, but tags are emitted with the name as it's stored.
+    tags = [TTLCacheBackend.ALL]
+    entry = _course_names.get(name, tags)
+    if entry is not None:
+        return entry[1]
+
+    stored_name = (
+        CourseModel.unfiltered
+        .filter(name=name)
+        .values_list("name", flat=True)
+        .first()
+    )
+    # a course's name never changes, but one which doesn't exist yet might be
+    # added later, so only remember names which were found.
+    if stored_name is None:
+        return name
+    return _course_names.compute(name, tags, 24 * 60 * 60,
+        lambda: stored_name, register=False)
+
+def _requested_names(names):
+    """
+    The names in `names` which were requested as each (case folded) name. Batch
+    results are keyed by the names as requested, but the database compares
+    names case insensitively, so eg `cmsc131` finds CMSC131.
+    """
+    requested = defaultdict(list)
+    for name in names:
+        requested[name.casefold()].append(name)
+    return requested
+
+def _course_tags(request):
+    name = _course_name(request.query_params.get("name"))
+    return [
+        cache_tag("course", "name", name),
+        cache_tag("review", "course", name),
+        cache_tag("grade", "course", name),
+        # a course lists its professors
+        cache_tag("professor")
+    ]
+
+def _grades_tags(request):
+    course = request.query_params.get("course")
+    if course:
+        course = _course_name(course)
+        tags = [
+            cache_tag("grade", "course", course),
+            cache_tag("course", "name", course)
+        ]
+    else:
+        tags = [cache_tag("grade"), cache_tag("course")]
+    return [*tags, cache_tag("professor")]
+
+
 class Course(APIView):
+    cache_models = COURSE_MODELS
+
+    @cache_response(CACHE_MAX_AGE, params=["name", "reviews"],
+        depends_on=_course_tags)
     def get(self, request):
         name = param(request, "name")
         reviews = param_bool(request, "reviews", default=False)
@@ -45,6 +126,22 @@ class Course(APIView):
 
 class Courses(ListAPIView):
     serializer_class = CourseSerializer
+    cache_models = COURSE_MODELS
+    # courses are unique by name, so it doubles as a pagination key
+    keyset_fields = ["name"]
+
+    def get(self, request, *args, **kwargs):
+        if param_bool(request, "bulk", default=False):
+            after = param(request, "after", default=None)
+            values = [after] if after is not None else None
+            return stream_ndjson(self.get_queryset(), self.serializer_class,
+                self.keyset_fields, values=values)
+        return self.list(request, *args, **kwargs)
+
+    @cache_response(CACHE_MAX_AGE, params=["department", "reviews", "limit",
+        "offset", "after"], depends_on=LIST_TAGS)
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
 
     def get_queryset(self):
         request = self.request
@@ -52,9 +149,14 @@ class Courses(ListAPIView):
         reviews = param_bool(request, "reviews", default=False)
         limit = param_int(request, "limit", default=100, min_=0, max_=100)
         offset = param_int(request, "offset", default=0, min_=0)
+        after = param(request, "after", default=None)
+        bulk = param_bool(request, "bulk", default=False)
 
         if department and len(department) != 4:
             raise ValidationError("department parameter must be 4 characters")
+        if after is not None and offset:
+            raise ValidationError("after and offset parameters cannot be "
+                "used together")
 
         courses = CourseModel.recent.all()
         if department:
@@ -62,12 +164,48 @@ class Courses(ListAPIView):
 
         if reviews:
             self.serializer_class = CourseWithReviewsSerializer
+        courses = self.serializer_class.prefetch(courses)
+
+        if bulk:
+            return courses
+
+        if after is not None:
+            return keyset(courses, self.keyset_fields, [after])[:limit]
 
         courses = courses[offset:offset + limit]
         return courses
 
 
+class CoursesBatch(APIView):
+    cache_models = COURSE_MODELS
+
+    @cache_response(CACHE_MAX_AGE, params=["names", "reviews"],
+        depends_on=LIST_TAGS)
+    def get(self, request):
+        names = param_list(request, "names")
+        reviews = param_bool(request, "reviews", default=False)
+
+        Serializer = (CourseWithReviewsSerializer if reviews else
+            CourseSerializer)
+        courses = Serializer.prefetch(CourseModel.recent.filter(name__in=names))
+        courses = list(courses)
+        serialized = Serializer(courses, many=True).data
+
+        requested = _requested_names(names)
+        data = dict.fromkeys(names)
+        for course, course_data in zip(courses, serialized):
+            for name in requested[course.name.casefold()]:
+                data[name] = course_data
+        return Response(data)
+
+
 class Professor(APIView):
+    cache_models = PROFESSOR_MODELS
+
+    # professors are looked up by name, but tagged by slug, so depend on every
+    # professor and review.
+    @cache_response(CACHE_MAX_AGE, params=["name", "reviews"],
+        depends_on=LIST_TAGS)
     def get(self, request):
         name = param(request, "name")
         reviews = param_bool(request, "reviews", default=False)
@@ -83,6 +221,35 @@ class Professor(APIView):
 
 class Professors(ListAPIView):
     serializer_class = ProfessorSerializer
+    cache_models = PROFESSOR_MODELS
+    # names aren't unique, so break ties by slug
+    keyset_fields = ["name", "slug"]
+
+    def get(self, request, *args, **kwargs):
+        if param_bool(request, "bulk", default=False):
+            return stream_ndjson(self.get_queryset(), self.serializer_class,
+                self.keyset_fields, values=self.after_values)
+        return self.list(request, *args, **kwargs)
+
+    @cache_response(CACHE_MAX_AGE, params=["type", "reviews", "limit",
+        "offset", "after"], depends_on=LIST_TAGS)
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @cached_property
+    def after_values(self):
+        """
+        The keyset values for the professor whose slug was passed as `after`,
+        or `None` if it wasn't passed.
+        """
+        after = param(self.request, "after", default=None)
+        if after is None:
+            return None
+
+        professor = ProfessorModel.verified.filter(slug=after).first()
+        if not professor:
+            raise ValidationError("professor passed to after not found")
+        return [professor.name, professor.slug]
 
     def get_queryset(self):
         request = self.request
@@ -91,21 +258,70 @@ class Professors(ListAPIView):
         reviews = param_bool(request, "reviews", default=False)
         limit = param_int(request, "limit", default=100, min_=0, max_=100)
         offset = param_int(request, "offset", default=0, min_=0)
+        after_values = self.after_values
+        bulk = param_bool(request, "bulk", default=False)
         # keep backwards compatability
         if type_ == "ta":
             type_ = "TA"
 
+        if after_values is not None and offset:
+            raise ValidationError("after and offset parameters cannot be "
+                "used together")
+
         professors = ProfessorModel.verified.all()
         if type_:
             professors = professors.filter(type=type_)
 
         if reviews:
             self.serializer_class = ProfessorWithReviewsSerializer
+        professors = self.serializer_class.prefetch(professors)
+
+        if bulk:
+            return professors
+
+        if after_values is not None:
+            return keyset(professors, self.keyset_fields, after_values)[:limit]
 
         professors = professors[offset:offset + limit]
         return professors
 
+class ProfessorsBatch(APIView):
+    cache_models = PROFESSOR_MODELS
+
+    @cache_response(CACHE_MAX_AGE, params=["names", "reviews"],
+        depends_on=LIST_TAGS)
+    def get(self, request):
+        names = param_list(request, "names")
+        reviews = param_bool(request, "reviews", default=False)
+
+        Serializer = (ProfessorWithReviewsSerializer if reviews else
+            ProfessorSerializer)
+        professors = (
+            ProfessorModel.verified
+            .filter(name__in=names)
+            .order_by("pk")
+        )
+        # names aren't unique. Like `Professor`, return the first professor
+        # with each name.
+        first_professors = {}
+        for professor in Serializer.prefetch(professors):
+            first_professors.setdefault(professor.name.casefold(), professor)
+        professors = list(first_professors.values())
+        serialized = Serializer(professors, many=True).data
+
+        requested = _requested_names(names)
+        data = dict.fromkeys(names)
+        for professor, professor_data in zip(professors, serialized):
+            for name in requested[professor.name.casefold()]:
+                data[name] = professor_data
+        return Response(data)
+
+
 class Grades(APIView):
+    cache_models = [GradeModel, CourseModel, ProfessorModel]
+
+    @cache_response(CACHE_MAX_AGE, params=["course", "professor", "semester",
+        "section"], depends_on=_grades_tags)
     def get(self, request):
         course_name = param(request, "course", default=None)
         professor_name = param(request, "professor", default=None)
@@ -144,11 +360,57 @@ class Grades(APIView):
         if section:
             grades = grades.filter(section=section)
 
-        serializer = GradeSerializer(grades, many=True)
-        return Response(serializer.data)
+        # courses and professors can have thousands of grades, so skip drf's
+        # serializers and renderers here; see `grade_rows`.
+        grades = grades.order_by("pk")
+        return json_response(request, grade_rows(grades))
+
+
+class GradesBatch(APIView):
+    cache_models = [GradeModel, CourseModel, ProfessorModel]
+
+    @cache_response(CACHE_MAX_AGE, params=["courses", "semester"],
+        depends_on=[cache_tag("grade"), cache_tag("course"),
+            cache_tag("professor")])
+    def get(self, request):
+        names = param_list(request, "courses")
+        semester = param(request, "semester", default=None)
+
+        if semester:
+            try:
+                semester = Semester(semester)
+            except:
+                raise ValidationError(f"invalid semester `{semester}`")
+
+        courses = list(
+            CourseModel.recent
+            .filter(name__in=names)
+            .values_list("name", flat=True)
+        )
+        grades = GradeModel.recent.filter(course__name__in=courses)
+        if semester:
+            grades = grades.filter(semester=semester)
+
+        # courses we don't know about are `None`, while courses without any
+        # (matching) grades are an empty list, same as `Grades`.
+        rows = {name: [] for name in courses}
+        for row in grade_rows(grades.order_by("pk")):
+            rows[row["course"]].append(row)
+
+        requested = _requested_names(names)
+        data = dict.fromkeys(names)
+        for course, course_rows in rows.items():
+            for name in requested[course.casefold()]:
+                data[name] = course_rows
+
+        return json_response(request, data)
 
 
 class Search(APIView):
+    cache_models = [CourseModel, ProfessorModel]
+
+    @cache_response(CACHE_MAX_AGE, params=["query", "limit", "offset"],
+        depends_on=[cache_tag("course"), cache_tag("professor")])
     def get(self, request):
         query = param(request, "query")
         limit = param_int(request, "limit", default=30, min_=0, max_=100)
@@ -0,0 +1,87 @@
+from timeit import Timer
+
+from django.core.management import BaseCommand, CommandError
+
+from rest_framework.renderers import JSONRenderer
+
+from home.models import Grade, CourseGradeRollup, DepartmentGradeRollup
+from home.views.data_sources import CourseDifficultyData
+from api.serializers import GradeSerializer, grade_rows
+from api.utils import render_json
+
+class Command(BaseCommand):
+    help = ("Compare the speed of alternative implementations of hot paths "
+        "against the current data.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("benchmark", choices=["grades", "difficulty"])
+        parser.add_argument("-n", "--number", type=int, default=10,
+            help="how many times to run each implementation")
+        parser.add_argument("--course", help="only use grades for this course")
+
+    def handle(self, *args, **options):
+        getattr(self, f"benchmark_{options['benchmark']}")(options)
+
+    def compare(self, number, implementations):
+        # make sure we're comparing implementations which actually agree with
+        # each other before timing them
+        results = [f() for f in implementations.values()]
+        if any(result != results[0] for result in results):
+            raise CommandError("implementations returned different results")
+
+        for name, f in implementations.items():
+            seconds = min(Timer(f).repeat(repeat=3, number=number)) / number
+            self.stdout.write(f"{name}: {seconds * 1000:.2f}ms")
+
+    def benchmark_grades(self, options):
+        grades = Grade.recent.order_by("pk")
+        if options["course"]:
+            grades = grades.filter(course__name=options["course"])
+        self.stdout.write(f"rendering {grades.count()} grades")
+
+        def serializer():
+            # `Grade.course` and `Grade.professor` are lazily loaded here, same
+            # as the serializer path in the api used to do.
+            data = GradeSerializer(grades.all(), many=True).data
+            return JSONRenderer().render(data)
+
+        def fast():
+            return render_json(grade_rows(grades.all()))
+
+        self.compare(options["number"], {
+            "GradeSerializer + JSONRenderer": serializer,
+            "grade_rows + render_json": fast
+        })
+
+    def benchmark_difficulty(self, options):
+        def orm():
+            # one grouped query each for courses and departments, as
+            # `CourseDifficultyData` used to do
+            tables = {}
+            for (key, rollups, field) in [
+                ("courses", CourseGradeRollup, "course__name"),
+                ("departments", DepartmentGradeRollup, "department")
+            ]:
+                summaries = rollups.recent.exclude_pf().summary_by(field)
+                tables[key] = [(name, summary["num_students"],
+                    summary["average_gpa"]) for name, summary in
+                    summaries.items()]
+            return self.format_difficulty(tables)
+
+        def table():
+            tables = CourseDifficultyData.difficulty_table.__wrapped__()
+            return self.format_difficulty(tables)
+
+        self.compare(options["number"], {
+            "summary_by per table": orm,
+            "difficulty_table": table
+        })
+
+    @staticmethod
+    def format_difficulty(tables):
+        # gpas are displayed to two decimal places, and may differ in the
+        # last few bits between sql and python
+        return {key: [(name, num_students,
+            None if gpa is None else f"{gpa:.2f}")
+            for (name, num_students, gpa) in rows]
+            for key, rows in tables.items()}
@@ -0,0 +1,33 @@
+# Builds the search index used by `home.queries.search` and writes it to
+# `SEARCH_INDEX_PATH`, so that workers can load it on startup instead of each
+# building it from the database.
+#
+# Workers keep their index up to date as professors and courses are saved, and
+# rebuild it periodically, so this only needs to be run on deploy or after
+# bulk changes (like `updaterecency` or `loaddata`).
+
+import time
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+
+from home.search_index import SearchIndex
+
+class Command(BaseCommand):
+    help = "Builds the search index and writes it to SEARCH_INDEX_PATH."
+
+    def add_arguments(self, parser):
+        parser.add_argument("-o", "--output", default=None,
+            help="Where to write the index. Defaults to SEARCH_INDEX_PATH.")
+
+    def handle(self, *args, **options):
+        path = options["output"] or settings.SEARCH_INDEX_PATH
+        if not path:
+            raise CommandError("No output path. Set SEARCH_INDEX_PATH in "
+                "your config or pass --output.")
+
+        start = time.time()
+        index = SearchIndex.build()
+        index.save(path)
+        self.stdout.write(f"Indexed {len(index.results)} professors and "
+            f"courses to {path} in {time.time() - start:.2f}s")
@@ -7,30 +7,49 @@
 # * remove the header row at the top of the spreadsheet and check the data for
 #   invalid entries (at the bottom of the spreadsheet).
 #
+# Courses, professors, and aliases are loaded into memory up front, rows are
+# resolved against those in chunks of `BATCH_SIZE`, and grades are inserted
+# with one `bulk_create` per chunk, all inside a single transaction. So a failed
+# import doesn't leave a partial semester behind.
+#
 # After running:
+# * the recency of the imported courses is updated automatically.
+# * the grade rollups for the imported semester are refreshed automatically, so
+#   grade charts will pick up the new data immediately.
 # * go through /admin and deal with any ambiguous professors from the grade data
 #   - ie, determing which professor they actually map to and merge them into
 #   that professor.
 
-import csv
+from collections import defaultdict
+from itertools import islice
 from pathlib import Path
+import csv
+import time
 
 from django.core.management import BaseCommand, CommandError
+from django.db import transaction
 
 from home.models import Professor, Course, Grade, ProfessorAlias
+from home.rollups import refresh_rollups
 from home.utils import Semester
 
 class ValidationError(Exception):
     pass
 
 class Command(BaseCommand):
+    BATCH_SIZE = 1000
+
     def __init__(self):
         super().__init__()
 
-        self.grades = []
         self.reject_rows = []
         self.semester = None
 
+        self.course_ids = {}
+        self.alias_professor_ids = {}
+        self.professor_ids = defaultdict(list)
+        self.professor_index = None
+
     def add_arguments(self, parser):
         parser.add_argument("-s", "--semester", required=True)
         parser.add_argument("-f", "--file", required=True)
@@ -42,15 +61,43 @@ class Command(BaseCommand):
         if file_path.suffix != ".csv":
             raise CommandError("File must be a .csv")
 
-        with open(file_path, newline="") as file:
+        self.stdout.write("Loading courses and professors...")
+        self.preload()
+
+        start = time.time()
+        num_rows = 0
+        num_grades = 0
+        course_ids = set()
+        with open(file_path, newline="") as file, transaction.atomic():
             reader = csv.reader(file, delimiter=',', quotechar="\"")
 
             self.stdout.write("Importing data...")
-            for row in reader:
-                self.add_grade(row)
+            while True:
+                rows = list(islice(reader, self.BATCH_SIZE))
+                if not rows:
+                    break
 
-        grades = Grade.unfiltered.bulk_create(self.grades)
-        self.stdout.write(f"Done, added {len(grades)} grades")
+                grades = [self.parse_grade(row) for row in rows]
+                grades = [grade for grade in grades if grade is not None]
+                Grade.unfiltered.bulk_create(grades)
+                course_ids.update(grade.course_id for grade in grades)
+
+                num_rows += len(rows)
+                num_grades += len(grades)
+                rate = num_rows / max(time.time() - start, 1e-6)
+                self.stdout.write(f"Processed {num_rows} rows "
+                    f"({rate:.0f} rows/s)")
+
+        elapsed = time.time() - start
+        self.stdout.write(f"Done, added {num_grades} grades from {num_rows} "
+            f"rows in {elapsed:.2f}s "
+            f"({num_rows / max(elapsed, 1e-6):.0f} rows/s)")
+
+        num_changed = Course.update_recency(course_ids)
+        self.stdout.write(f"Updated recency of {num_changed} courses")
+
+        self.stdout.write(f"Refreshing rollups for {self.semester.name()}...")
+        refresh_rollups([self.semester])
 
         if self.reject_rows:
             print(f"Exporting {len(self.reject_rows)} rejected rows...")
@@ -63,16 +110,27 @@ class Command(BaseCommand):
             print("**** Some data could not be imported and was stored in "
                 "rejected_imports.csv ****\n")
 
+    def preload(self):
+        # names are keyed case folded, since the database (and so the
+        # `filter(name=...)` lookups these replace) compares them case
+        # insensitively.
+        self.course_ids = {name.casefold(): id_ for (name, id_) in
+            Course.unfiltered.values_list("name", "id")}
+        self.alias_professor_ids = {alias.casefold(): professor_id
+            for (alias, professor_id) in
+            ProfessorAlias.objects.values_list("alias", "professor_id")}
+        for (name, id_) in Professor.verified.values_list("name", "id"):
+            self.professor_ids[name.casefold()].append(id_)
+        self.professor_index = Professor.similar_name_index()
 
     def parse_course(self, name: str):
         if name is None:
             raise ValidationError("Missing course")
 
         name = name.strip()
-        courses = Course.unfiltered.filter(name=name)
-        if not courses.exists():
+        if name.casefold() not in self.course_ids:
             raise ValidationError(f"Course {name} doesn't exist")
-        return courses.get()
+        return self.course_ids[name.casefold()]
 
     def parse_professor(self, name: str):
         if name is None or name == "":
@@ -82,39 +140,42 @@ class Command(BaseCommand):
         lastname, firstname = name.split(", ")
         name = f"{firstname.strip()} {lastname.strip()}"
 
-        # .first() is ok here because at most one record will be returned
-        alias = ProfessorAlias.objects.filter(alias=name).first()
-        if alias:
-            return alias.professor
+        if name.casefold() in self.alias_professor_ids:
+            return self.alias_professor_ids[name.casefold()]
 
-        professors = Professor.verified.filter(name=name)
-        if professors.count() == 1:
-            return professors.first()
+        professor_ids = self.professor_ids[name.casefold()]
+        if len(professor_ids) == 1:
+            return professor_ids[0]
 
-        similar_professors = Professor.find_similar(name, 70)
-        if professors.count() > 1 or similar_professors:
+        similar_professors = Professor.find_similar(name, 70,
+            index=self.professor_index)
+        if len(professor_ids) > 1 or similar_professors:
             # if 'name' matches more than one professor or is similar to more
             # than one professor, create a new pending professor for us to
             # manually decide which professor the data belongs to.
             # We'll go through the admin panel right after running this script
             # to deal with any ambiguous professors.
+            # Each section gets its own pending professor, since sections
+            # under the same name may have been taught by different people.
             new_professor = Professor(
                 name=name,
                 type=Professor.Type.PROFESSOR
             )
             new_professor.save()
-            return new_professor
+            return new_professor.id
 
         raise ValidationError(f"Professor {name} doesn't exist")
 
-
-    def add_grade(self, row):
+    def parse_grade(self, row):
+        """
+        The (unsaved) grade for a csv row, or `None` if the row is rejected.
+        """
         try:
             grade = Grade(
                 semester=self.semester,
-                course=self.parse_course(row[0]),
+                course_id=self.parse_course(row[0]),
                 section=row[1],
-                professor=self.parse_professor(row[2]),
+                professor_id=self.parse_professor(row[2]),
                 num_students=row[3],
                 a_plus=row[4],
                 a=row[5],
@@ -135,5 +196,5 @@ class Command(BaseCommand):
         except ValidationError as e:
             print(e)
             self.reject_rows.append(row)
-        else:
-            self.grades.append(grade)
+            return None
+        return grade
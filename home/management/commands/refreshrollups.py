@@ -0,0 +1,34 @@
+# Rebuilds the precomputed grade rollup tables (`home_course_grade_rollup` and
+# `home_department_grade_rollup`) from `home_grade`. Grade charts, course
+# difficulty, and grade inflation all read from these tables instead of summing
+# raw section rows on every request.
+#
+# `importgradedata` refreshes the semester it imports automatically, and the
+# tables are populated when first migrated, so this only needs to be run by
+# hand after editing `home_grade` directly.
+
+from django.core.management import BaseCommand
+
+from home.rollups import refresh_rollups
+from home.utils import Semester
+
+class Command(BaseCommand):
+    help = ("Rebuilds the grade rollup tables. Pass one or more semesters to "
+        "only rebuild those semesters.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("-s", "--semester", action="append", default=None,
+            dest="semesters")
+
+    def handle(self, *args, **options):
+        semesters = options["semesters"]
+        if semesters is not None:
+            semesters = [Semester(s) for s in semesters]
+            names = ", ".join(s.name() for s in semesters)
+            self.stdout.write(f"Refreshing rollups for {names}...")
+        else:
+            self.stdout.write("Refreshing all rollups...")
+
+        (num_course, num_department) = refresh_rollups(semesters)
+        self.stdout.write(f"Done, wrote {num_course} course rollups and "
+            f"{num_department} department rollups")
@@ -1,12 +1,15 @@
 import re
-import requests
+from collections import defaultdict
 from datetime import datetime
 
 from django.core.management import BaseCommand
+from django.db import transaction
+from django.utils import timezone
 from argparse import RawTextHelpFormatter
 
 from home.models import Course, Professor, ProfessorCourse, ProfessorAlias
-from home.utils import Semester
+from home.umdio import UMDIOClient, DEFAULT_BASE_URL, is_error
+from home.utils import Semester, invalidate_ttl_cache, cache_tag
 
 class Command(BaseCommand):
     help = '''Updates the database with new courses and professors during the provided semester.
@@ -25,11 +28,23 @@ class Command(BaseCommand):
         super().__init__()
         self.total_num_new_courses = 0
         self.total_num_new_professors = 0
-        self.courses = Course.unfiltered.all()
-        self.verified_professors = Professor.verified.all()
-        self.non_rejected_professors = Professor.unfiltered.exclude(status=Professor.Status.REJECTED)
-        self.aliases = ProfessorAlias.objects.all()
-        self.professor_courses = ProfessorCourse.objects.all()
+        self.dry_run = False
+        self.professor_index = None
+        self.client = None
+
+        # everything we need to resolve umd.io data is loaded into these up
+        # front (see `preload`) and kept up to date as we go, instead of
+        # querying for every course and professor.
+        self.courses = {}
+        self.non_rejected_professors = defaultdict(list)
+        self.verified_slugs = set()
+        self.aliases = {}
+        self.professor_courses = defaultdict(list)
+
+        # professor course changes for the current semester, written in bulk
+        # at the end of the semester
+        self.new_professor_courses = []
+        self.updated_professor_courses = []
 
     def create_parser(self, *args, **kwargs):
         parser = super(Command, self).create_parser(*args, **kwargs)
@@ -38,48 +53,77 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument("semesters", nargs='+')
+        parser.add_argument("--base-url", default=DEFAULT_BASE_URL,
+            help="umd.io api to fetch from.")
+        parser.add_argument("--cache-dir", default=None,
+            help="Cache umd.io responses in this directory, and reuse them on "
+            "later runs.")
+        parser.add_argument("--refresh", action="store_true",
+            help="Refetch responses even if they're already cached.")
+        parser.add_argument("--workers", type=int, default=8,
+            help="Number of concurrent requests to umd.io.")
+        parser.add_argument("--dry-run", action="store_true",
+            help="Print the changes that would be made without saving them.")
 
     def handle(self, *args, **options):
         t_start = datetime.now()
         semesters = [Semester(s) for s in options['semesters']]
+        self.dry_run = options["dry_run"]
         print(f"Inputted Semesters: {', '.join(s.name() for s in semesters)}")
+        if self.dry_run:
+            print("Dry run, no changes will be saved")
 
-        for semester in semesters:
-            kwargs = {"semester": semester, "per_page": 100, "page": 1}
-            course_data = requests.get("https://api.umd.io/v1/courses", params=kwargs).json()
+        self.preload()
 
-            # if no courses were found during semester, skip.
-            if isinstance(course_data, dict) and 'error_code' in course_data.keys():
-                print(f"umd.io doesn't have data for {semester.name()}!")
-                continue
+        self.client = UMDIOClient(options["base_url"],
+            cache_dir=options["cache_dir"], refresh=options["refresh"],
+            max_workers=options["workers"])
 
-            print(f"Working on courses for {semester.name()}...")
+        for semester in semesters:
+            found_courses = False
+
+            for course_data in self.client.course_pages(semester):
+                if not found_courses:
+                    print(f"Working on courses for {semester.name()}...")
+                    found_courses = True
 
-            while course_data:
+                courses = []
                 # for every course taught during `semester`...
                 for umdio_course in course_data:
-                    course = self.courses.filter(name=umdio_course['course_id'].strip("\n\t\r ")).first()
+                    name = umdio_course['course_id'].strip("\n\t\r ")
+                    course = self.courses.get(name.casefold())
 
                     # if we don't have the course, create it.
                     if not course:
                         course = Course(
-                            name=umdio_course['course_id'].strip("\n\t\r "),
+                            name=name,
                             department=umdio_course['dept_id'].strip("\n\t\r "),
-                            course_number=umdio_course['course_id'].strip("\n\t\r ")[4:],
+                            course_number=name[4:],
                             title=umdio_course['name'].strip("\n\t\r "),
                             credits=umdio_course['credits'].strip("\n\t\r "),
                             description=umdio_course["description"].strip("\n\t\r ")
                         )
 
-                        course.save()
+                        self.save(course, f"course {course.name}")
+                        self.courses[name.casefold()] = course
                         self.total_num_new_courses += 1
+                    courses.append(course)
 
+                # fetch the professors for the whole page at once, then
+                # process them in order.
+                umdio_professors = self.client.professors_many(
+                    [course.name for course in courses])
+                for course in courses:
                     print(course)
                     # collect all the professors that taught this course during `semester`
-                    self._professors(course, semester)
+                    self._professors(course, semester,
+                        umdio_professors[course.name])
+
+            # if no courses were found during semester, skip.
+            if not found_courses:
+                print(f"umd.io doesn't have data for {semester.name()}!")
 
-                kwargs["page"] += 1
-                course_data = requests.get("https://api.umd.io/v1/courses", params=kwargs).json()
+            self.write_professor_courses(semester)
 
         print(f"\n** New Courses Created: {self.total_num_new_courses} **")
         print(f"** New Professors Created: {self.total_num_new_professors} **")
@@ -87,12 +131,93 @@ class Command(BaseCommand):
         runtime = datetime.now() - t_start
         print(f"Runtime: {round(runtime.seconds / 60, 2)} minutes")
 
-    def _professors(self, course: Course, semester: Semester):
-        kwargs = {"course_id": course.name}
-        umdio_professors = requests.get("https://api.umd.io/v1/professors", params=kwargs).json()
+    def preload(self):
+        # names are keyed case folded, since the database (and so the
+        # `filter(name=...)` lookups these replace) compares them case
+        # insensitively.
+        for course in Course.unfiltered.all():
+            self.courses[course.name.casefold()] = course
+
+        professors = (
+            Professor.unfiltered
+            .exclude(status=Professor.Status.REJECTED)
+        )
+        for professor in professors:
+            self.non_rejected_professors[professor.name.casefold()].append(
+                professor)
+            if professor.status == Professor.Status.VERIFIED:
+                self.verified_slugs.add(professor.slug)
+
+        for alias in ProfessorAlias.objects.select_related("professor"):
+            self.aliases[alias.alias.casefold()] = alias.professor
+
+        # share the course objects we just loaded, so `pc.course` doesn't
+        # query for each professor course we touch.
+        courses_by_id = {course.pk: course for course in self.courses.values()}
+        for professor_course in ProfessorCourse.objects.all():
+            professor_course.course = courses_by_id[professor_course.course_id]
+            key = (professor_course.course_id, professor_course.professor_id)
+            self.professor_courses[key].append(professor_course)
+
+        # load verified professor names once instead of for every new
+        # professor. Professors we verify below are added as we go.
+        self.professor_index = Professor.similar_name_index()
+
+    @staticmethod
+    def _key(instance):
+        # in a dry run, new courses and professors are never saved and so
+        # don't have a pk to key them by. Fall back to the object itself.
+        if instance.pk is None:
+            return ("unsaved", id(instance))
+        return instance.pk
+
+    def save(self, instance, description):
+        print(f"+ {description}")
+        if not self.dry_run:
+            instance.save()
+
+    def write_professor_courses(self, semester):
+        for professor_course in self.new_professor_courses:
+            print(f"+ {professor_course} ({semester.name()})")
+        for professor_course in self.updated_professor_courses:
+            print(f"~ {professor_course}: recent semester set to "
+                f"{semester.name()}")
+
+        if not self.dry_run:
+            # `bulk_update` doesn't bump `auto_now` fields
+            now = timezone.now()
+            for professor_course in self.updated_professor_courses:
+                professor_course.updated_at = now
+
+            with transaction.atomic():
+                ProfessorCourse.objects.bulk_create(self.new_professor_courses,
+                    batch_size=1000)
+                ProfessorCourse.objects.bulk_update(
+                    self.updated_professor_courses,
+                    ["recent_semester", "updated_at"], batch_size=1000)
+
+            # `bulk_create` and `bulk_update` don't send signals. Professor
+            # courses show up in both course and professor api responses.
+            touched = self.new_professor_courses + self.updated_professor_courses
+            if touched:
+                tags = {cache_tag("professorcourse"), cache_tag("professor")}
+                tags.update(cache_tag("course", "name", pc.course.name)
+                    for pc in touched)
+                invalidate_ttl_cache(tags)
+
+            # a course taught recently is recent, so recency can only have
+            # changed for the courses we just touched
+            course_ids = {professor_course.course_id for professor_course in
+                touched}
+            num_changed = Course.update_recency(course_ids)
+            print(f"Updated recency of {num_changed} courses")
+
+        self.new_professor_courses = []
+        self.updated_professor_courses = []
 
+    def _professors(self, course: Course, semester: Semester, umdio_professors):
         # if no professors were found for `course`, exit function.
-        if isinstance(umdio_professors, dict) and 'error_code' in umdio_professors.keys():
+        if is_error(umdio_professors):
             return
 
         # for every professor that taught `course`...
@@ -101,17 +226,16 @@ class Command(BaseCommand):
             if re.search("instructor:?\s*tba", professor_name.lower()):
                 continue
 
-            professor = self.non_rejected_professors.filter(name=professor_name)
-            alias = self.aliases.filter(alias=professor_name)
+            professors = self.non_rejected_professors[professor_name.casefold()]
 
             # if there's only one matching professor, use that professor.
-            if professor.count() == 1:
-                professor = professor.first()
+            if len(professors) == 1:
+                professor = professors[0]
 
             # if there are no matching professors but we have an alias
             # for this name, use the professor associated with that alias.
-            elif professor.count() == 0 and alias.exists():
-                professor = alias.first().professor
+            elif len(professors) == 0 and professor_name.casefold() in self.aliases:
+                professor = self.aliases[professor_name.casefold()]
 
             # Otherwise, we either don't recognize this professor or there is
             # more than one professor with this exact same name. So we create a
@@ -119,14 +243,15 @@ class Command(BaseCommand):
             # a process similar to that in admin.py.
             else:
                 professor = Professor(name=professor_name, type=Professor.Type.PROFESSOR)
-                similar_professors = Professor.find_similar(professor.name, 70)
+                similar_professors = Professor.find_similar(professor.name, 70,
+                    index=self.professor_index)
                 split_name = professor.name.strip().split()
                 new_slug = split_name[-1].lower()
                 valid_slug = True
 
-                if self.verified_professors.filter(slug=new_slug).exists():
+                if new_slug in self.verified_slugs:
                     new_slug = f"{split_name[-1]}_{split_name[0]}".lower()
-                    if self.verified_professors.filter(slug=new_slug).exists():
+                    if new_slug in self.verified_slugs:
                         valid_slug = False
 
                 # if there are no similarly named professors and there's no
@@ -135,27 +260,36 @@ class Command(BaseCommand):
                     professor.slug = new_slug
                     professor.status = Professor.Status.VERIFIED
 
-                professor.save()
+                self.save(professor, f"professor {professor.name} "
+                    f"({professor.status}, slug {professor.slug})")
                 self.total_num_new_professors += 1
+                self.non_rejected_professors[professor_name.casefold()].append(
+                    professor)
+                if professor.status == Professor.Status.VERIFIED:
+                    self.verified_slugs.add(professor.slug)
+                    self.professor_index.add(professor.name, professor)
 
             # for every course taught by `professor`...
             for entry in umdio_professor['taught']:
                 # we only care about `course` taught during `semester`.
-                if entry['course_id'] == course.name and Semester(entry['semester']) == semester:
-                    professorcourse = self.professor_courses.filter(
-                        course=course,
-                        professor=professor
-                    )
+                if entry['course_id'].casefold() == course.name.casefold() and Semester(entry['semester']) == semester:
+                    key = (self._key(course), self._key(professor))
+                    professor_courses = self.professor_courses[key]
 
                     # if only one professorcourse record and it doesn't
                     # have a recent semester, update that one record.
-                    if professorcourse.count() == 1 and not professorcourse.first().recent_semester:
-                        professorcourse.update(recent_semester=semester)
+                    if len(professor_courses) == 1 and not professor_courses[0].recent_semester:
+                        professor_course = professor_courses[0]
+                        professor_course.recent_semester = semester
+                        self.updated_professor_courses.append(professor_course)
 
                     # if there's no professorcourse entries at all that match
                     # the prof/course combo or if there are matching records but
                     # none of them have recent semester = `semester`, create a new
                     # professor course entry.
-                    elif professorcourse.count() == 0 or not professorcourse.filter(recent_semester=semester).exists():
-                        ProfessorCourse.objects.create(course=course, professor=professor, recent_semester=semester)
+                    elif not any(pc.recent_semester and pc.recent_semester == semester for pc in professor_courses):
+                        professor_course = ProfessorCourse(course=course,
+                            professor=professor, recent_semester=semester)
+                        professor_courses.append(professor_course)
+                        self.new_professor_courses.append(professor_course)
                     break
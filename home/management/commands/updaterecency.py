@@ -1,8 +1,6 @@
 from django.core.management import BaseCommand
-from django.db.models import Max, Q
 
 from home.models import Course
-from home.utils import Semester
 
 class Command(BaseCommand):
     def handle(self, *args, **options):
@@ -24,25 +22,13 @@ class Command(BaseCommand):
         # frame for a course to be considered recently taught (~10 years) and
         # the time frame for a professor to be considered having recently taught
         # a course may not be the same.
+        #
+        # `Course.update_recency` computes this for every course in one query
+        # and only writes the courses whose recency changed, so this is cheap to
+        # rerun. `importgradedata` and `updatecourses` already update the
+        # courses they touch, so this is mostly needed after loading data by
+        # other means.
 
         print("updating recency")
-
-        print("setting all courses is_recent to false")
-        # reset recency
-        Course.unfiltered.update(is_recent=False)
-
-        print("setting is_recent to true for recent courses")
-        # actually update recency
-        (
-            Course.unfiltered
-            .annotate(max_semester=Max("grade__semester"))
-            .annotate(most_recent_semester=Max(
-                "professorcourse__recent_semester")
-            )
-            .filter(
-                Q(max_semester__gte=Semester(201201)) |
-                Q(most_recent_semester__gte=Semester(201201))
-            )
-            .update(is_recent=True)
-        )
-        print("finished updating recency")
+        num_changed = Course.update_recency()
+        print(f"finished updating recency, {num_changed} courses changed")
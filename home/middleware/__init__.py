@@ -1 +1,2 @@
 from home.middleware.cors import CorsMiddleware
+from home.middleware.http_cache import HttpCacheMiddleware
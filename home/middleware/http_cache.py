@@ -0,0 +1,94 @@
+from hashlib import sha1
+
+from django.apps import apps
+from django.db.models import Count, Max
+from django.http import HttpResponseNotModified
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import quote_etag, parse_etags
+
+from home.utils import ttl_cache, cache_tag
+
+# how long clients and CDNs may reuse an api response without asking us again.
+MAX_AGE = 60
+
+def _data_version_tags(*labels):
+    # `home.signals`, `refresh_rollups`, and `updatecourses` emit a tag named
+    # after each model when it changes. Changes made some other way are only
+    # picked up once the cached version expires.
+    return [cache_tag(apps.get_model(label)._meta.model_name)
+        for label in labels]
+
+@ttl_cache(MAX_AGE, depends_on=_data_version_tags)
+def data_version(*labels):
+    """
+    A fingerprint of the current contents of the models with the given labels
+    (eg `"home.Course"`), which changes whenever rows are added, deleted, or
+    (for models with an `updated_at` field) edited.
+
+    Every model in a view's `cache_models` should have an `auto_now`
+    `updated_at` field. `QuerySet.update` and `bulk_update` don't bump those,
+    so code which uses them has to set `updated_at` itself.
+    """
+    version = []
+    for label in labels:
+        model = apps.get_model(label)
+        aggregates = {"count": Count("*"), "max_pk": Max("pk")}
+        if any(field.name == "updated_at" for field in model._meta.fields):
+            aggregates["updated_at"] = Max("updated_at")
+        values = model._default_manager.aggregate(**aggregates)
+        version.append((label, *(str(value) for value in values.values())))
+    return version
+
+class HttpCacheMiddleware:
+    """
+    Adds `ETag` and `Cache-Control` headers to GET responses from views with a
+    `cache_models` attribute, and answers requests whose `If-None-Match`
+    matches with a 304 without running the view at all.
+
+    `cache_models` lists the models a view reads from. The etag combines
+    their `data_version` with the request itself, so it only changes when the
+    data behind the response might have.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+
+        etag = getattr(request, "_http_cache_etag", None)
+        if etag is not None and response.status_code == 200:
+            self.add_headers(response, etag)
+        return response
+
+    @staticmethod
+    def add_headers(response, etag):
+        response["ETag"] = etag
+        patch_cache_control(response, public=True, max_age=MAX_AGE)
+        patch_vary_headers(response, ["Accept"])
+
+    def process_view(self, request, view_func, _view_args, _view_kwargs):
+        if request.method not in ["GET", "HEAD"]:
+            return None
+        view_class = getattr(view_func, "view_class", None)
+        models = getattr(view_class, "cache_models", None)
+        if not models:
+            return None
+
+        version = data_version(*(model._meta.label for model in models))
+        # the query string and the accept header (for drf's `indent`) are the
+        # only inputs to our api views besides the data itself.
+        fingerprint = repr((
+            request.get_full_path(),
+            request.META.get("HTTP_ACCEPT", ""),
+            version
+        ))
+        etag = quote_etag(sha1(fingerprint.encode()).hexdigest())
+        request._http_cache_etag = etag
+
+        if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+        if if_none_match and (etag in parse_etags(if_none_match) or
+            if_none_match.strip() == "*"):
+            response = HttpResponseNotModified()
+            self.add_headers(response, etag)
+            return response
+        return None
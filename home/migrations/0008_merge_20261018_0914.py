@@ -0,0 +1,14 @@
+# Generated by Django 3.2.4 on 2026-10-18 09:14
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0007_alter_professoralias_alias'),
+        ('home', '0007_course_geneds'),
+    ]
+
+    operations = [
+    ]
@@ -0,0 +1,103 @@
+# Generated by Django 3.2.4 on 2026-10-18 09:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.db.models.manager
+import home.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0008_merge_20261018_0914'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CourseGradeRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('semester', home.models.SemesterField()),
+                ('num_students', models.PositiveIntegerField()),
+                ('a_plus', models.PositiveIntegerField()),
+                ('a', models.PositiveIntegerField()),
+                ('a_minus', models.PositiveIntegerField()),
+                ('b_plus', models.PositiveIntegerField()),
+                ('b', models.PositiveIntegerField()),
+                ('b_minus', models.PositiveIntegerField()),
+                ('c_plus', models.PositiveIntegerField()),
+                ('c', models.PositiveIntegerField()),
+                ('c_minus', models.PositiveIntegerField()),
+                ('d_plus', models.PositiveIntegerField()),
+                ('d', models.PositiveIntegerField()),
+                ('d_minus', models.PositiveIntegerField()),
+                ('f', models.PositiveIntegerField()),
+                ('w', models.PositiveIntegerField()),
+                ('other', models.PositiveIntegerField()),
+            ],
+            options={
+                'db_table': 'home_course_grade_rollup',
+                'default_manager_name': 'unfiltered',
+            },
+            managers=[
+                ('unfiltered', django.db.models.manager.Manager()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DepartmentGradeRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('semester', home.models.SemesterField()),
+                ('num_students', models.PositiveIntegerField()),
+                ('a_plus', models.PositiveIntegerField()),
+                ('a', models.PositiveIntegerField()),
+                ('a_minus', models.PositiveIntegerField()),
+                ('b_plus', models.PositiveIntegerField()),
+                ('b', models.PositiveIntegerField()),
+                ('b_minus', models.PositiveIntegerField()),
+                ('c_plus', models.PositiveIntegerField()),
+                ('c', models.PositiveIntegerField()),
+                ('c_minus', models.PositiveIntegerField()),
+                ('d_plus', models.PositiveIntegerField()),
+                ('d', models.PositiveIntegerField()),
+                ('d_minus', models.PositiveIntegerField()),
+                ('f', models.PositiveIntegerField()),
+                ('w', models.PositiveIntegerField()),
+                ('other', models.PositiveIntegerField()),
+                ('department', models.CharField(max_length=4)),
+            ],
+            options={
+                'db_table': 'home_department_grade_rollup',
+                'default_manager_name': 'unfiltered',
+            },
+            managers=[
+                ('unfiltered', django.db.models.manager.Manager()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='departmentgraderollup',
+            index=models.Index(fields=['semester'], name='home_depart_semeste_511f71_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='departmentgraderollup',
+            constraint=models.UniqueConstraint(fields=('department', 'semester'), name='unique_department_semester'),
+        ),
+        migrations.AddField(
+            model_name='coursegraderollup',
+            name='course',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='home.course'),
+        ),
+        migrations.AddField(
+            model_name='coursegraderollup',
+            name='professor',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='home.professor'),
+        ),
+        migrations.AddIndex(
+            model_name='coursegraderollup',
+            index=models.Index(fields=['semester'], name='home_course_semeste_1f26fc_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='coursegraderollup',
+            constraint=models.UniqueConstraint(fields=('course', 'professor', 'semester'), name='unique_course_professor_semester'),
+        ),
+    ]
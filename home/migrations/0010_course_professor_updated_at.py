@@ -0,0 +1,23 @@
+# Generated by Django 3.2.4 on 2026-10-18 09:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0009_grade_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='course',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='professor',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
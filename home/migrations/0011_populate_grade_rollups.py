@@ -0,0 +1,60 @@
+from django.db import migrations
+from django.db.models import Sum
+
+TOTAL_FIELDS = ["num_students", "a_plus", "a", "a_minus", "b_plus", "b",
+    "b_minus", "c_plus", "c", "c_minus", "d_plus", "d", "d_minus", "f", "w",
+    "other"]
+
+def populate_rollups(apps, schema_editor):
+    # the same aggregation as `home.rollups.refresh_rollups`, but against the
+    # historical models, so this keeps working as the real models change.
+    # these models don't have an `objects` manager
+    grades = apps.get_model("home", "Grade")._default_manager
+    CourseGradeRollup = apps.get_model("home", "CourseGradeRollup")
+    DepartmentGradeRollup = apps.get_model("home", "DepartmentGradeRollup")
+    course_rollups = CourseGradeRollup._default_manager
+    department_rollups = DepartmentGradeRollup._default_manager
+
+    # `refreshrollups` was already run by hand
+    if course_rollups.exists() or department_rollups.exists():
+        return
+
+    totals = {f"{field}_total": Sum(field) for field in TOTAL_FIELDS}
+    def _totals(value):
+        return {field: value[f"{field}_total"] for field in TOTAL_FIELDS}
+
+    course_values = (
+        grades
+        .values("course", "professor", "semester")
+        .annotate(**totals)
+        .order_by()
+    )
+    course_rollups.bulk_create((
+        CourseGradeRollup(course_id=value["course"],
+            professor_id=value["professor"], semester=value["semester"],
+            **_totals(value))
+        for value in course_values
+    ), batch_size=1000)
+
+    department_values = (
+        grades
+        .values("course__department", "semester")
+        .annotate(**totals)
+        .order_by()
+    )
+    department_rollups.bulk_create((
+        DepartmentGradeRollup(department=value["course__department"],
+            semester=value["semester"], **_totals(value))
+        for value in department_values
+    ), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0010_course_professor_updated_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.2.4 on 2026-10-18 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0011_populate_grade_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='grade',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='professorcourse',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='grade',
+            index=models.Index(fields=['updated_at'], name='home_grade_updated_a042ee_idx'),
+        ),
+    ]
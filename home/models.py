@@ -1,17 +1,46 @@
 from enum import Enum
+from functools import reduce
+import operator
 
 from django.contrib.auth.models import (AbstractUser,
     UserManager as DjangoUserManager)
 from django.utils.safestring import mark_safe
 from django.utils.functional import cached_property
+from django.utils import timezone
 from django.urls import reverse
 from django.core import validators
 from django.db.models import (Model, CharField, DateTimeField, TextField,
     IntegerField, BooleanField, ForeignKey, PositiveIntegerField, EmailField,
     CASCADE, ManyToManyField, SlugField, TextChoices, FloatField, Manager,
-    QuerySet, Sum, UniqueConstraint, Index, Count, JSONField)
-
-from fuzzywuzzy import fuzz
+    QuerySet, Sum, UniqueConstraint, Index, Count, JSONField, Exists,
+    OuterRef, Q, ExpressionWrapper)
+
+# the letter grade columns shared by `Grade` and the grade rollup tables, in the
+# order umd reports them.
+GRADE_FIELDS = ["a_plus", "a", "a_minus", "b_plus", "b", "b_minus", "c_plus",
+    "c", "c_minus", "d_plus", "d", "d_minus", "f", "w", "other"]
+# grade points of each grade, for computing gpas both in python and in sql (see
+# `GradeQuerySet.average_gpa_expression`). Grades missing from here are worth
+# 0 points.
+GPA_POINTS = {"a_plus": 4, "a": 4, "a_minus": 3.7, "b_plus": 3.3, "b": 3,
+    "b_minus": 2.7, "c_plus": 2.3, "c": 2, "c_minus": 1.7, "d_plus": 1.3,
+    "d": 1, "d_minus": 0.7}
+# the grades which count towards a gpa. "other" (eg pass/fail, incomplete)
+# doesn't.
+GPA_FIELDS = [field for field in GRADE_FIELDS if field != "other"]
+
+def gpa_from_totals(totals):
+    """
+    The average gpa of `totals`, a dict mapping each of `GPA_FIELDS` to its
+    number of students, computed the same way as
+    `GradeQuerySet.average_gpa`. `None` if no students count towards a gpa.
+    """
+    num_students = sum(totals[field] for field in GPA_FIELDS)
+    if not num_students:
+        return None
+    points = sum(totals[field] * points for (field, points) in
+        GPA_POINTS.items())
+    return points / num_students
 
 class GradeQuerySet(QuerySet):
 
@@ -37,21 +66,22 @@ class GradeQuerySet(QuerySet):
         A generic way to calculate average_gpa, either as an aggregate or as an
         annotation. Not intended for external use.
         """
-        return func(
-            average_gpa=(
-                (Sum("a_plus") * 4  + Sum("a") * 4 + Sum("a_minus") * 3.7 +
-                Sum("b_plus") * 3.3 + Sum("b") * 3 + Sum("b_minus") * 2.7 +
-                Sum("c_plus") * 2.3 + Sum("c") * 2 + Sum("c_minus") * 1.7 +
-                Sum("d_plus") * 1.3 + Sum("d") * 1 + Sum("d_minus") * 0.7)
-                /
-                # TODO switch back to using `num_students - other` once
-                # discrepancies in `num_students` are fixed
-                (Sum("a_plus") + Sum("a") + Sum("a_minus") + Sum("b_plus") +
-                 Sum("b") + Sum("b_minus") +Sum("c_plus")  + Sum("c") +
-                 Sum("c_minus") + Sum("d_plus")  + Sum("d") + Sum("d_minus") +
-                 Sum("f") + Sum("w"))
-            )
-        )
+        return func(average_gpa=self.average_gpa_expression())
+
+    @staticmethod
+    def average_gpa_expression():
+        """
+        An aggregate expression for the average gpa of the grades (or grade
+        rollups) it's applied to, eg
+        `rollups.annotate(average_gpa=GradeQuerySet.average_gpa_expression())`.
+        """
+        points = reduce(operator.add, (Sum(field) * points
+            for (field, points) in GPA_POINTS.items()))
+        # TODO switch back to using `num_students - other` once
+        # discrepancies in `num_students` are fixed
+        num_students = reduce(operator.add, (Sum(field)
+            for field in GPA_FIELDS))
+        return points / num_students
 
     def num_students(self):
         return self.aggregate(
@@ -69,8 +99,50 @@ class GradeQuerySet(QuerySet):
             )
         )
 
+    def summary(self):
+        """
+        `average_gpa`, `num_students`, and `grade_totals_aggregate` computed
+        together in a single query. Returns a dict with an `average_gpa` key, a
+        `num_students` key, and the same `*_total` keys as
+        `grade_totals_aggregate`.
+        """
+        summary = self.aggregate(**self._summary_expressions())
+        return self._clean_summary(summary)
+
+    def summary_by(self, field):
+        """
+        Like `summary`, but grouped by `field` (eg `"course__name"` or
+        `"semester"`). Returns a dict mapping each value of `field` to the
+        summary for that group, ordered by `field`.
+        """
+        values = (
+            self
+            .values(field)
+            .annotate(**self._summary_expressions())
+            .order_by(field)
+        )
+        return {value.pop(field): self._clean_summary(value) for value in values}
+
+    def _summary_expressions(self):
+        # `num_students` can't be used as an annotation name, since it would
+        # shadow the field of the same name. We rename it afterwards.
+        expressions = {
+            "average_gpa": self.average_gpa_expression(),
+            "num_students_total": Sum("num_students")
+        }
+        for field in GRADE_FIELDS:
+            expressions[f"{field}_total"] = Sum(field)
+        return expressions
+
+    @staticmethod
+    def _clean_summary(summary):
+        summary["num_students"] = summary.pop("num_students_total")
+        return summary
+
     average_gpa.queryset_only = True
     num_students.queryset_only = True
+    summary.queryset_only = True
+    summary_by.queryset_only = True
 
 class RecentGradeManager(Manager):
     def get_queryset(self):
@@ -185,6 +257,7 @@ class Course(Model):
     credits = IntegerField(null=True)
     description = TextField(null=True)
     created_at = DateTimeField(auto_now_add=True)
+    updated_at = DateTimeField(auto_now=True)
     # determining whether a course is recent or not can actually be extremely
     # expensive (for reasons I don't quite understand - lacking proper
     # indices?). Since recency changes so infrequently, we'll cache it and
@@ -214,7 +287,7 @@ class Course(Model):
         default_manager_name = "unfiltered"
 
     def average_gpa(self):
-        return self.grade_set(manager="recent").all().average_gpa()
+        return self.coursegraderollup_set(manager="recent").all().average_gpa()
 
     def get_absolute_url(self):
         return reverse("course", kwargs={"name": self.name})
@@ -232,6 +305,65 @@ class Course(Model):
             gened_str.append(and_str)
         return " or ".join(gened_str)
 
+    @staticmethod
+    def update_recency(course_ids=None):
+        """
+        Recomputes `is_recent` (see `RecentCourseManager`) for the courses in
+        `course_ids`, or every course if `None`, and writes back only the ones
+        which changed. Returns the number of courses changed.
+        """
+        from home.utils import Semester, invalidate_ttl_cache, cache_tag
+
+        # `Semester(201201)` should match `RecentCourseManager` and
+        # `RecentGradeManager`.
+        since = Semester(201201)
+        recent_grades = Grade.unfiltered.filter(course=OuterRef("pk"),
+            semester__gte=since)
+        recently_taught = ProfessorCourse.objects.filter(course=OuterRef("pk"),
+            recent_semester__gte=since)
+
+        courses = Course.unfiltered.all()
+        if course_ids is not None:
+            courses = courses.filter(pk__in=course_ids)
+
+        rows = (
+            courses
+            .annotate(
+                should_be_recent=ExpressionWrapper(
+                    Q(Exists(recent_grades)) | Q(Exists(recently_taught)),
+                    output_field=BooleanField()
+                )
+            )
+            .values_list("pk", "name", "is_recent", "should_be_recent")
+        )
+
+        now_recent = []
+        no_longer_recent = []
+        tags = [cache_tag("course")]
+        for (pk, name, is_recent, should_be_recent) in rows:
+            if should_be_recent and not is_recent:
+                now_recent.append(pk)
+            if not should_be_recent and is_recent:
+                no_longer_recent.append(pk)
+            if should_be_recent != is_recent:
+                tags.append(cache_tag("course", "name", name))
+
+        # chunked to keep each update (and the locks it takes) small
+        for ids, is_recent in [(now_recent, True), (no_longer_recent, False)]:
+            for i in range(0, len(ids), 1000):
+                (
+                    Course.unfiltered
+                    .filter(pk__in=ids[i:i + 1000])
+                    # `update` doesn't bump `auto_now` fields
+                    .update(is_recent=is_recent, updated_at=timezone.now())
+                )
+
+        num_changed = len(now_recent) + len(no_longer_recent)
+        # `update` doesn't send signals
+        if num_changed:
+            invalidate_ttl_cache(tags)
+        return num_changed
+
     def __str__(self):
         return self.name
 
@@ -263,6 +395,7 @@ class Professor(Model):
     status = CharField(choices=Status.choices, default=Status.PENDING,
         max_length=50)
     created_at = DateTimeField(auto_now_add=True)
+    updated_at = DateTimeField(auto_now=True)
 
     class Meta:
         default_manager_name = "unfiltered"
@@ -280,17 +413,32 @@ class Professor(Model):
         return reverse("professor", kwargs={"slug": self.slug})
 
     @staticmethod
-    def find_similar(professor_name, tolerance):
-        similar_professors = []
-        for professor in Professor.verified.all():
-            ratio = fuzz.ratio(professor_name, professor.name)
-            if ratio > tolerance:
-                similar_professors.append({"professor" : professor, "ratio" : ratio})
+    def similar_name_index():
+        """
+        An index of verified professor names for `find_similar`. Build this
+        once and pass it to `find_similar` or `find_similar_many` when looking
+        up many names, instead of reloading every professor for each one.
+        """
+        from home.utils import SimilarNameIndex
+        professors = Professor.verified.all()
+        return SimilarNameIndex((p.name, p) for p in professors)
 
-        similar_professors.sort(key=lambda e: e["ratio"], reverse=True)
-        similar_professors = [p["professor"] for p in similar_professors]
+    @staticmethod
+    def find_similar(professor_name, tolerance, *, index=None):
+        if index is None:
+            index = Professor.similar_name_index()
+        return index.find_similar(professor_name, tolerance)
 
-        return similar_professors
+    @staticmethod
+    def find_similar_many(professor_names, tolerance, *, index=None):
+        """
+        `find_similar` for each of `professor_names`, as a dict of name to
+        similar professors, sharing one index between them.
+        """
+        if index is None:
+            index = Professor.similar_name_index()
+        return {name: index.find_similar(name, tolerance)
+            for name in professor_names}
 
     def __str__(self):
         return f"{self.name} ({self.id})"
@@ -482,6 +630,7 @@ class Grade(Model):
     f       = PositiveIntegerField(db_column="F")
     w       = PositiveIntegerField(db_column="W")
     other   = PositiveIntegerField(db_column="OTHER")
+    updated_at = DateTimeField(auto_now=True)
 
     recent = RecentGradeManager.from_queryset(GradeQuerySet)()
     unfiltered = Manager.from_queryset(GradeQuerySet)()
@@ -499,6 +648,8 @@ class Grade(Model):
         indexes = [
             Index(fields=["semester"]),
             Index(fields=["section"]),
+            # for `home.middleware.http_cache.data_version`
+            Index(fields=["updated_at"]),
         ]
         default_manager_name = "unfiltered"
 
@@ -511,6 +662,79 @@ class Grade(Model):
             f"{self.f} {self.w} {self.other}"
         )
 
+class GradeRollup(Model):
+    """
+    Precomputed sums of `Grade` rows, maintained by `refreshrollups`. Rollups
+    use the same column names as `Grade`, so `GradeQuerySet` works against them
+    unchanged, but they are a fraction of the size of `home_grade`.
+    """
+    semester = SemesterField()
+    num_students = PositiveIntegerField()
+    a_plus  = PositiveIntegerField()
+    a       = PositiveIntegerField()
+    a_minus = PositiveIntegerField()
+    b_plus  = PositiveIntegerField()
+    b       = PositiveIntegerField()
+    b_minus = PositiveIntegerField()
+    c_plus  = PositiveIntegerField()
+    c       = PositiveIntegerField()
+    c_minus = PositiveIntegerField()
+    d_plus  = PositiveIntegerField()
+    d       = PositiveIntegerField()
+    d_minus = PositiveIntegerField()
+    f       = PositiveIntegerField()
+    w       = PositiveIntegerField()
+    other   = PositiveIntegerField()
+
+    class Meta:
+        abstract = True
+
+class CourseGradeRollup(GradeRollup):
+    """
+    Grades summed over sections, keyed by (course, professor, semester).
+    """
+    course = ForeignKey(Course, CASCADE)
+    professor = ForeignKey(Professor, CASCADE, null=True)
+
+    recent = RecentGradeManager.from_queryset(GradeQuerySet)()
+    unfiltered = Manager.from_queryset(GradeQuerySet)()
+
+    class Meta:
+        db_table = "home_course_grade_rollup"
+        constraints = [
+            UniqueConstraint(
+                fields=["course", "professor", "semester"],
+                name="unique_course_professor_semester"
+            )
+        ]
+        indexes = [
+            Index(fields=["semester"])
+        ]
+        default_manager_name = "unfiltered"
+
+class DepartmentGradeRollup(GradeRollup):
+    """
+    Grades summed over every course in a department, keyed by
+    (department, semester).
+    """
+    department = CharField(max_length=4)
+
+    recent = RecentGradeManager.from_queryset(GradeQuerySet)()
+    unfiltered = Manager.from_queryset(GradeQuerySet)()
+
+    class Meta:
+        db_table = "home_department_grade_rollup"
+        constraints = [
+            UniqueConstraint(
+                fields=["department", "semester"],
+                name="unique_department_semester"
+            )
+        ]
+        indexes = [
+            Index(fields=["semester"])
+        ]
+        default_manager_name = "unfiltered"
+
 class Organization(Model):
     name = TextField()
     url = TextField()
@@ -536,6 +760,7 @@ class ProfessorCourse(Model):
     course = ForeignKey(Course, CASCADE)
     recent_semester = SemesterField(null=True, blank=True)
     created_at = DateTimeField(auto_now_add=True)
+    updated_at = DateTimeField(auto_now=True)
 
     def __str__(self):
         return f"{self.professor} teaching {self.course}"
@@ -0,0 +1,98 @@
+from django.db import transaction
+from django.db.models import Sum
+
+from home.models import (Grade, CourseGradeRollup, DepartmentGradeRollup,
+    GRADE_FIELDS)
+from home.utils import invalidate_ttl_cache, cache_tag
+
+TOTAL_FIELDS = ["num_students", *GRADE_FIELDS]
+
+def refresh_rollups(semesters=None):
+    """
+    Rebuild the grade rollup tables from `home_grade`.
+
+    If `semesters` is passed, only the rollups for those semesters are deleted
+    and rebuilt; everything else is left alone. Otherwise the tables are
+    rebuilt from scratch. Returns the number of course and department rollups
+    written.
+
+    Cached grade data for every course and professor with rollups in the
+    rebuilt semesters is invalidated afterwards.
+    """
+    grades = Grade.unfiltered.all()
+    course_rollups = CourseGradeRollup.unfiltered.all()
+    department_rollups = DepartmentGradeRollup.unfiltered.all()
+
+    if semesters is not None:
+        semesters = list(semesters)
+        grades = grades.filter(semester__in=semesters)
+        course_rollups = course_rollups.filter(semester__in=semesters)
+        department_rollups = department_rollups.filter(semester__in=semesters)
+
+    # we can't annotate with the field names themselves, since django won't
+    # let an annotation shadow a field on the model.
+    totals = {f"{field}_total": Sum(field) for field in TOTAL_FIELDS}
+
+    course_values = (
+        grades
+        .values("course", "professor", "semester")
+        .annotate(**totals)
+        .order_by()
+    )
+    department_values = (
+        grades
+        .values("course__department", "semester")
+        .annotate(**totals)
+        .order_by()
+    )
+
+    with transaction.atomic():
+        new_course_rollups = [
+            CourseGradeRollup(
+                course_id=value["course"],
+                professor_id=value["professor"],
+                semester=value["semester"],
+                **_totals(value)
+            )
+            for value in course_values
+        ]
+        new_department_rollups = [
+            DepartmentGradeRollup(
+                department=value["course__department"],
+                semester=value["semester"],
+                **_totals(value)
+            )
+            for value in department_values
+        ]
+
+        # anything which had rollups before the refresh is affected as well as
+        # anything which has rollups after, eg when a professor is merged away.
+        affected = set(_affected(course_rollups))
+
+        course_rollups.delete()
+        department_rollups.delete()
+        CourseGradeRollup.unfiltered.bulk_create(new_course_rollups,
+            batch_size=1000)
+        DepartmentGradeRollup.unfiltered.bulk_create(new_department_rollups,
+            batch_size=1000)
+
+        affected.update(_affected(course_rollups))
+
+    tags = {cache_tag("grade")}
+    for (course_name, professor_slug) in affected:
+        tags.add(cache_tag("grade", "course", course_name))
+        if professor_slug:
+            tags.add(cache_tag("grade", "professor", professor_slug))
+    transaction.on_commit(lambda: invalidate_ttl_cache(tags))
+
+    return (len(new_course_rollups), len(new_department_rollups))
+
+def _affected(course_rollups):
+    return (
+        course_rollups
+        .values_list("course__name", "professor__slug")
+        .distinct()
+    )
+
+def _totals(value):
+    return {field: value[f"{field}_total"] for field in TOTAL_FIELDS}
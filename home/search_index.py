@@ -0,0 +1,525 @@
+# An in-memory inverted index over professor names and course names and titles,
+# used by `home.queries.search` instead of `icontains` scans.
+#
+# Every name and title is broken into its 1, 2, and 3 character substrings
+# ("grams"), and the index maps each gram to the results containing it. A query
+# is answered by intersecting the posting sets of its grams and then ranking
+# the (few) surviving candidates, without touching the database.
+#
+# The index lives in each worker's memory. It's built from the database (or
+# loaded from `SEARCH_INDEX_PATH`, see the `buildsearchindex` command) the
+# first time it's needed, kept up to date by the signal receivers in
+# `home.signals` as professors and courses are saved, and rebuilt in the
+# background every `MAX_AGE` seconds to pick up changes which don't send
+# signals, like `updaterecency`.
+#
+# The search index also maintains an `AutocompleteIndex`, a sorted array of
+# course codes and professor name tokens which answers prefix queries by
+# bisection, for the autocomplete endpoint, and a `FuzzyIndex` over the words
+# in names, which finds likely misspellings of a query without computing the
+# edit distance to every name.
+
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict
+from heapq import nsmallest
+from pathlib import Path
+from threading import Lock, Thread
+import pickle
+import re
+import time
+
+from django.conf import settings
+from django.db import connection
+
+from Levenshtein import distance
+
+class SearchResult:
+    """
+    A professor or course in the search index. Mirrors the parts of `Professor`
+    and `Course` that search results are used for, so they can be rendered and
+    redirected to without going back to the database.
+    """
+    PROFESSOR = "professor"
+    COURSE = "course"
+
+    def __init__(self, type_, pk, name, slug, url, label, title=None):
+        self.type = type_
+        self.pk = pk
+        self.name = name
+        self.slug = slug
+        self.url = url
+        self.label = label
+        self.title = title
+
+    def get_absolute_url(self):
+        return self.url
+
+    def __str__(self):
+        return self.label
+
+    def __repr__(self):
+        return f"SearchResult({self.type}, {self.name!r})"
+
+
+class AutocompleteIndex:
+    """
+    Prefix lookups over course codes ("cmsc131", "131") and professor name
+    tokens ("nelson padua-perez", "padua-perez", "perez"). Entries are kept in
+    a sorted list of `(key, type, pk)`, so every entry whose key starts with a
+    query is in one contiguous range we can find with two bisections.
+
+    Not thread safe on its own; `SearchIndex` guards access to it.
+    """
+    # splits "nelson padua-perez" into the suffixes starting at each word
+    WORD_BOUNDARY = re.compile(r"[\s\-]+")
+
+    def __init__(self):
+        self._entries = []
+        self._keys = {}
+
+    @staticmethod
+    def normalize(query):
+        query = " ".join(query.lower().split())
+        # "CMSC 131" -> "cmsc131"
+        if any(character.isdigit() for character in query):
+            query = query.replace(" ", "")
+        return query
+
+    @classmethod
+    def professor_keys(cls, name):
+        name = cls.normalize(name)
+        keys = {name}
+        for match in cls.WORD_BOUNDARY.finditer(name):
+            keys.add(name[match.end():])
+        keys.discard("")
+        return keys
+
+    @classmethod
+    def course_keys(cls, name, course_number):
+        return {cls.normalize(name), cls.normalize(course_number)}
+
+    def add(self, type_, pk, keys):
+        self.remove(type_, pk)
+        self._keys[(type_, pk)] = keys
+        for key in keys:
+            insort(self._entries, (key, type_, pk))
+
+    def remove(self, type_, pk):
+        keys = self._keys.pop((type_, pk), ())
+        for key in keys:
+            i = bisect_left(self._entries, (key, type_, pk))
+            del self._entries[i]
+
+    def complete(self, query, types):
+        """
+        The `(type, pk)` of every entry of one of `types` with a key starting
+        with `query`, in no particular order.
+        """
+        query = self.normalize(query)
+        if not query:
+            return set()
+
+        lo = bisect_left(self._entries, (query,))
+        # "\uffff" sorts after any character which can appear in a key
+        hi = bisect_left(self._entries, (query + "\uffff",), lo)
+        return {(type_, pk) for (_key, type_, pk) in self._entries[lo:hi]
+            if type_ in types}
+
+
+class FuzzyIndex:
+    """
+    Finds the names with a word within a small edit distance of a query.
+
+    Candidates come from an index of the bigrams in every distinct word (and
+    whole name). A word within `k` edits of a query shares at least
+    `len(query) - 1 - 2k` of its bigrams, so only words which share that many
+    need their edit distance computed.
+
+    Not thread safe on its own; `SearchIndex` guards access to it.
+    """
+
+    def __init__(self):
+        # word -> set of (type, pk)
+        self._keys_by_word = defaultdict(set)
+        # bigram -> set of words
+        self._words_by_gram = defaultdict(set)
+        self._words = {}
+
+    @staticmethod
+    def bigrams(word):
+        return {word[i:i + 2] for i in range(len(word) - 1)}
+
+    @staticmethod
+    def max_distance(query):
+        # short queries are too ambiguous to correct
+        if len(query) < 4:
+            return 0
+        # a swapped pair of letters ("smiht") is two edits
+        if len(query) < 5:
+            return 1
+        return 2
+
+    def add(self, key, words):
+        self.remove(key)
+        self._words[key] = words
+        for word in words:
+            if not self._keys_by_word[word]:
+                for gram in self.bigrams(word):
+                    self._words_by_gram[gram].add(word)
+            self._keys_by_word[word].add(key)
+
+    def remove(self, key):
+        for word in self._words.pop(key, ()):
+            keys = self._keys_by_word[word]
+            keys.discard(key)
+            if keys:
+                continue
+            del self._keys_by_word[word]
+            for gram in self.bigrams(word):
+                words = self._words_by_gram[gram]
+                words.discard(word)
+                if not words:
+                    del self._words_by_gram[gram]
+
+    def match(self, query):
+        """
+        A dict of `(type, pk)` to the smallest edit distance between `query`
+        and one of that result's words, for every result within
+        `max_distance(query)` edits.
+        """
+        max_distance = self.max_distance(query)
+        if not max_distance:
+            return {}
+
+        grams = self.bigrams(query)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self._words_by_gram.get(gram, ()))
+        min_shared = max(1, len(query) - 1 - 2 * max_distance)
+
+        matches = {}
+        for word, count in shared.items():
+            if count < min_shared:
+                continue
+            if abs(len(word) - len(query)) > max_distance:
+                continue
+            word_distance = distance(query, word)
+            if word_distance > max_distance:
+                continue
+            for key in self._keys_by_word[word]:
+                matches[key] = min(word_distance,
+                    matches.get(key, word_distance))
+        return matches
+
+
+class SearchIndex:
+    GRAM_SIZE = 3
+
+    def __init__(self):
+        self.built_at = time.time()
+        # (type, pk) -> SearchResult
+        self.results = {}
+        # (type, pk) -> list of normalized searchable fields, name first
+        self._fields = {}
+        # gram -> set of (type, pk)
+        self._postings = defaultdict(set)
+        self.autocomplete = AutocompleteIndex()
+        self.fuzzy = FuzzyIndex()
+        self._lock = Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = Lock()
+
+    @classmethod
+    def build(cls):
+        # imported here rather than at the top, so that this module can be
+        # imported before django is set up, eg by `planetterp.wsgi`.
+        from home.models import Professor, Course
+
+        index = cls()
+        professors = (
+            Professor.verified
+            .exclude(slug=None)
+            .only("pk", "name", "slug")
+        )
+        for professor in professors:
+            index.add_professor(professor)
+
+        courses = Course.recent.only("pk", "name", "course_number", "title")
+        for course in courses:
+            index.add_course(course)
+        return index
+
+    @staticmethod
+    def normalize(text):
+        return " ".join(text.lower().split())
+
+    @classmethod
+    def grams(cls, text):
+        grams = set()
+        for size in range(1, cls.GRAM_SIZE + 1):
+            for i in range(len(text) - size + 1):
+                grams.add(text[i:i + size])
+        return grams
+
+    def add_professor(self, professor):
+        result = SearchResult(SearchResult.PROFESSOR, professor.pk,
+            professor.name, professor.slug, professor.get_absolute_url(),
+            str(professor))
+        self._add(result, [professor.name],
+            AutocompleteIndex.professor_keys(professor.name))
+
+    def add_course(self, course):
+        result = SearchResult(SearchResult.COURSE, course.pk, course.name,
+            course.name, course.get_absolute_url(), str(course),
+            title=course.title)
+        self._add(result, [course.name, course.title or ""],
+            AutocompleteIndex.course_keys(course.name, course.course_number))
+
+    def _add(self, result, fields, autocomplete_keys):
+        key = (result.type, result.pk)
+        fields = [self.normalize(field) for field in fields]
+        with self._lock:
+            self._remove(key)
+            self.results[key] = result
+            self._fields[key] = fields
+            for field in fields:
+                for gram in self.grams(field):
+                    self._postings[gram].add(key)
+            self.autocomplete.add(result.type, result.pk, autocomplete_keys)
+            # only names are corrected, not course titles
+            name = fields[0]
+            words = {name, *name.split(),
+                *AutocompleteIndex.WORD_BOUNDARY.split(name)}
+            self.fuzzy.add(key, words)
+
+    def remove(self, type_, pk):
+        with self._lock:
+            self._remove((type_, pk))
+
+    def _remove(self, key):
+        # callers must hold `self._lock`
+        fields = self._fields.pop(key, None)
+        if fields is None:
+            return
+        del self.results[key]
+        self.autocomplete.remove(*key)
+        self.fuzzy.remove(key)
+        for field in fields:
+            for gram in self.grams(field):
+                postings = self._postings[gram]
+                postings.discard(key)
+                if not postings:
+                    del self._postings[gram]
+
+    def _candidates(self, query):
+        if len(query) <= self.GRAM_SIZE:
+            return set(self._postings.get(query, ()))
+
+        grams = [query[i:i + self.GRAM_SIZE]
+            for i in range(len(query) - self.GRAM_SIZE + 1)]
+        postings = sorted((self._postings.get(gram, set()) for gram in grams),
+            key=len)
+        return set.intersection(*postings)
+
+    @staticmethod
+    def _rank(query, fields):
+        """
+        How well `query` matches a result, lower is better, or `None` if it
+        doesn't contain `query` at all.
+        """
+        name = fields[0]
+        if name == query:
+            return 0
+        if name.startswith(query):
+            return 1
+        if f" {query}" in name or f"-{query}" in name:
+            return 2
+        if query in name:
+            return 3
+        if any(query in field for field in fields[1:]):
+            return 4
+        return None
+
+    FUZZY_RANK = 5
+
+    def search(self, query, limit=None, *, professors=False, courses=False):
+        """
+        Professors and/or courses matching `query`, best match first.
+
+        Results whose name (or title, for courses) contains `query` are ranked
+        by whether it's an exact match, a prefix, the start of a word, or
+        somewhere else. If nothing contains `query`, we assume it's misspelled
+        and return results with a word a small edit distance away instead,
+        closest first. Ties are broken by type (professors first), then by
+        name. Only the best `limit` results are returned, if passed.
+        """
+        query = self.normalize(query)
+        if not query:
+            return []
+
+        types = []
+        if professors:
+            types.append(SearchResult.PROFESSOR)
+        if courses:
+            types.append(SearchResult.COURSE)
+
+        with self._lock:
+            ranks = {}
+            for key in self._candidates(query):
+                if key[0] not in types:
+                    continue
+                rank = self._rank(query, self._fields[key])
+                if rank is not None:
+                    ranks[key] = (rank, 0)
+
+            # only correct queries which don't match anything as typed, so eg
+            # "herman" still finds just "Larry Herman" and not "Herman" plus
+            # everyone named "Hermon".
+            if not ranks:
+                for key, edits in self.fuzzy.match(query).items():
+                    if key[0] in types:
+                        ranks[key] = (self.FUZZY_RANK, edits)
+
+            results = [(rank, self.results[key]) for key, rank in ranks.items()]
+
+        def sort_key(entry):
+            (rank, result) = entry
+            return (rank, types.index(result.type), result.name)
+
+        if limit is None:
+            results.sort(key=sort_key)
+        else:
+            results = nsmallest(limit, results, key=sort_key)
+        return [result for (_rank, result) in results]
+
+    def complete(self, query, num_results, *, professors=False,
+        courses=False):
+        """
+        The first `num_results` professors and/or courses with a course code or
+        name token starting with `query`, by type (professors first) and then
+        by name, followed by courses with a title containing `query`.
+        """
+        types = []
+        if professors:
+            types.append(SearchResult.PROFESSOR)
+        if courses:
+            types.append(SearchResult.COURSE)
+
+        with self._lock:
+            keys = self.autocomplete.complete(query, types)
+            results = [self.results[key] for key in keys]
+
+            # course titles aren't in the autocomplete index, but courses whose
+            # title contains `query` still fill up any remaining results.
+            title_matches = []
+            normalized = self.normalize(query)
+            if courses and normalized and len(keys) < num_results:
+                for key in self._candidates(normalized):
+                    if key[0] != SearchResult.COURSE or key in keys:
+                        continue
+                    titles = self._fields[key][1:]
+                    if any(normalized in title for title in titles):
+                        title_matches.append(self.results[key])
+
+        results = nsmallest(num_results, results,
+            key=lambda result: (types.index(result.type), result.name))
+        results += nsmallest(num_results - len(results), title_matches,
+            key=lambda result: result.name)
+        return results
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+
+# rebuild the index from the database at least this often
+MAX_AGE = 60 * 60
+
+_index = None
+_index_lock = Lock()
+_rebuilding = False
+# updates applied to `_index` while it's being rebuilt, which are replayed onto
+# the rebuilt index before it replaces the old one.
+_pending_updates = []
+
+def get_search_index():
+    """
+    This process's search index, building or loading it if necessary.
+    """
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = _load_or_build()
+
+    if time.time() - _index.built_at > MAX_AGE:
+        _rebuild_in_background()
+    return _index
+
+def loaded_search_index():
+    """
+    This process's search index if it's been loaded, and `None` otherwise.
+    """
+    return _index
+
+def update_search_index(update):
+    """
+    Calls `update` with this process's search index, if it's been loaded. Used
+    to keep the index up to date without building it unnecessarily.
+
+    If the index is being rebuilt, `update` is also applied to the rebuilt
+    index, since the rebuild may have read the database before the change.
+    """
+    with _index_lock:
+        if _index is None:
+            return
+        update(_index)
+        if _rebuilding:
+            _pending_updates.append(update)
+
+def _load_or_build():
+    path = getattr(settings, "SEARCH_INDEX_PATH", None)
+    if path and Path(path).exists():
+        index = SearchIndex.load(path)
+        # the file is as old as the last deploy, but signals keep the loaded
+        # index up to date from here on. Keeping the file's `built_at` would
+        # make every worker rebuild as soon as it's loaded a stale file.
+        index.built_at = time.time()
+        return index
+    return SearchIndex.build()
+
+def _rebuild_in_background():
+    global _rebuilding
+    with _index_lock:
+        if _rebuilding:
+            return
+        _rebuilding = True
+
+    def rebuild():
+        global _index, _rebuilding
+        try:
+            index = SearchIndex.build()
+            with _index_lock:
+                for update in _pending_updates:
+                    update(index)
+                _index = index
+        finally:
+            with _index_lock:
+                _rebuilding = False
+                _pending_updates.clear()
+            # this thread's connection would otherwise never be closed
+            connection.close()
+
+    Thread(target=rebuild).start()
@@ -0,0 +1,125 @@
+# Invalidates `ttl_cache`d values when the models they're computed from change,
+# so that eg a newly verified review shows up in review statistics right away
+# without throwing away unrelated cached grade data.
+#
+# Each change emits a broad tag for the model (`cache_tag("review")`) as well
+# as narrower tags for the rows it affects (`cache_tag("review", "professor",
+# slug)`). Cached functions declare which of these they depend on with
+# `ttl_cache(depends_on=...)`.
+#
+# Professor and course changes are also applied to this process's search index
+# (see `home.search_index`), if it's been loaded.
+#
+# Note that `bulk_create` and `QuerySet.update` don't send signals, so code
+# which uses them is responsible for calling `invalidate_ttl_cache` itself.
+#
+# Invalidation reaches every worker only with `TTL_CACHE_BACKEND = "django"`.
+# With the default in-process backend, other workers keep serving their cached
+# values until those expire.
+
+from threading import local
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from home.models import Course, Professor, Review, Grade, Gened
+from home.utils import invalidate_ttl_cache, cache_tag
+from home.search_index import (update_search_index, SearchIndex,
+    SearchResult)
+
+def invalidate_on_commit(tags):
+    # wait until the change is visible to other connections before
+    # recomputing anything.
+    transaction.on_commit(lambda: invalidate_ttl_cache(tags))
+
+def update_search_index_on_commit(type_, instance, add, searchable):
+    def update(index):
+        if searchable:
+            add(index, instance)
+        else:
+            index.remove(type_, instance.pk)
+    transaction.on_commit(lambda: update_search_index(update))
+
+@receiver([post_save, post_delete], sender=Course)
+def course_changed(sender, instance, signal, **kwargs):
+    # update the index first, so cached search responses aren't recomputed
+    # from the old index.
+    searchable = signal is post_save and instance.is_recent
+    update_search_index_on_commit(SearchResult.COURSE, instance,
+        SearchIndex.add_course, searchable)
+
+    invalidate_on_commit([
+        cache_tag("course"),
+        cache_tag("course", "name", instance.name)
+    ])
+
+@receiver([post_save, post_delete], sender=Professor)
+def professor_changed(sender, instance, signal, **kwargs):
+    searchable = (signal is post_save and instance.slug is not None and
+        instance.status == Professor.Status.VERIFIED)
+    update_search_index_on_commit(SearchResult.PROFESSOR, instance,
+        SearchIndex.add_professor, searchable)
+
+    invalidate_on_commit([
+        cache_tag("professor"),
+        cache_tag("professor", "slug", instance.slug)
+    ])
+
+@receiver([post_save, post_delete], sender=Review)
+def review_changed(sender, instance, **kwargs):
+    tags = [
+        cache_tag("review"),
+        cache_tag("review", "professor", instance.professor.slug)
+    ]
+    if instance.course:
+        tags.append(cache_tag("review", "course", instance.course.name))
+    invalidate_on_commit(tags)
+
+@receiver([post_save, post_delete], sender=Gened)
+def gened_changed(sender, instance, **kwargs):
+    invalidate_on_commit([cache_tag("gened")])
+
+# the semesters whose grades changed in this thread's current transaction and
+# whose rollups still need refreshing, along with the commit hook which will
+# refresh them. Connections are per thread, so this is per transaction.
+_pending_rollups = local()
+
+def _refresh_rollup_on_commit(semester, refresh_rollups):
+    semesters = getattr(_pending_rollups, "semesters", None)
+    hook = getattr(_pending_rollups, "hook", None)
+    # django forgets commit hooks when their transaction or savepoint is rolled
+    # back, so if our hook is gone, so is the transaction its semesters were
+    # pending for. An empty set means the hook already ran. (If only a savepoint
+    # within the transaction rolls back, its semesters are still refreshed,
+    # which is harmless.)
+    registered = any(func is hook for (_sids, func) in
+        transaction.get_connection().run_on_commit)
+    if semesters and registered:
+        semesters.add(semester)
+        return
+
+    semesters = {semester}
+    def hook():
+        pending = list(semesters)
+        semesters.clear()
+        refresh_rollups(pending)
+
+    _pending_rollups.semesters = semesters
+    _pending_rollups.hook = hook
+    # outside a transaction, this runs the hook right away.
+    transaction.on_commit(hook)
+
+@receiver([post_save, post_delete], sender=Grade)
+def grade_changed(sender, instance, **kwargs):
+    # avoid circular import
+    from home.rollups import refresh_rollups
+
+    # grade data is read from the rollups, so those need to be updated before
+    # anything is recomputed. `refresh_rollups` invalidates the relevant tags
+    # itself.
+    #
+    # Imports save many grades in one transaction, so rather than refreshing a
+    # semester once per grade, a single commit hook refreshes every semester
+    # changed in the transaction.
+    _refresh_rollup_on_commit(instance.semester, refresh_rollups)
@@ -1,3 +1,1377 @@
-from django.test import TestCase
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Event
+from unittest import mock
+from urllib.parse import urlparse, parse_qs
+import csv
+import io
+import json
+import os
+import tempfile
+import time
 
-# Create your tests here.
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection, transaction, DatabaseError
+from django.db.models import Sum, F
+from django.test import TestCase, SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from fuzzywuzzy import fuzz
+from rest_framework.renderers import JSONRenderer
+
+from home.models import (Course, Professor, ProfessorCourse, Grade, Review,
+    Gened, User, CourseGradeRollup, DepartmentGradeRollup, GRADE_FIELDS)
+from home.rollups import refresh_rollups
+from home import queries, search_index
+from home.umdio import UMDIOClient
+from home.middleware import http_cache
+from home.utils import (Semester, _response_cache, invalidate_ttl_cache,
+    cache_tag, ttl_cache, TTLCache, TTLCacheBackend, DjangoTTLCache,
+    _approximate_size, AdminAction)
+from home.views.data_sources import GradeData, CourseDifficultyData
+from home.views.admin import _find_similar_professors
+from home.views.tools import ToolStatistics, ToolPopularCourses
+from api.serializers import GradeSerializer, CourseSerializer
+from api.utils import render_json, stream_ndjson, LOCAL_MAX_AGE
+from api.views import CACHE_MAX_AGE
+
+def create_grade(course, professor, semester, section, count=10):
+    totals = {field: count for field in GRADE_FIELDS}
+    return Grade.unfiltered.create(course=course, professor=professor,
+        semester=semester, section=section,
+        num_students=count * len(GRADE_FIELDS), **totals)
+
+class ProfessorCourseGradeDataTest(TestCase):
+    def setUp(self):
+        self.professor = Professor.unfiltered.create(name="Jane Doe",
+            slug="doe", type=Professor.Type.PROFESSOR,
+            status=Professor.Status.VERIFIED)
+        self.semester = Semester(202108)
+
+    def add_courses(self, num_courses):
+        start = Course.unfiltered.count()
+        for i in range(start, start + num_courses):
+            course = Course(department="CMSC", course_number=f"{100 + i}",
+                is_recent=True)
+            course.save()
+            ProfessorCourse.objects.create(course=course,
+                professor=self.professor, recent_semester=self.semester)
+            create_grade(course, self.professor, self.semester, "0101")
+        refresh_rollups()
+
+    def course_grade_data(self):
+        # bypass the ttl cache so every call actually hits the database
+        return GradeData._course_grade_data.__wrapped__(self.professor.name,
+            False)
+
+    def test_query_count_is_constant(self):
+        self.add_courses(1)
+        with self.assertNumQueries(3):
+            self.course_grade_data()
+
+        self.add_courses(40)
+        with self.assertNumQueries(3):
+            grade_data = self.course_grade_data()
+
+        self.assertEqual(len(grade_data["courses"]), 41)
+
+    def test_course_summaries(self):
+        self.add_courses(2)
+        grade_data = self.course_grade_data()
+        summary = grade_data["courses"]["CMSC100"]
+
+        self.assertEqual(summary["num_students"], 10 * len(GRADE_FIELDS))
+        self.assertEqual(summary["a_plus_total"], 10)
+        self.assertEqual(grade_data["num_students"],
+            2 * 10 * len(GRADE_FIELDS))
+
+    def commit(self, function):
+        # refreshing rollups on commit registers another commit hook to
+        # invalidate their tags, which a single `captureOnCommitCallbacks`
+        # wouldn't run.
+        with self.captureOnCommitCallbacks() as callbacks:
+            function()
+        with self.captureOnCommitCallbacks(execute=True):
+            for callback in callbacks:
+                callback()
+
+    def test_depends_on_professor(self):
+        self.commit(lambda: self.add_courses(1))
+        course = Course.unfiltered.get()
+        other = Professor.unfiltered.create(name="John Smith", slug="smith",
+            type=Professor.Type.PROFESSOR, status=Professor.Status.VERIFIED)
+        cache = TTLCache(max_size=10, max_bytes=1024 * 1024)
+
+        with mock.patch("home.utils._ttl_cache", cache), \
+            mock.patch.object(cache, "recompute") as recompute:
+            GradeData._course_grade_data(self.professor.name, False)
+
+            # another professor's grades and details don't affect this one.
+            # Refreshing a semester's rollups affects everyone who has grades
+            # in it, so use one this professor has no grades in.
+            self.commit(lambda: (
+                create_grade(course, other, Semester(202101), "0201"),
+                other.save()
+            ))
+            recompute.assert_not_called()
+
+            self.commit(lambda:
+                create_grade(course, self.professor, self.semester, "0301"))
+            recompute.assert_called_once()
+
+
+class GradeSummaryTest(TestCase):
+    def setUp(self):
+        professor = Professor.unfiltered.create(name="Jane Doe", slug="doe",
+            type=Professor.Type.PROFESSOR, status=Professor.Status.VERIFIED)
+        courses = [Course.unfiltered.create(department="CMSC",
+            course_number=number) for number in ["131", "132"]]
+        # a pass/fail semester, so excluding those changes the result
+        semesters = [Semester(202001), Semester(202108)]
+        for (i, course) in enumerate(courses):
+            for (j, semester) in enumerate(semesters):
+                create_grade(course, professor, semester, "0101",
+                    count=1 + i + 2 * j)
+        # vary the distribution, so the average gpa isn't just the mean of
+        # every grade's points
+        Grade.unfiltered.filter(course=courses[0]).update(
+            a_plus=F("a_plus") + 7, f=F("f") + 3)
+
+    def expected_summary(self, grades):
+        return {
+            "average_gpa": grades.average_gpa(),
+            "num_students": grades.num_students(),
+            **grades.grade_totals_aggregate()
+        }
+
+    def assert_summaries_match(self, grades):
+        self.assertEqual(grades.summary(), self.expected_summary(grades))
+
+        summaries = grades.summary_by("course__name")
+        names = grades.values_list("course__name", flat=True).distinct()
+        self.assertCountEqual(summaries, names)
+        for (name, summary) in summaries.items():
+            self.assertEqual(summary,
+                self.expected_summary(grades.filter(course__name=name)))
+
+    def test_summary(self):
+        self.assert_summaries_match(Grade.unfiltered.all())
+
+    def test_exclude_pf(self):
+        grades = Grade.unfiltered.exclude_pf()
+        self.assertNotEqual(grades.summary(), Grade.unfiltered.all().summary())
+        self.assert_summaries_match(grades)
+
+    def test_empty(self):
+        grades = Grade.unfiltered.filter(semester=Semester(201908))
+        self.assert_summaries_match(grades)
+        self.assertIsNone(grades.summary()["average_gpa"])
+        self.assertEqual(grades.summary_by("course__name"), {})
+
+
+class AutocompleteTest(TestCase):
+    def setUp(self):
+        Professor.unfiltered.create(name="Nelson Padua-Perez",
+            slug="padua-perez", type=Professor.Type.PROFESSOR,
+            status=Professor.Status.VERIFIED)
+        for course_number in ["131", "132", "216"]:
+            Course(department="CMSC", course_number=course_number,
+                is_recent=True).save()
+        search_index._index = search_index.SearchIndex.build()
+
+    def tearDown(self):
+        search_index._index = None
+
+    def autocomplete(self, query):
+        response = self.client.get(reverse("autocomplete"), {
+            "query": query,
+            "types[]": ["professor", "course"],
+            "return_attrs[]": ["url"]
+        })
+        return [result["label"] for result in response.json()]
+
+    def test_prefixes(self):
+        self.assertEqual(self.autocomplete("cmsc 13"), ["CMSC131", "CMSC132"])
+        self.assertEqual(self.autocomplete("216"), ["CMSC216"])
+        self.assertEqual(self.autocomplete("pere"), ["Nelson Padua-Perez"])
+        self.assertEqual(self.autocomplete("padua-p"), ["Nelson Padua-Perez"])
+        self.assertEqual(self.autocomplete("zzz"), [])
+
+    def test_titles(self):
+        Course(department="HIST", course_number="200", title="Interpreting 216",
+            is_recent=True).save()
+        search_index._index = search_index.SearchIndex.build()
+        # title matches come after code and name matches
+        self.assertEqual(self.autocomplete("216"), ["CMSC216", "HIST200"])
+        self.assertEqual(self.autocomplete("interp"), ["HIST200"])
+
+    def test_no_queries(self):
+        with self.assertNumQueries(0):
+            self.autocomplete("cmsc")
+
+
+class SearchTest(TestCase):
+    def setUp(self):
+        Professor.unfiltered.create(name="Larry Herman", slug="herman",
+            type=Professor.Type.PROFESSOR, status=Professor.Status.VERIFIED)
+        Course(department="HERM", course_number="101", title="Hermeneutics",
+            is_recent=True).save()
+        for course_number in ["131", "132", "216"]:
+            Course(department="CMSC", course_number=course_number,
+                is_recent=True).save()
+        search_index._index = search_index.SearchIndex.build()
+
+    def tearDown(self):
+        search_index._index = None
+
+    def search(self, query, num_results=30, offset=0):
+        results = queries.search(query, num_results, offset=offset,
+            professors=True, courses=True)
+        return [result.name for result in results]
+
+    def test_ranking(self):
+        # a prefix match on a course ranks above a word match on a professor
+        self.assertEqual(self.search("herm"), ["HERM101", "Larry Herman"])
+        self.assertEqual(self.search("herman"), ["Larry Herman"])
+
+    def test_ranking_order(self):
+        professors = [("Herman", "herman_1"), ("Herman Hollerith", "hollerith"),
+            ("Bob Sherman", "sherman")]
+        for (name, slug) in professors:
+            Professor.unfiltered.create(name=name, slug=slug,
+                type=Professor.Type.PROFESSOR,
+                status=Professor.Status.VERIFIED)
+        Course(department="ENGL", course_number="101", title="Herman Melville",
+            is_recent=True).save()
+        search_index._index = search_index.SearchIndex.build()
+
+        # exact, prefix, start of a word, anywhere in the name, then titles
+        self.assertEqual(self.search("herman"), ["Herman", "Herman Hollerith",
+            "Larry Herman", "Bob Sherman", "ENGL101"])
+
+    def test_misspellings(self):
+        self.assertEqual(self.search("hreman"), ["Larry Herman"])
+        self.assertEqual(self.search("cmsc2l6"), ["CMSC216"])
+        self.assertEqual(self.search("zzzzzz"), [])
+
+    def test_offset(self):
+        self.assertEqual(self.search("cmsc", 2), ["CMSC131", "CMSC132"])
+        self.assertEqual(self.search("cmsc", 2, offset=1),
+            ["CMSC132", "CMSC216"])
+
+    def test_load(self):
+        index = search_index._index
+        # an index file from an old deploy
+        index.built_at = 0
+        with tempfile.TemporaryDirectory() as directory:
+            path = f"{directory}/search_index.pickle"
+            index.save(path)
+
+            search_index._index = None
+            with override_settings(SEARCH_INDEX_PATH=path), \
+                mock.patch.object(search_index, "_rebuild_in_background") as \
+                rebuild, self.assertNumQueries(0):
+                self.assertEqual(self.search("herm"), ["HERM101", "Larry Herman"])
+            # the loaded index counts as fresh, rather than being rebuilt by
+            # every worker that loads it
+            rebuild.assert_not_called()
+
+    def test_rebuild_keeps_updates(self):
+        course = Course(department="CMSC", course_number="330", is_recent=True)
+        course.save()
+        # an index built from the database before `course` was saved...
+        stale = search_index.SearchIndex.build()
+        stale.remove(search_index.SearchResult.COURSE, course.pk)
+
+        def build():
+            # ...while `course` is saved mid rebuild
+            search_index.update_search_index(
+                lambda index: index.add_course(course))
+            return stale
+
+        with mock.patch.object(search_index.SearchIndex, "build", build):
+            search_index._rebuild_in_background()
+            start = time.time()
+            while search_index._rebuilding and time.time() - start < 5:
+                time.sleep(0.01)
+
+        self.assertIs(search_index._index, stale)
+        self.assertEqual(self.search("cmsc330"), ["CMSC330"])
+
+
+class FindSimilarTest(TestCase):
+    def test_matches_full_scan(self):
+        names = ["Larry Herman", "Larry Hermann", "Harry Herman", "Jon Smith",
+            "John Smith", "Johnathan Smithson", "Nelson Padua-Perez", "A"]
+        for name in names:
+            Professor.unfiltered.create(name=name, type=Professor.Type.PROFESSOR,
+                status=Professor.Status.VERIFIED)
+
+        lookups = ["Larry Herman", "Jon Smyth", "Padua Perez", "A", "", "Zed"]
+        similar = Professor.find_similar_many(lookups, 70)
+        for query in lookups:
+            ratios = [(fuzz.ratio(query, p.name), p)
+                for p in Professor.verified.all()]
+            expected = sorted((r for r in ratios if r[0] > 70),
+                key=lambda r: r[0], reverse=True)
+            self.assertEqual(similar[query], [p for (_ratio, p) in expected])
+
+    def test_admin_reuses_index(self):
+        for name in ["Larry Herman", "Larry Hermann", "Jon Smith"]:
+            Professor.unfiltered.create(name=name, type=Professor.Type.PROFESSOR,
+                status=Professor.Status.VERIFIED)
+        cache = TTLCache(max_size=10, max_bytes=1024 * 1024)
+
+        with mock.patch("home.utils._ttl_cache", cache):
+            self.assertEqual(_find_similar_professors("Larry Herman", 70),
+                Professor.find_similar("Larry Herman", 70))
+            # only the professors found are loaded, not every professor
+            with self.assertNumQueries(1):
+                similar = _find_similar_professors("Jon Smyth", 70)
+        self.assertEqual([p.name for p in similar], ["Jon Smith"])
+
+
+class TTLCacheTest(SimpleTestCase):
+    def compute(self, cache, key, value, tags=()):
+        return cache.compute(key, (TTLCacheBackend.ALL, *tags), 60,
+            lambda: value)
+
+    def test_evicts_by_count(self):
+        cache = TTLCache(max_size=2, max_bytes=1024 * 1024)
+        self.compute(cache, "a", 1)
+        self.compute(cache, "b", 2)
+        # touch "a", so "b" is the least recently used
+        cache.get("a", [TTLCacheBackend.ALL])
+        self.compute(cache, "c", 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.evictions, 1)
+        self.assertIsNone(cache.get("b", [TTLCacheBackend.ALL]))
+        self.assertIsNotNone(cache.get("a", [TTLCacheBackend.ALL]))
+
+    def test_evicts_by_bytes(self):
+        value = "x" * 1000
+        cache = TTLCache(max_size=100,
+            max_bytes=int(_approximate_size(value) * 2.5))
+        for key in ["a", "b", "c"]:
+            self.compute(cache, key, value)
+
+        self.assertEqual(len(cache), 2)
+        self.assertLessEqual(cache.num_bytes, cache.max_bytes)
+        self.assertIsNone(cache.get("a", [TTLCacheBackend.ALL]))
+
+        # a value larger than the limit is still cached on its own
+        self.compute(cache, "big", "x" * 10000)
+        self.assertEqual([key for (key, _) in cache.items()], ["big"])
+
+    def test_stale_while_revalidate(self):
+        cache = TTLCache(max_size=10, max_bytes=1024 * 1024)
+        calls = []
+        @ttl_cache(60)
+        def function():
+            calls.append(None)
+            return len(calls)
+
+        with mock.patch("home.utils._ttl_cache", cache), \
+            mock.patch("home.utils.time.time") as time:
+            time.return_value = 1000
+            self.assertEqual(function(), 1)
+            self.assertEqual(function(), 1)
+
+            # once expired, the old value is returned while the new one is
+            # computed in the background
+            time.return_value = 1100
+            self.assertEqual(function(), 1)
+            cache._executor.shutdown(wait=True)
+            self.assertEqual(function(), 2)
+            self.assertEqual(len(calls), 2)
+
+    def test_failed_recompute(self):
+        cache = TTLCache(max_size=10, max_bytes=1024 * 1024)
+        tags = [TTLCacheBackend.ALL]
+        self.compute(cache, "key", "value")
+        cache.mark_stale()
+
+        def fail():
+            raise ValueError("database went away")
+
+        with self.assertLogs("home.utils", "ERROR") as logs, \
+            mock.patch("home.utils.connection") as connection:
+            cache.recompute("key", tags, 60, fail)
+            cache._executor.shutdown(wait=True)
+        self.assertIn("database went away", logs.output[0])
+        # the worker thread doesn't keep its connection around
+        connection.close.assert_called()
+        self.assertEqual(cache.get("key", tags)[1], "value")
+
+    def test_single_flight(self):
+        cache = TTLCache(max_size=10, max_bytes=1024 * 1024)
+        started = Event()
+        release = Event()
+        calls = []
+        def function():
+            calls.append(None)
+            started.set()
+            release.wait(5)
+            return "value"
+
+        results = []
+        def compute():
+            results.append(cache.compute("key", [TTLCacheBackend.ALL], 60,
+                function))
+
+        threads = [Thread(target=compute)]
+        threads[0].start()
+        started.wait(5)
+        threads += [Thread(target=compute) for _ in range(8)]
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ["value"] * 9)
+        # nothing is left waiting on a finished computation
+        self.assertEqual(cache._computing, {})
+        self.assertEqual(self.compute(cache, "key", "other"), "value")
+
+
+@override_settings(CACHES={
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "ttl": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "ttl-cache-test"
+    }
+})
+class DjangoTTLCacheTest(SimpleTestCase):
+    def setUp(self):
+        caches["ttl"].clear()
+        self.tags = (TTLCacheBackend.ALL, "course")
+
+    def compute(self, cache, key, value):
+        return cache.compute(key, self.tags, 60, lambda: value, register=False)
+
+    def test_shared_between_instances(self):
+        first = DjangoTTLCache("ttl")
+        second = DjangoTTLCache("ttl")
+        self.compute(first, "a", 1)
+        self.assertEqual(second.get("a", self.tags)[1], 1)
+
+        # an invalidation in one worker marks the value stale in every worker
+        second.invalidate(["course"])
+        self.assertEqual(first.get("a", self.tags), (0, 1))
+        self.assertEqual(self.compute(first, "a", 2), 2)
+        self.assertNotEqual(second.get("a", self.tags)[0], 0)
+
+        # unrelated tags don't affect the value
+        first.invalidate(["review"])
+        self.assertNotEqual(second.get("a", self.tags)[0], 0)
+
+    def test_evicted_generation(self):
+        cache = DjangoTTLCache("ttl")
+        self.compute(cache, "a", 1)
+        cache.invalidate(["course"])
+        self.compute(cache, "a", 2)
+
+        # losing the generation counter makes the value stale, and the
+        # restarted counter doesn't make older values fresh again.
+        caches["ttl"].delete(cache._tag_key("course"))
+        self.assertEqual(cache.get("a", self.tags), (0, 2))
+        cache.invalidate(["course"])
+        self.assertEqual(cache.get("a", self.tags), (0, 2))
+        self.assertEqual(self.compute(cache, "a", 3), 3)
+        self.assertNotEqual(cache.get("a", self.tags)[0], 0)
+
+
+
+class StubUMDIOServer:
+    """
+    A local stand in for umd.io. `routes` maps a path (eg "/courses") to a
+    function of the query params which returns `(status, json body)`.
+    """
+    def __init__(self, routes):
+        self.routes = routes
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                stub.requests.append((url.path, params))
+                (status, body) = stub.routes[url.path](params)
+                body = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def __enter__(self):
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def stub_courses(courses):
+    def route(params):
+        if params["page"] != "1":
+            return (200, [])
+        return (200, courses)
+    return route
+
+def stub_professors(professors_by_course):
+    def route(params):
+        professors = professors_by_course.get(params["course_id"])
+        if professors is None:
+            return (404, {"error_code": 404})
+        return (200, professors)
+    return route
+
+
+class UMDIOClientTest(SimpleTestCase):
+    def test_retries(self):
+        statuses = [503, 503]
+        def route(_params):
+            if statuses:
+                return (statuses.pop(), {})
+            return (200, ["ok"])
+
+        with StubUMDIOServer({"/professors": route}) as stub:
+            client = UMDIOClient(stub.url, backoff_factor=0)
+            self.assertEqual(client.professors("CMSC131"), ["ok"])
+            self.assertEqual(len(stub.requests), 3)
+
+    def test_cache(self):
+        routes = {"/professors": stub_professors({"CMSC131": ["a"]})}
+        with StubUMDIOServer(routes) as stub, \
+            tempfile.TemporaryDirectory() as cache_dir:
+            client = UMDIOClient(stub.url, cache_dir=cache_dir)
+            self.assertEqual(client.professors_many(["CMSC131", "CMSC132"]),
+                {"CMSC131": ["a"], "CMSC132": {"error_code": 404}})
+
+            # the successful response is served from disk, the error isn't
+            client = UMDIOClient(stub.url, cache_dir=cache_dir)
+            client.professors_many(["CMSC131", "CMSC132"])
+            self.assertEqual(len(stub.requests), 3)
+
+
+class UpdateCoursesTest(TestCase):
+    semester = "202108"
+
+    def setUp(self):
+        herman = Professor.unfiltered.create(name="Larry Herman",
+            slug="herman", type=Professor.Type.PROFESSOR,
+            status=Professor.Status.VERIFIED)
+        course = Course(department="CMSC", course_number="131")
+        course.save()
+        # should have its recent semester filled in
+        ProfessorCourse.objects.create(course=course, professor=herman)
+
+        courses = [
+            {"course_id": name, "dept_id": name[:4], "name": f"{name} title",
+                "credits": "3", "description": ""}
+            for name in ["CMSC131", "CMSC132"]
+        ]
+        taught = [
+            {"course_id": "CMSC131", "semester": self.semester},
+            {"course_id": "CMSC132", "semester": self.semester}
+        ]
+        professors = [
+            {"name": "Larry Herman", "taught": taught},
+            {"name": "Clyde Kruskal", "taught": taught}
+        ]
+        self.routes = {
+            "/courses": stub_courses(courses),
+            "/professors": stub_professors({
+                "CMSC131": professors,
+                "CMSC132": professors
+            })
+        }
+
+    def update_courses(self, *args):
+        # updatecourses reports progress with print
+        with StubUMDIOServer(self.routes) as stub, \
+            redirect_stdout(io.StringIO()) as stdout:
+            call_command("updatecourses", self.semester, *args,
+                base_url=stub.url)
+        return stdout.getvalue()
+
+    def professor_courses(self):
+        return set(
+            ProfessorCourse.objects.values_list("professor__name",
+                "course__name", "recent_semester")
+        )
+
+    def test_update(self):
+        self.update_courses()
+
+        self.assertEqual(
+            set(Course.unfiltered.values_list("name", flat=True)),
+            {"CMSC131", "CMSC132"}
+        )
+        kruskal = Professor.verified.get(name="Clyde Kruskal")
+        self.assertEqual(kruskal.slug, "kruskal")
+
+        semester = Semester(self.semester)
+        expected = {
+            ("Larry Herman", "CMSC131", semester),
+            ("Larry Herman", "CMSC132", semester),
+            ("Clyde Kruskal", "CMSC131", semester),
+            ("Clyde Kruskal", "CMSC132", semester)
+        }
+        self.assertEqual(self.professor_courses(), expected)
+
+        # running again shouldn't change anything
+        self.update_courses()
+        self.assertEqual(ProfessorCourse.objects.count(), 4)
+
+    def test_name_case(self):
+        # the database compares names case insensitively, so these are the
+        # existing course and professor rather than new ones
+        taught = [{"course_id": "cmsc131", "semester": self.semester}]
+        self.routes = {
+            "/courses": stub_courses([{"course_id": "cmsc131",
+                "dept_id": "CMSC", "name": "title", "credits": "3",
+                "description": ""}]),
+            "/professors": stub_professors({
+                "CMSC131": [{"name": "LARRY HERMAN", "taught": taught}]
+            })
+        }
+        self.update_courses()
+
+        self.assertEqual(Course.unfiltered.count(), 1)
+        self.assertEqual(Professor.unfiltered.count(), 1)
+        self.assertEqual(self.professor_courses(),
+            {("Larry Herman", "CMSC131", Semester(self.semester))})
+
+    def test_no_course_lookups(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.update_courses()
+        # professor courses share the preloaded courses rather than loading
+        # their course one at a time
+        lookups = [query["sql"] for query in queries if
+            query["sql"].startswith('SELECT "home_course"') and
+            '"home_course"."id" =' in query["sql"]]
+        self.assertEqual(lookups, [])
+
+    def test_dry_run(self):
+        before = self.professor_courses()
+        output = self.update_courses("--dry-run")
+
+        self.assertIn("+ course CMSC132", output)
+        self.assertIn("+ professor Clyde Kruskal", output)
+        self.assertEqual(Course.unfiltered.count(), 1)
+        self.assertFalse(Professor.unfiltered.filter(name="Clyde Kruskal")
+            .exists())
+        self.assertEqual(self.professor_courses(), before)
+
+
+class UpdateRecencyTest(TestCase):
+    def test_update_recency(self):
+        professor = Professor.unfiltered.create(name="Jane Doe", slug="doe",
+            type=Professor.Type.PROFESSOR, status=Professor.Status.VERIFIED)
+        # taught recently, but not marked recent
+        taught = Course.unfiltered.create(department="CMSC",
+            course_number="131")
+        ProfessorCourse.objects.create(course=taught, professor=professor,
+            recent_semester=Semester(202108))
+        # graded recently, but not marked recent
+        graded = Course.unfiltered.create(department="CMSC",
+            course_number="132")
+        create_grade(graded, professor, Semester(201908), "0101")
+        # only graded and taught long ago, but marked recent
+        old = Course.unfiltered.create(department="CMSC", course_number="100",
+            is_recent=True)
+        create_grade(old, professor, Semester(201008), "0101")
+        ProfessorCourse.objects.create(course=old, professor=professor,
+            recent_semester=Semester(201008))
+        # already correct
+        unchanged = Course.unfiltered.create(department="CMSC",
+            course_number="216", is_recent=True)
+        create_grade(unchanged, professor, Semester(202101), "0101")
+
+        self.assertEqual(Course.update_recency(), 3)
+        self.assertEqual(set(Course.recent.values_list("name", flat=True)),
+            {"CMSC131", "CMSC132", "CMSC216"})
+
+        # nothing left to change
+        with self.assertNumQueries(1):
+            self.assertEqual(Course.update_recency(), 0)
+
+        # only the passed courses are considered
+        Course.unfiltered.filter(pk__in=[taught.pk, old.pk]).update(
+            is_recent=False)
+        self.assertEqual(Course.update_recency([old.pk]), 0)
+        self.assertEqual(Course.update_recency([taught.pk]), 1)
+        self.assertTrue(Course.unfiltered.get(pk=taught.pk).is_recent)
+
+
+class ImportGradeDataTest(TestCase):
+    def setUp(self):
+        self.course = Course.unfiltered.create(department="CMSC",
+            course_number="131")
+        self.professor = Professor.unfiltered.create(name="Jane Doe",
+            slug="doe", type=Professor.Type.PROFESSOR,
+            status=Professor.Status.VERIFIED)
+        self.semester = Semester(202108)
+
+    def import_rows(self, rows):
+        with tempfile.TemporaryDirectory() as directory:
+            path = f"{directory}/grades.csv"
+            with open(path, "w", newline="") as f:
+                csv.writer(f).writerows(rows)
+
+            # rejected rows are written to the working directory
+            cwd = os.getcwd()
+            os.chdir(directory)
+            try:
+                with redirect_stdout(io.StringIO()):
+                    call_command("importgradedata", semester=self.semester,
+                        file=path, stdout=io.StringIO())
+                with open("rejected_imports.csv", newline="") as f:
+                    return list(csv.reader(f))
+            finally:
+                os.chdir(cwd)
+
+    def test_import(self):
+        counts = ["1"] * 15
+        rows = [
+            ["CMSC131", "0101", "Doe, Jane", "15", *counts],
+            ["CMSC131", "0102", "Doe, Jane", "15", *counts],
+            ["CMSC999", "0101", "Doe, Jane", "15", *counts],
+            # the database compares names case insensitively
+            ["cmsc131", "0103", "DOE, JANE", "15", *counts],
+            # similar to, but not exactly, an existing professor
+            ["CMSC131", "0201", "Doe, Janet", "15", *counts],
+            ["CMSC131", "0202", "Doe, Janet", "15", *counts],
+        ]
+        # split the rows across several chunks
+        with mock.patch("home.management.commands.importgradedata.Command."
+            "BATCH_SIZE", 2):
+            rejected = self.import_rows(rows)
+
+        self.assertEqual(rejected, [rows[2]])
+        grades = Grade.unfiltered.filter(semester=self.semester)
+        self.assertEqual(grades.count(), 5)
+        self.assertEqual(grades.filter(professor=self.professor).count(), 3)
+
+        # every ambiguous section gets its own pending professor
+        pending = Professor.unfiltered.filter(name="Janet Doe")
+        self.assertEqual(pending.count(), 2)
+        self.assertEqual(grades.filter(professor__in=pending).count(), 2)
+
+        rollup = CourseGradeRollup.unfiltered.get(course=self.course,
+            professor=self.professor)
+        self.assertEqual(rollup.num_students, 45)
+        self.course.refresh_from_db()
+        self.assertTrue(self.course.is_recent)
+
+
+class RefreshRollupsTest(TestCase):
+    def setUp(self):
+        self.course = Course.unfiltered.create(department="CMSC",
+            course_number="131")
+        self.professor = Professor.unfiltered.create(name="Jane Doe",
+            slug="doe", type=Professor.Type.PROFESSOR,
+            status=Professor.Status.VERIFIED)
+
+    def assert_rollups_match_grades(self, semester=None):
+        totals = {f"{field}_total": Sum(field) for field in
+            ["num_students", *GRADE_FIELDS]}
+        grades = Grade.unfiltered.all()
+        rollups = CourseGradeRollup.unfiltered.all()
+        if semester is not None:
+            grades = grades.filter(semester=semester)
+            rollups = rollups.filter(semester=semester)
+
+        expected = {
+            (value.pop("course"), value.pop("professor"),
+                value.pop("semester")): value
+            for value in
+            grades.values("course", "professor", "semester")
+                .annotate(**totals).order_by()
+        }
+        actual = {
+            (rollup.course_id, rollup.professor_id, rollup.semester): {
+                f"{field}_total": getattr(rollup, field)
+                for field in ["num_students", *GRADE_FIELDS]
+            }
+            for rollup in rollups
+        }
+        self.assertEqual(actual, expected)
+
+    def test_sums_sections(self):
+        semester = Semester(202108)
+        for (section, count) in [("0101", 10), ("0201", 5), ("0301", 1)]:
+            create_grade(self.course, self.professor, semester, section,
+                count=count)
+        refresh_rollups()
+
+        self.assert_rollups_match_grades()
+        rollup = CourseGradeRollup.unfiltered.get()
+        self.assertEqual(rollup.num_students, 16 * len(GRADE_FIELDS))
+        self.assertEqual(DepartmentGradeRollup.unfiltered.get().num_students,
+            16 * len(GRADE_FIELDS))
+
+    def test_refresh_semester(self):
+        semesters = [Semester(202101), Semester(202108)]
+        for semester in semesters:
+            create_grade(self.course, self.professor, semester, "0101")
+        refresh_rollups()
+        before = CourseGradeRollup.unfiltered.get(semester=semesters[1])
+
+        # `update` doesn't send signals, so nothing is refreshed until we ask
+        Grade.unfiltered.update(a=20, num_students=F("num_students") + 10)
+        refresh_rollups([semesters[0]])
+
+        self.assert_rollups_match_grades(semesters[0])
+        after = CourseGradeRollup.unfiltered.get(semester=semesters[1])
+        self.assertEqual((after.pk, after.a, after.num_students),
+            (before.pk, before.a, before.num_students))
+
+    def test_professor_merge(self):
+        semester = Semester(202108)
+        subject = Professor.unfiltered.create(name="J Doe", slug="j_doe",
+            type=Professor.Type.PROFESSOR, status=Professor.Status.PENDING)
+        create_grade(self.course, self.professor, semester, "0101")
+        create_grade(self.course, subject, semester, "0201", count=5)
+        refresh_rollups()
+
+        admin = User.objects.create_user("admin", is_staff=True)
+        self.client.force_login(admin)
+        response = self.client.post(reverse("admin"), {
+            "action_type": AdminAction.PROFESSOR_MERGE.value,
+            "subject_id": subject.pk,
+            "target_id": self.professor.pk
+        })
+        self.assertTrue(response.json()["success"])
+
+        self.assert_rollups_match_grades()
+        rollup = CourseGradeRollup.unfiltered.get()
+        self.assertEqual(rollup.professor, self.professor)
+        self.assertEqual(rollup.num_students, 15 * len(GRADE_FIELDS))
+
+
+class InvalidationTest(TestCase):
+    def test_recomputes_dependents(self):
+        cache = TTLCache(max_size=10, max_bytes=1024 * 1024)
+        calls = []
+        @ttl_cache(60, depends_on=lambda name:
+            [cache_tag("course", "name", name)])
+        def function(name):
+            calls.append(name)
+            return len(calls)
+
+        with mock.patch("home.utils._ttl_cache", cache):
+            self.assertEqual(function("CMSC131"), 1)
+            self.assertEqual(function("CMSC132"), 2)
+
+            with self.captureOnCommitCallbacks(execute=True):
+                Course(department="CMSC", course_number="131").save()
+            cache._executor.shutdown(wait=True)
+
+            # only the dependent value was recomputed, and it was recomputed
+            # eagerly rather than on the next call
+            self.assertEqual(calls, ["CMSC131", "CMSC132", "CMSC131"])
+            self.assertEqual(function("CMSC131"), 3)
+            self.assertEqual(function("CMSC132"), 2)
+
+    def test_refreshes_rollups_once_per_transaction(self):
+        course = Course.unfiltered.create(department="CMSC",
+            course_number="131")
+        professor = Professor.unfiltered.create(name="Jane Doe", slug="doe",
+            type=Professor.Type.PROFESSOR, status=Professor.Status.VERIFIED)
+        semesters = [Semester(202101), Semester(202108)]
+
+        with mock.patch("home.rollups.refresh_rollups") as refresh, \
+            self.captureOnCommitCallbacks(execute=True):
+            for semester in semesters:
+                for section in ["0101", "0201"]:
+                    create_grade(course, professor, semester, section)
+        refresh.assert_called_once()
+        self.assertCountEqual(refresh.call_args[0][0], semesters)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            create_grade(course, professor, semesters[0], "0301")
+        rollups = CourseGradeRollup.unfiltered.filter(course=course)
+        self.assertEqual(rollups.get(semester=semesters[0]).num_students,
+            3 * 10 * len(GRADE_FIELDS))
+
+    def test_forgets_rolled_back_rollups(self):
+        course = Course.unfiltered.create(department="CMSC",
+            course_number="131")
+        professor = Professor.unfiltered.create(name="Jane Doe", slug="doe",
+            type=Professor.Type.PROFESSOR, status=Professor.Status.VERIFIED)
+
+        with mock.patch("home.rollups.refresh_rollups") as refresh:
+            with self.assertRaises(DatabaseError):
+                with transaction.atomic():
+                    create_grade(course, professor, Semester(202101), "0101")
+                    raise DatabaseError()
+
+            with self.captureOnCommitCallbacks(execute=True):
+                create_grade(course, professor, Semester(202108), "0101")
+        refresh.assert_called_once_with([Semester(202108)])
+
+
+class ApiTestCase(TestCase):
+    def setUp(self):
+        # don't serve api responses cached by earlier tests
+        _response_cache.mark_stale()
+
+
+class ApiListQueryCountTest(ApiTestCase):
+    def add_rows(self, num):
+        start = Course.unfiltered.count()
+        semester = Semester(202108)
+        for i in range(start, start + num):
+            professor = Professor.unfiltered.create(name=f"Professor {i}",
+                slug=f"professor{i}", type=Professor.Type.PROFESSOR,
+                status=Professor.Status.VERIFIED)
+            course = Course(department="CMSC", course_number=f"{100 + i}",
+                is_recent=True)
+            course.save()
+            ProfessorCourse.objects.create(course=course, professor=professor,
+                recent_semester=semester)
+            create_grade(course, professor, semester, "0101")
+            Review.unfiltered.create(professor=professor, course=course,
+                content="review", rating=4, anonymous=True,
+                status=Review.Status.VERIFIED)
+        refresh_rollups()
+
+    def assertConstantQueries(self, url, num_queries):
+        self.add_rows(2)
+        # only count the view's own queries, not `HttpCacheMiddleware`'s
+        # (cached) data version, and don't let `cache_response` skip the view.
+        self.client.get(url)
+        _response_cache.mark_stale()
+        with self.assertNumQueries(num_queries):
+            self.client.get(url)
+
+        self.add_rows(20)
+        _response_cache.mark_stale()
+        with self.assertNumQueries(num_queries):
+            response = self.client.get(url)
+        self.assertEqual(len(response.json()), 22)
+
+    def test_courses(self):
+        self.assertConstantQueries(reverse("api-courses"), 2)
+
+    def test_courses_with_reviews(self):
+        self.assertConstantQueries(reverse("api-courses") + "?reviews=true", 3)
+
+    def test_professors(self):
+        self.assertConstantQueries(reverse("api-professors"), 2)
+
+    def test_professors_with_reviews(self):
+        self.assertConstantQueries(reverse("api-professors") + "?reviews=true",
+            3)
+
+    def test_batch(self):
+        courses = ",".join(f"CMSC{100 + i}" for i in range(22))
+        professors = ",".join(f"Professor {i}" for i in range(22))
+        self.assertConstantQueries(reverse("api-courses-batch") +
+            f"?names={courses}&reviews=true", 3)
+        self.assertConstantQueries(reverse("api-professors-batch") +
+            f"?names={professors}", 2)
+        self.assertConstantQueries(reverse("api-grades-batch") +
+            f"?courses={courses}", 2)
+
+        # batches return the same data as the single endpoints
+        data = self.client.get(reverse("api-courses-batch") +
+            "?names=CMSC101,CMSC999").json()
+        course = self.client.get(reverse("api-course") + "?name=CMSC101")
+        self.assertEqual(data, {"CMSC101": course.json(), "CMSC999": None})
+
+
+class ApiGradesTest(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        professor = Professor.unfiltered.create(name="Jane Doe", slug="doe",
+            type=Professor.Type.PROFESSOR, status=Professor.Status.VERIFIED)
+        course = Course(department="CMSC", course_number="131", is_recent=True)
+        course.save()
+        for semester in [Semester(201808), Semester(202108)]:
+            create_grade(course, professor, semester, "0101")
+            create_grade(course, None, semester, "0201", count=3)
+
+    def test_matches_serializer(self):
+        grades = Grade.recent.order_by("pk")
+        expected = JSONRenderer().render(
+            GradeSerializer(grades, many=True).data)
+
+        response = self.client.get(reverse("api-grades") + "?course=CMSC131")
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertEqual(response.content, expected)
+
+    def test_render_json(self):
+        data = [{"name": "café \u2028\u2029 \"\U0001f600\"", "count": 3,
+            "none": None, "list": [True, False]}]
+        expected = JSONRenderer().render(data)
+        self.assertEqual(render_json(data), expected)
+
+        # the fallback if orjson isn't installed
+        with mock.patch("api.utils.orjson", None):
+            self.assertEqual(render_json(data), expected)
+
+
+class ApiKeysetTest(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        # created out of order, so results are sorted by the query
+        for course_number in ["104", "100", "103", "101", "102"]:
+            Course(department="CMSC", course_number=course_number,
+                is_recent=True).save()
+        professors = [("Jane Doe", "doe_2"), ("Zed Zed", "zed"),
+            ("Jane Doe", "doe_1"), ("Adam Ant", "ant")]
+        for (name, slug) in professors:
+            Professor.unfiltered.create(name=name, slug=slug,
+                type=Professor.Type.PROFESSOR,
+                status=Professor.Status.VERIFIED)
+
+    def get(self, name, **params):
+        response = self.client.get(reverse(name), params)
+        if response.streaming:
+            content = b"".join(response.streaming_content)
+            return [json.loads(line) for line in content.splitlines()]
+        return response.json()
+
+    def test_bulk(self):
+        courses = self.get("api-courses", bulk="true")
+        self.assertEqual([course["name"] for course in courses],
+            ["CMSC100", "CMSC101", "CMSC102", "CMSC103", "CMSC104"])
+        courses = self.get("api-courses", bulk="true", after="CMSC102")
+        self.assertEqual([course["name"] for course in courses],
+            ["CMSC103", "CMSC104"])
+
+    def test_after(self):
+        courses = self.get("api-courses", limit=2, after="CMSC101")
+        self.assertEqual([course["name"] for course in courses],
+            ["CMSC102", "CMSC103"])
+
+        response = self.client.get(reverse("api-courses"),
+            {"after": "CMSC101", "offset": 1})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(reverse("api-professors"),
+            {"after": "doe_1", "offset": 1})
+        self.assertEqual(response.status_code, 400)
+
+    def test_professor_ties(self):
+        # professors with the same name are ordered by slug
+        professors = self.get("api-professors", bulk="true")
+        self.assertEqual([professor["slug"] for professor in professors],
+            ["ant", "doe_1", "doe_2", "zed"])
+
+        professors = self.get("api-professors", limit=2, after="doe_1")
+        self.assertEqual([professor["slug"] for professor in professors],
+            ["doe_2", "zed"])
+        professors = self.get("api-professors", bulk="true", after="doe_2")
+        self.assertEqual([professor["slug"] for professor in professors],
+            ["zed"])
+
+    def test_chunks(self):
+        courses = CourseSerializer.prefetch(Course.recent.all())
+        names = sorted(courses.values_list("name", flat=True))
+        def stream(chunk_size, values=None):
+            response = stream_ndjson(courses, CourseSerializer, ["name"],
+                values=values, chunk_size=chunk_size)
+            with CaptureQueriesContext(connection) as queries:
+                lines = b"".join(response.streaming_content).splitlines()
+            num_chunks = sum(query["sql"].startswith('SELECT "home_course"')
+                for query in queries)
+            return ([json.loads(line)["name"] for line in lines], num_chunks)
+
+        # a partial last chunk is known to be the last, but a full one needs
+        # another query to find out
+        for (chunk_size, num_chunks) in [(2, 3), (5, 2), (1, 6), (10, 1)]:
+            self.assertEqual(stream(chunk_size), (names, num_chunks))
+
+        self.assertEqual(stream(1, values=["CMSC103"]), (["CMSC104"], 2))
+
+
+class HttpCacheTest(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        course = Course(department="CMSC", course_number="131", is_recent=True)
+        course.save()
+
+    def test_not_modified(self):
+        url = reverse("api-courses")
+        response = self.client.get(url)
+        etag = response["ETag"]
+        self.assertIn("max-age", response["Cache-Control"])
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["Access-Control-Allow-Origin"], "*")
+
+        response = self.client.get(url + "?limit=1", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_edits(self):
+        professor = Professor.unfiltered.create(name="Jane Doe", slug="doe",
+            type=Professor.Type.PROFESSOR, status=Professor.Status.VERIFIED)
+        course = Course.unfiltered.get()
+        review = Review.unfiltered.create(professor=professor, course=course,
+            content="Great", rating=5, anonymous=False)
+        professor_course = ProfessorCourse.objects.create(course=course,
+            professor=professor)
+        grade = create_grade(course, professor, Semester(202108), "0101")
+
+        def verify_review():
+            review.status = Review.Status.VERIFIED
+            review.save()
+        def correct_grade():
+            grade.a += 1
+            grade.save()
+        def update_recent_semester():
+            professor_course.recent_semester = Semester(202108)
+            professor_course.save()
+
+        edits = [("api-courses", verify_review), ("api-grades", correct_grade),
+            ("api-professors", update_recent_semester)]
+        # skip the ttl cache, which is only invalidated on commit
+        with mock.patch.object(http_cache, "data_version",
+            http_cache.data_version.__wrapped__):
+            for (name, edit) in edits:
+                url = reverse(name) + "?course=CMSC131"
+                etag = self.client.get(url)["ETag"]
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 304)
+
+                edit()
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 200)
+                self.assertNotEqual(response["ETag"], etag)
+
+    def test_data_version(self):
+        # skip the ttl cache, which is only invalidated on commit
+        data_version = http_cache.data_version.__wrapped__
+        before = data_version("home.Course", "home.Professor")
+
+        course = Course.unfiltered.get()
+        course.title = "Object-Oriented Programming I"
+        course.save()
+        self.assertNotEqual(data_version("home.Course", "home.Professor"),
+            before)
+
+
+class ResponseCacheTest(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        course = Course(department="CMSC", course_number="131", is_recent=True)
+        course.save()
+        professor = Professor.unfiltered.create(name="Jane Doe", slug="doe",
+            type=Professor.Type.PROFESSOR, status=Professor.Status.VERIFIED)
+        Review.unfiltered.create(professor=professor, course=course,
+            content="review", rating=4, anonymous=True,
+            status=Review.Status.VERIFIED)
+
+    def get_reviews(self, url):
+        return self.client.get(url).json()["reviews"]
+
+    def test_cached(self):
+        url = reverse("api-course") + "?name=CMSC131&reviews=true"
+        response = self.client.get(url)
+
+        # parameter order and unknown parameters don't matter
+        with self.assertNumQueries(0):
+            cached = self.client.get(reverse("api-course") +
+                "?reviews=true&name=CMSC131&unused=2")
+        self.assertEqual(cached.content, response.content)
+
+    def test_invalidation(self):
+        url = reverse("api-course") + "?name=CMSC131&reviews=true"
+        self.assertEqual(len(self.get_reviews(url)), 1)
+
+        Review.unfiltered.create(professor=Professor.verified.get(),
+            course=Course.unfiltered.get(), content="another review",
+            rating=2, anonymous=True, status=Review.Status.VERIFIED)
+        # still cached, since signals only invalidate on commit
+        self.assertEqual(len(self.get_reviews(url)), 1)
+
+        invalidate_ttl_cache([cache_tag("review", "course", "CMSC131")])
+        self.assertEqual(len(self.get_reviews(url)), 2)
+
+    def test_local_max_age(self):
+        url = reverse("api-course") + "?name=CMSC131&reviews=true"
+        with mock.patch("time.time") as time_:
+            time_.return_value = 1000 * CACHE_MAX_AGE
+            self.assertEqual(len(self.get_reviews(url)), 1)
+            Review.unfiltered.create(professor=Professor.verified.get(),
+                course=Course.unfiltered.get(), content="another review",
+                rating=2, anonymous=True, status=Review.Status.VERIFIED)
+
+            # a shared cache is invalidated by every worker, so its responses
+            # are kept for longer...
+            time_.return_value += LOCAL_MAX_AGE
+            with mock.patch.object(_response_cache, "shared", True):
+                self.assertEqual(len(self.get_reviews(url)), 1)
+            # ...than those in this process's cache, which other workers'
+            # changes don't invalidate
+            self.assertEqual(len(self.get_reviews(url)), 2)
+
+
+class GenedDataTest(TestCase):
+    def setUp(self):
+        for (number, geneds) in [("131", ["FSAW", "DSHS"]), ("132", ["FSAW"]),
+            ("216", ["DSHS", "FSAW", "SCIS"])]:
+            course = Course(department="CMSC", course_number=number,
+                title=f"Course {number}", credits=3, is_recent=True)
+            course.save()
+            for gened in geneds:
+                Gened.objects.create(course=course, name=gened)
+        create_grade(Course.unfiltered.get(name="CMSC131"), None,
+            Semester(202108), "0101")
+
+    def gened_data(self, geneds):
+        geneds = "&".join(f"{gened}=on" for gened in geneds)
+        response = self.client.get(reverse("gened-data"), {"geneds": geneds})
+        return response.json()["data"]
+
+    def test_intersection(self):
+        refresh_rollups()
+        data = self.gened_data(["DSHS", "FSAW"])
+        self.assertEqual([row[1] for row in data], ["Course 131", "Course 216"])
+        self.assertEqual(data[0][3:], ["2.12", "FSAW, DSHS"])
+        self.assertEqual(data[1][3:], ["No grade data available",
+            "DSHS, FSAW, SCIS"])
+
+        with self.assertNumQueries(0):
+            data = self.gened_data(["SCIS", "FSAW"])
+        self.assertEqual([row[1] for row in data], ["Course 216"])
+        self.assertEqual(self.gened_data(["DVUP"]), [])
+
+
+class CourseDifficultyTest(TestCase):
+    def test_matches_summaries(self):
+        semester = Semester(202108)
+        for (i, department) in enumerate(["CMSC", "CMSC", "MATH"]):
+            course = Course(department=department, course_number=f"{100 + i}",
+                is_recent=True)
+            course.save()
+            create_grade(course, None, semester, "0101", count=i + 1)
+            create_grade(course, None, semester, "0201", count=i * 3)
+        refresh_rollups()
+
+        tables = CourseDifficultyData.difficulty_table.__wrapped__()
+        for (key, rollups, field) in [
+            ("courses", CourseGradeRollup, "course__name"),
+            ("departments", DepartmentGradeRollup, "department")
+        ]:
+            summaries = rollups.recent.exclude_pf().summary_by(field)
+            self.assertEqual([row[0] for row in tables[key]], list(summaries))
+            for (name, num_students, average_gpa) in tables[key]:
+                summary = summaries[name]
+                self.assertEqual(num_students, summary["num_students"])
+                self.assertAlmostEqual(average_gpa, summary["average_gpa"])
+
+
+class GradeInflationTest(TestCase):
+    def setUp(self):
+        for (i, department) in enumerate(["CMSC", "CMSC", "MATH"]):
+            course = Course(department=department, course_number=f"{100 + i}",
+                is_recent=True)
+            course.save()
+            for (j, semester) in enumerate([Semester(201908),
+                Semester(202001), Semester(202108)]):
+                create_grade(course, None, semester, "0101", count=i + j + 1)
+
+        # vary gpas between semesters and departments
+        totals = dict.fromkeys(GRADE_FIELDS, 0)
+        totals["f"] = 20
+        Grade.unfiltered.create(course=course, professor=None,
+            semester=Semester(202001), section="0201", num_students=20,
+            **totals)
+        refresh_rollups()
+
+    def series(self, search):
+        response = self.client.post(reverse("tools-grade-inflation"),
+            {"search": search})
+        return response.json()
+
+    def expected(self, grades):
+        summaries = grades.summary_by("semester")
+        return [
+            [semester.name(short=True, year_first=True)
+                for semester in summaries],
+            [f"{summary['average_gpa']:0.2f}"
+                for summary in summaries.values()]
+        ]
+
+    def test_series(self):
+        rollups = DepartmentGradeRollup.unfiltered.all()
+        self.assertEqual(self.series(""), self.expected(rollups))
+        self.assertEqual(self.series("CMSC"),
+            self.expected(rollups.filter(department="CMSC")))
+        self.assertEqual(self.series("ENGL"), [[], []])
+
+        course = Course.unfiltered.get(name="CMSC101")
+        self.assertEqual(self.series("CMSC101"),
+            self.expected(course.coursegraderollup_set.all()))
+
+
+class StatisticsTest(TestCase):
+    def test_graph_data(self):
+        professors = [Professor.unfiltered.create(name=f"Professor {i}",
+            slug=f"professor{i}", type=Professor.Type.PROFESSOR,
+            status=Professor.Status.VERIFIED) for i in range(2)]
+        for (professor, rating, status) in [
+            (professors[0], 5, Review.Status.VERIFIED),
+            (professors[0], 2, Review.Status.VERIFIED),
+            (professors[1], 4, Review.Status.VERIFIED),
+            (professors[1], 1, Review.Status.PENDING)
+        ]:
+            Review.unfiltered.create(professor=professor, content="review",
+                rating=rating, anonymous=True, status=status)
+
+        (review_ratings, review_dates, professor_ratings) = (
+            ToolStatistics.graph_data.__wrapped__())
+        self.assertEqual(review_ratings, [0, 1, 0, 1, 1])
+
+        week = Review.verified.first().created_at.isocalendar()[1]
+        self.assertEqual(review_dates[week - 1], 3)
+        self.assertEqual(sum(review_dates), 3)
+
+        # averages of 3.5 and 4
+        expected = [0] * 41
+        expected[25] = 1
+        expected[30] = 1
+        self.assertEqual(professor_ratings, expected)
+
+
+class PopularCoursesTest(TestCase):
+    def test_matches_icontains(self):
+        semester = Semester(202108)
+        for (i, name) in enumerate(["CMSC131", "CMSC132", "CMSC216", "AMSC460",
+            "MATH131", "MATH140"]):
+            course = Course(department=name[:4], course_number=name[4:],
+                is_recent=True)
+            course.save()
+            create_grade(course, None, semester, "0101", count=i + 1)
+        refresh_rollups()
+
+        for query in ["cmsc", "CMSC13", "msc", "131", "MATH140", "ENGL"]:
+            values = (
+                CourseGradeRollup.recent
+                .filter(course__name__icontains=query)
+                .values_list("course__name")
+                .annotate(num_students=Sum("num_students"))
+            )
+            self.assertCountEqual(ToolPopularCourses.matching_courses(query),
+                values)
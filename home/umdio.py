@@ -0,0 +1,111 @@
+# A small client for the parts of the umd.io api (https://beta.umd.io/) used by
+# `updatecourses`.
+#
+# Requests go through one pooled `requests.Session`, so we're not opening a new
+# connection for every course, and transient failures (timeouts, 429s, 5xxs)
+# are retried with exponential backoff. Per-course professor lookups, which
+# are most of the requests, are fanned out over a bounded thread pool.
+#
+# If `cache_dir` is passed, successful responses are stored on disk and reused
+# by later runs, so rerunning `updatecourses` after a failure only fetches what
+# it didn't get the first time. Pass `refresh=True` to ignore (but still
+# overwrite) what's cached.
+#
+# The base url is configurable so the client can be pointed at a local stub
+# server in tests.
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import hashlib
+import json
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_BASE_URL = "https://api.umd.io/v1"
+
+def is_error(data):
+    # umd.io reports errors (including "no results") as a json object with an
+    # error code, instead of a list
+    return isinstance(data, dict) and "error_code" in data
+
+class UMDIOClient:
+    def __init__(self, base_url=DEFAULT_BASE_URL, *, cache_dir=None,
+        refresh=False, max_workers=8, retries=5, backoff_factor=0.5,
+        timeout=30):
+        self.base_url = base_url.rstrip("/")
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.refresh = refresh
+        self.max_workers = max_workers
+        self.timeout = timeout
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET"],
+            # hand back the last response instead of raising, so we can report
+            # the status code ourselves
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=1,
+            pool_maxsize=max_workers)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def _cache_path(self, path, params):
+        key = json.dumps([path, sorted(params.items())])
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return self.cache_dir / f"{digest}.json"
+
+    def get(self, path, params):
+        cache_path = self._cache_path(path, params) if self.cache_dir else None
+        if cache_path and not self.refresh and cache_path.exists():
+            return json.loads(cache_path.read_text())
+
+        response = self.session.get(f"{self.base_url}/{path}", params=params,
+            timeout=self.timeout)
+        # umd.io returns a 404 (with a json error body) for queries with no
+        # results, which we want to pass through to the caller.
+        if response.status_code >= 500:
+            response.raise_for_status()
+        data = response.json()
+
+        if cache_path and response.ok:
+            # write then rename, so an interrupted run can't leave a truncated
+            # file behind
+            tmp_path = cache_path.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(data))
+            tmp_path.replace(cache_path)
+        return data
+
+    def course_pages(self, semester, per_page=100):
+        """
+        Yields every course offered in `semester`, one page (list) at a time.
+        """
+        page = 1
+        while True:
+            params = {"semester": str(semester), "per_page": per_page,
+                "page": page}
+            courses = self.get("courses", params)
+            if not courses or is_error(courses):
+                return
+            yield courses
+            page += 1
+
+    def professors(self, course_name):
+        return self.get("professors", {"course_id": course_name})
+
+    def professors_many(self, course_names):
+        """
+        A dict of course name to `professors(course_name)` for each of
+        `course_names`, fetched concurrently by up to `max_workers` threads.
+        """
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            results = executor.map(self.professors, course_names)
+            return dict(zip(course_names, results))
@@ -1,12 +1,20 @@
+from abc import ABC, abstractmethod
 from enum import Enum, auto
 from functools import wraps, total_ordering
 import time
 import base64
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from threading import Thread
+from threading import Thread, Lock
 from datetime import datetime
-
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from bisect import bisect_left, insort
+import sys
+import hashlib
+import logging
+
+from django.db import connection, close_old_connections
 from django.urls import reverse
 from django.template.defaultfilters import pluralize
 
@@ -14,10 +22,13 @@ from discord_webhook import DiscordWebhook
 from discord_webhook.webhook import DiscordEmbed
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+from Levenshtein import ratio
 
 from planetterp.config import (WEBHOOK_URL_UPDATE, EMAIL_HOST_USER,
     EMAIL_SERVICE_ACCOUNT_CREDENTIALS, WEBHOOK_FREQUENCY)
 
+logger = logging.getLogger(__name__)
+
 @total_ordering
 class Semester:
     SPRING = 1
@@ -126,6 +137,66 @@ class ReviewsTableColumn(Enum):
     STATUS = auto()
     ACTION = auto()
 
+class SimilarNameIndex:
+    """
+    Finds the names which are similar to a name by `fuzz.ratio`, with the same
+    results as comparing against every name, but without actually doing so.
+
+    `fuzz.ratio(a, b)` is `2 * lcs(a, b) / (len(a) + len(b))` (scaled to 0-100
+    and rounded), and the longest common subsequence of two strings can't be
+    longer than the shorter string. So only names whose length is close enough
+    to the query's can possibly be similar enough. Names are kept sorted by
+    length and we only score that window, using `Levenshtein.ratio` directly
+    (which is what `fuzz.ratio` calls) to skip fuzzywuzzy's wrapper overhead.
+    """
+    def __init__(self, items=()):
+        # sorted list of (len(name), insertion order, name, value). Insertion
+        # orders are unique, so sorting never has to compare values.
+        self._entries = sorted((len(name), order, name, value)
+            for (order, (name, value)) in enumerate(items))
+        self._count = len(self._entries)
+
+    def add(self, name, value):
+        insort(self._entries, (len(name), self._count, name, value))
+        self._count += 1
+
+    @staticmethod
+    def _max_ratio(length1, length2):
+        if length1 + length2 == 0:
+            return 100
+        return round(100 * 2 * min(length1, length2) / (length1 + length2))
+
+    def find_similar(self, name, tolerance):
+        """
+        The value of every name with a `fuzz.ratio` to `name` greater than
+        `tolerance`, most similar first. Ties are in insertion order.
+        """
+        if not self._entries:
+            return []
+
+        length = len(name)
+        longest = self._entries[-1][0]
+        min_length = length
+        while min_length > 0 and self._max_ratio(length, min_length - 1) > tolerance:
+            min_length -= 1
+        max_length = length
+        while max_length < longest and self._max_ratio(length, max_length + 1) > tolerance:
+            max_length += 1
+
+        lo = bisect_left(self._entries, (min_length,))
+        hi = bisect_left(self._entries, (max_length + 1,), lo)
+
+        similar = []
+        for (_length, order, other_name, value) in self._entries[lo:hi]:
+            # identical to fuzzywuzzy's rounding, so we agree with `fuzz.ratio`
+            # exactly
+            similarity = int(round(100 * ratio(name, other_name)))
+            if similarity > tolerance:
+                similar.append((-similarity, order, value))
+
+        similar.sort(key=lambda e: e[:2])
+        return [value for (_similarity, _order, value) in similar]
+
 # We're going to handroll our own ttl cache instead of using python's
 # `lru_cache` with a time salt (which was the original implementation), for two
 # reasons:
@@ -137,11 +208,470 @@ class ReviewsTableColumn(Enum):
 # * we want to be able to force update values, even if the ttl hasn't expired
 #   yet. This is useful for scenarios where we eg add new grades and want to
 #   update all grade graphs immediately.
-# XXX: as we've handrolled our own (unbounded) cache implementation, this has
-# the potential to cause memory leaks. Investigate this first if memory leaks
-# arise in the future.
-_ttl_cache = {}
-def ttl_cache(max_age):
+class TTLCacheBackend(ABC):
+    """
+    Base class for the storage behind `ttl_cache`. Subclasses decide where
+    values live by implementing `_get_entry`, `_set_entry`, `_generations`,
+    `_bump`, and `items`.
+
+    Every value depends on a set of tags (see `ttl_cache`'s `depends_on`), and
+    every tag has a generation counter. A value is stored alongside the
+    generations of its tags at the time it was computed, and is stale once any
+    of those tags has been bumped since. Generations are captured *before*
+    computing a value, so an invalidation that lands mid-computation isn't
+    lost.
+
+    This class also provides hit and miss counters, and per-key deduplication
+    of computations. Concurrent callers that miss the same key wait for a
+    single computation, and recomputations run on a small shared thread pool,
+    so a popular stale key triggers exactly one recomputation no matter how
+    many requests hit it at once.
+    """
+    # every value depends on this tag, so bumping it marks everything stale.
+    ALL = "*"
+    # whether values and invalidations are shared with other processes.
+    shared = False
+    # how many keys to remember how to recompute, for `invalidate`.
+    MAX_REGISTERED_KEYS = 5000
+
+    def __init__(self, *, max_workers=4):
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = Lock()
+        # keys which are currently being computed, and the future which
+        # callers wait on until that computation finishes.
+        self._computing = {}
+        self._recomputing = set()
+        # key -> (tags, max_age, function), so `invalidate` can eagerly
+        # recompute keys.
+        self._registry = OrderedDict()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+            thread_name_prefix="ttl_cache")
+
+    @abstractmethod
+    def _get_entry(self, key, tags):
+        """
+        Returns `((time_salt, generations, value), current_generations)` for
+        `key`, where `current_generations` are the current generations of
+        `tags`, or `(None, current_generations)` if `key` is not cached. Must
+        not affect the hit and miss counters.
+        """
+        pass
+
+    @abstractmethod
+    def _set_entry(self, key, time_salt, generations, value):
+        pass
+
+    @abstractmethod
+    def _generations(self, tags):
+        """
+        The current generation of each of `tags`, as a dict.
+        """
+        pass
+
+    @abstractmethod
+    def _bump(self, tags):
+        pass
+
+    @abstractmethod
+    def items(self):
+        """
+        A snapshot of `(key, (time_salt, value))` for cached values.
+        """
+        pass
+
+    def _get(self, key, tags):
+        (entry, current_generations) = self._get_entry(key, tags)
+        if entry is None:
+            return None
+
+        (time_salt, generations, value) = entry
+        if generations != current_generations:
+            time_salt = 0
+        return (time_salt, value)
+
+    def get(self, key, tags):
+        """
+        Returns `(time_salt, value)` for `key`, or `None` if `key` is not
+        cached. Values which are stale because one of `tags` has been bumped
+        since they were computed are returned with a time salt of 0.
+        """
+        entry = self._get(key, tags)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry
+
+    def compute(self, key, tags, max_age, function, *, register=True):
+        """
+        Computes and caches `function()` under `key`, unless another thread is
+        already doing so, in which case we wait for and return its result
+        instead.
+
+        If `register` is false, `invalidate` only marks the value as stale
+        instead of recomputing it in the background.
+        """
+        time_salt = time.time() // max_age
+        if register:
+            self._register(key, tags, max_age, function)
+
+        # the first caller to miss `key` computes it, and every caller that
+        # misses it in the meantime waits on the same future. The future is
+        # only forgotten once its result is set, so there's no window where a
+        # new caller could start a second computation.
+        with self._lock:
+            future = self._computing.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._computing[key] = future
+
+        if not owner:
+            return future.result()
+
+        try:
+            entry = self._get(key, tags)
+            if entry is not None and entry[0] >= time_salt:
+                value = entry[1]
+            else:
+                generations = self._generations(tags)
+                value = function()
+                self._set_entry(key, time_salt, generations, value)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(value)
+            return value
+        finally:
+            with self._lock:
+                self._computing.pop(key, None)
+
+    def recompute(self, key, tags, max_age, function):
+        """
+        Schedules `function` to be recomputed in the background under `key`.
+        Does nothing if a recomputation of `key` is already scheduled.
+        """
+        with self._lock:
+            if key in self._recomputing:
+                return
+            self._recomputing.add(key)
+
+        def recompute():
+            # our worker threads live as long as the process, so make sure
+            # they don't reuse a connection the database has since closed.
+            close_old_connections()
+            try:
+                self.compute(key, tags, max_age, function)
+            except Exception:
+                # the executor would otherwise swallow this, and we'd keep
+                # serving the stale value without anyone noticing.
+                logger.exception(f"Failed to recompute {key!r}")
+            finally:
+                with self._lock:
+                    self._recomputing.discard(key)
+                connection.close()
+
+        self._executor.submit(recompute)
+
+    def invalidate(self, tags):
+        """
+        Marks every value which depends on any of `tags` as stale, and
+        immediately recomputes those values in the background, at least for
+        the keys this process knows how to recompute.
+        """
+        tags = set(tags)
+        self._bump(tags)
+
+        with self._lock:
+            affected = [(key, registration)
+                for key, registration in self._registry.items()
+                if tags.intersection(registration[0])]
+
+        for key, (key_tags, max_age, function) in affected:
+            self.recompute(key, key_tags, max_age, function)
+
+    def mark_stale(self):
+        """
+        Marks every cached value as stale, so it will be recomputed the next
+        time it's accessed.
+        """
+        self._bump([self.ALL])
+
+    def _register(self, key, tags, max_age, function):
+        with self._lock:
+            self._registry[key] = (tags, max_age, function)
+            self._registry.move_to_end(key)
+            if len(self._registry) > self.MAX_REGISTERED_KEYS:
+                self._registry.popitem(last=False)
+
+    def _forget(self, key):
+        # callers must hold `self._lock`
+        self._registry.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+class TTLCache(TTLCacheBackend):
+    """
+    Stores values in this process's memory. Holds at most `max_size` entries
+    and (approximately) `max_bytes` bytes of values, evicting the least
+    recently used entries first once either limit is exceeded.
+    """
+    def __init__(self, max_size, max_bytes, **kwargs):
+        super().__init__(**kwargs)
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self.num_bytes = 0
+
+        # key -> (time_salt, generations, value, num_bytes), in least to most
+        # recently used order.
+        self._entries = OrderedDict()
+        self._tag_generations = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get_entry(self, key, tags):
+        with self._lock:
+            current_generations = self._current_generations(tags)
+            entry = self._entries.get(key)
+            if entry is None:
+                return (None, current_generations)
+            self._entries.move_to_end(key)
+            return (entry[:3], current_generations)
+
+    def _current_generations(self, tags):
+        # callers must hold `self._lock`
+        return {tag: self._tag_generations.get(tag, 0) for tag in tags}
+
+    def _generations(self, tags):
+        with self._lock:
+            return self._current_generations(tags)
+
+    def _bump(self, tags):
+        with self._lock:
+            for tag in tags:
+                self._tag_generations[tag] = (
+                    self._tag_generations.get(tag, 0) + 1)
+
+    def _set_entry(self, key, time_salt, generations, value):
+        num_bytes = _approximate_size(value)
+        with self._lock:
+            if key in self._entries:
+                self.num_bytes -= self._entries.pop(key)[3]
+            self._entries[key] = (time_salt, generations, value, num_bytes)
+            self.num_bytes += num_bytes
+
+            while (len(self._entries) > self.max_size or
+                self.num_bytes > self.max_bytes):
+                # never evict the value we just set, even if it alone is
+                # larger than `max_bytes`.
+                if len(self._entries) == 1:
+                    break
+                (evicted_key, entry) = self._entries.popitem(last=False)
+                self._forget(evicted_key)
+                self.num_bytes -= entry[3]
+                self.evictions += 1
+
+    def items(self):
+        with self._lock:
+            items = []
+            for key, (time_salt, generations, value, _) in self._entries.items():
+                if generations != self._current_generations(generations):
+                    time_salt = 0
+                items.append((key, (time_salt, value)))
+            return items
+
+    def stats(self):
+        stats = super().stats()
+        with self._lock:
+            stats.update({
+                "entries": len(self._entries),
+                "bytes": self.num_bytes,
+                "evictions": self.evictions
+            })
+        return stats
+
+class DjangoTTLCache(TTLCacheBackend):
+    """
+    Stores values in one of django's configured caches (see the `CACHES`
+    setting), so they're shared between every worker process using that cache.
+    Any of django's cache backends will do: memcached, redis, the database
+    cache, or the file based cache for a single machine.
+
+    Values are pickled by django's cache framework, and tag generations live
+    in the shared cache as well, so an invalidation from one worker reaches
+    every worker.
+    """
+    shared = True
+
+    def __init__(self, alias="default", **kwargs):
+        super().__init__(**kwargs)
+        self.alias = alias
+
+    @property
+    def _cache(self):
+        # avoid accessing the cache at import time
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    @staticmethod
+    def _cache_key(key):
+        # keys need to be strings which are identical across processes, and
+        # memcached limits keys to 250 characters.
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return f"ttl_cache:{digest}"
+
+    def _tag_key(self, tag):
+        return self._cache_key(("tag", tag))
+
+    def _get_entry(self, key, tags):
+        # fetch the value and its tags' generations in a single round trip.
+        # A missing generation (eg evicted by memcached) is reported as `None`,
+        # which never matches a stored generation, so the entry is stale.
+        cache_key = self._cache_key(key)
+        tag_keys = {self._tag_key(tag): tag for tag in tags}
+        values = self._cache.get_many([cache_key, *tag_keys])
+
+        current_generations = {tag: values.get(tag_key)
+            for tag_key, tag in tag_keys.items()}
+        return (values.get(cache_key), current_generations)
+
+    def _generations(self, tags):
+        cache = self._cache
+        tag_keys = {self._tag_key(tag): tag for tag in tags}
+        values = cache.get_many(list(tag_keys))
+        missing = [tag_key for tag_key in tag_keys if tag_key not in values]
+        for tag_key in missing:
+            self._seed(tag_key)
+        if missing:
+            values.update(cache.get_many(missing))
+        return {tag: values.get(tag_key)
+            for tag_key, tag in tag_keys.items()}
+
+    def _seed(self, tag_key):
+        # if a counter is evicted and we restarted it from 0, it would
+        # eventually count back up through generations that old entries were
+        # stored with, and those entries would look fresh again. Starting from
+        # the current time instead means a restarted counter never revisits an
+        # old generation. `add` only sets the key if it doesn't already exist,
+        # so we don't race with another worker seeding the counter.
+        self._cache.add(tag_key, time.time_ns(), timeout=None)
+
+    def _bump(self, tags):
+        cache = self._cache
+        for tag in tags:
+            tag_key = self._tag_key(tag)
+            self._seed(tag_key)
+            try:
+                cache.incr(tag_key)
+            except ValueError:
+                # evicted between `add` and `incr`
+                self._seed(tag_key)
+
+    def _set_entry(self, key, time_salt, generations, value):
+        entry = (time_salt, generations, value)
+        self._cache.set(self._cache_key(key), entry, timeout=None)
+
+    def items(self):
+        # django's cache api has no way to list keys, so we can only list the
+        # keys this process has computed recently.
+        with self._lock:
+            registry = list(self._registry.items())
+        items = []
+        for key, (tags, _max_age, _function) in registry:
+            entry = self._get(key, tags)
+            if entry is not None:
+                items.append((key, entry))
+        return items
+
+def _approximate_size(value, seen=None):
+    """
+    A rough estimate of the memory used by `value`, including anything it
+    contains. `sys.getsizeof` on its own only counts the outermost container.
+    """
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_approximate_size(k, seen) + _approximate_size(v, seen)
+            for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(_approximate_size(v, seen) for v in value)
+    return size
+
+def _make_ttl_cache(*, max_size, max_bytes):
+    from django.conf import settings
+
+    backend = getattr(settings, "TTL_CACHE_BACKEND", "local")
+    if backend == "local":
+        return TTLCache(max_size=max_size, max_bytes=max_bytes)
+    if backend == "django":
+        return DjangoTTLCache(getattr(settings, "TTL_CACHE_ALIAS", "default"))
+    raise ValueError(f"Unknown TTL_CACHE_BACKEND {backend}")
+
+_ttl_cache = _make_ttl_cache(max_size=5000, max_bytes=256 * 1024 * 1024)
+# rendered api responses (see `api.utils.cache_response`). Kept separate from
+# `_ttl_cache` so that a burst of distinct api requests can't evict the values
+# our own pages depend on.
+_response_cache = _make_ttl_cache(max_size=5000, max_bytes=64 * 1024 * 1024)
+
+class ResponseCacheMetrics:
+    """
+    Hit ratio and latency of `api.utils.cache_response`d views, for the admin
+    page.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.hit_seconds = 0
+        self.miss_seconds = 0
+
+    def record(self, hit, seconds):
+        with self._lock:
+            if hit:
+                self.hits += 1
+                self.hit_seconds += seconds
+            else:
+                self.misses += 1
+                self.miss_seconds += seconds
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            stats = {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / requests if requests else 0,
+                "hit_ms": (self.hit_seconds / self.hits * 1000 if self.hits
+                    else 0),
+                "miss_ms": (self.miss_seconds / self.misses * 1000 if
+                    self.misses else 0)
+            }
+        # entries, bytes, and evictions, for the local backend
+        storage = _response_cache.stats()
+        for name in ["entries", "bytes", "evictions"]:
+            if name in storage:
+                stats[name] = storage[name]
+        return stats
+
+response_cache_metrics = ResponseCacheMetrics()
+
+def ttl_cache(max_age, *, depends_on=()):
     """
     An @cache, but instead of caching indefinitely, only caches for `max_age`
     seconds.
@@ -154,6 +684,16 @@ def ttl_cache(max_age):
     that the user which triggers the recomputation will not experience a delay,
     but *will* update the value for the next users.
 
+    `depends_on` declares what data the cached value is computed from, as a
+    list of tags (see `home.signals` for the tags that model changes emit), or
+    as a function which takes the same arguments as the decorated function and
+    returns such a list. When any of those tags is invalidated, the cached
+    value is recomputed immediately, even if `max_age` hasn't passed yet.
+
+    Values are stored in `_ttl_cache`. By default this is a bounded in-process
+    cache, but setting `TTL_CACHE_BACKEND = "django"` stores values in django's
+    cache framework instead, so they're shared across worker processes.
+
     Warnings
     --------
     This function does not actually guarantee that the result will be cached for
@@ -167,26 +707,24 @@ def ttl_cache(max_age):
             time_salt = time.time() // max_age
             # make kwargs hashable
             frozen_kwargs = tuple(sorted(kwargs.items()))
-            key = (function, args, frozen_kwargs)
-            if key in _ttl_cache:
-                (time_salt_cached, value) = _ttl_cache[key]
-
-                if time_salt_cached < time_salt:
-
-                    # recompute the new value in a separate thread, but return
-                    # the cached value immediately so we don't delay the
-                    # response.
-                    def recompute():
-                        value = function(*args, **kwargs)
-                        _ttl_cache[key] = (time_salt, value)
-                    thread = Thread(target=recompute)
-                    thread.start()
-                    return value
-
-                return value
-
-            value = function(*args, **kwargs)
-            _ttl_cache[key] = (time_salt, value)
+            # identify the function by name rather than by the function object
+            # itself, so the key is the same in every process.
+            name = f"{function.__module__}.{function.__qualname__}"
+            key = (name, args, frozen_kwargs)
+            tags = depends_on(*args, **kwargs) if callable(depends_on) else depends_on
+            tags = (TTLCacheBackend.ALL, *tags)
+            compute = lambda: function(*args, **kwargs)
+
+            entry = _ttl_cache.get(key, tags)
+            if entry is None:
+                return _ttl_cache.compute(key, tags, max_age, compute)
+
+            (time_salt_cached, value) = entry
+            if time_salt_cached < time_salt:
+                # recompute the new value in the background, but return the
+                # cached value immediately so we don't delay the response.
+                _ttl_cache.recompute(key, tags, max_age, compute)
+
             return value
 
         return wrapper
@@ -195,15 +733,33 @@ def ttl_cache(max_age):
 def recompute_ttl_cache():
     # TODO this is an imperfect implementation because although this will
     # recompute all values in the ttl cache, it will take two calls per cached
-    # key for any difference to be perceived. The first call we see that we set
-    # time_salt to 0 here and so will recompute the value, but it will return
-    # the previously cached value before it does so. Only on the second call
-    # will we return the truly updated value.
-    for key, value in _ttl_cache.copy().items():
-        (_time_salt, *values) = value
-        # set time_salt to 0 to force recomputation on next call
-        value = (0, *values)
-        _ttl_cache[key] = value
+    # key for any difference to be perceived. The first call we see that we
+    # mark every value as stale here and so will recompute the value, but it
+    # will return the previously cached value before it does so. Only on the
+    # second call will we return the truly updated value.
+    #
+    # Prefer `invalidate_ttl_cache` with specific tags where possible, which
+    # recomputes affected values immediately.
+    _ttl_cache.mark_stale()
+    _response_cache.mark_stale()
+
+def invalidate_ttl_cache(tags):
+    """
+    Recomputes every `ttl_cache`d value which depends on any of `tags`, and
+    drops every cached api response which does.
+    """
+    _ttl_cache.invalidate(tags)
+    _response_cache.invalidate(tags)
+
+def cache_tag(model, field=None, value=None):
+    """
+    The name of a `ttl_cache` dependency tag. `cache_tag("review")` covers every
+    review, while eg `cache_tag("review", "professor", "kruskal")` covers only
+    the reviews of one professor.
+    """
+    if field is None:
+        return model
+    return f"{model}:{field}:{value}"
 
 def send_updates_webhook(request):
     # avoid circular imports
@@ -7,6 +7,7 @@ from django.http import JsonResponse
 from django.template.context_processors import csrf
 from django.contrib.auth.mixins import UserPassesTestMixin
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.safestring import mark_safe
 
 from crispy_forms.utils import render_crispy_form
@@ -18,9 +19,25 @@ from home.tables.reviews_table import UnverifiedReviewsTable
 from home.tables.basic import ProfessorsTable
 from home.forms.admin_forms import (ProfessorMergeForm, ProfessorSlugForm,
     ProfessorUpdateForm, ActionForm, ProfessorInfoModal)
-from home.utils import send_email, _ttl_cache
+from home.utils import (send_email, _ttl_cache, invalidate_ttl_cache,
+    cache_tag, response_cache_metrics, ttl_cache, SimilarNameIndex)
+from home.rollups import refresh_rollups
 from planetterp import config
 
+@ttl_cache(24 * 60 * 60, depends_on=[cache_tag("professor")])
+def _professor_name_index():
+    # reused across requests rather than rebuilt from every verified professor
+    # each time one is verified. Holds ids rather than professors, so it stays
+    # small enough to share through the django cache backend.
+    return SimilarNameIndex(Professor.verified.values_list("name", "pk"))
+
+def _find_similar_professors(name, tolerance):
+    ids = _professor_name_index().find_similar(name, tolerance)
+    professors = Professor.verified.in_bulk(ids)
+    # the index may be a little out of date, so skip professors who've since
+    # been merged away or unverified.
+    return [professors[id_] for id_ in ids if id_ in professors]
+
 class Admin(UserPassesTestMixin, View):
 
     def test_func(self):
@@ -52,7 +69,9 @@ class Admin(UserPassesTestMixin, View):
             "professors_table": professors_table,
             "action_form": action_form,
             "merge_professor_form": merge_professor_form,
-            "ttl_cache_items": ttl_cache_items
+            "ttl_cache_items": ttl_cache_items,
+            "ttl_cache_stats": _ttl_cache.stats(),
+            "response_cache_stats": response_cache_metrics.stats()
         }
 
         context.update(csrf(request))
@@ -169,9 +188,29 @@ class Admin(UserPassesTestMixin, View):
                 grades = Grade.unfiltered.all()
                 professor_aliases = ProfessorAlias.objects.all()
 
-                professor_courses.filter(professor__id=subject_id).update(professor=merge_target)
-                reviews.filter(professor__id=subject_id).update(professor=merge_target)
-                grades.filter(professor__id=subject_id).update(professor=merge_target)
+                # the course rollups are keyed by professor, so any semester
+                # the subject has grades in needs to be rebuilt after merging.
+                merged_semesters = set(
+                    grades
+                    .filter(professor__id=subject_id)
+                    .values_list("semester", flat=True)
+                )
+
+                # `update` doesn't bump `auto_now` fields, which api etags
+                # depend on.
+                now = timezone.now()
+                professor_courses.filter(professor__id=subject_id).update(professor=merge_target, updated_at=now)
+                reviews.filter(professor__id=subject_id).update(professor=merge_target, updated_at=now)
+                grades.filter(professor__id=subject_id).update(professor=merge_target, updated_at=now)
+                if merged_semesters:
+                    refresh_rollups(merged_semesters)
+                # `update` doesn't send signals, so we have to invalidate any
+                # cached review data ourselves.
+                invalidate_ttl_cache([
+                    cache_tag("review"),
+                    cache_tag("review", "professor", merge_subject.slug),
+                    cache_tag("review", "professor", merge_target.slug)
+                ])
                 professor_aliases.filter(professor=merge_subject).update(professor=merge_target)
 
                 aliases = professor_aliases.filter(alias=merge_subject.name)
@@ -309,7 +348,7 @@ class Admin(UserPassesTestMixin, View):
                 ctx = {}
                 ctx.update(csrf(request))
 
-                similar_professors = Professor.find_similar(professor.name, 70)
+                similar_professors = _find_similar_professors(professor.name, 70)
                 verify_override = json.loads(request.POST["override"])
 
                 if not verify_override and len(similar_professors) > 0:
@@ -348,7 +387,7 @@ class Admin(UserPassesTestMixin, View):
             professor.slug = None
             if verified_status is Professor.Status.REJECTED:
                 reviews = Review.unfiltered.filter(professor__id=professor.pk)
-                reviews.update(status=verified_status)
+                reviews.update(status=verified_status, updated_at=timezone.now())
 
         professor.status = verified_status
         professor.save()
@@ -8,7 +8,7 @@ from django.contrib.auth.mixins import UserPassesTestMixin
 from home.models import Organization, Professor, Course, Review, Grade, User
 from home.tables.reviews_table import VerifiedReviewsTable, ProfileReviewsTable
 from home.forms.basic import ProfileForm
-from home.utils import recompute_ttl_cache, ttl_cache
+from home.utils import recompute_ttl_cache, ttl_cache, cache_tag
 
 class About(View):
     def get(self, request):
@@ -75,7 +75,8 @@ class CourseReviews(View):
 class Index(View):
 
     @staticmethod
-    @ttl_cache(24 * 60 * 60 * 7)
+    @ttl_cache(24 * 60 * 60 * 7, depends_on=[cache_tag("course"),
+        cache_tag("professor"), cache_tag("review"), cache_tag("grade")])
     def get_counts():
         num_courses = Course.unfiltered.count()
         num_professors = Professor.verified.count()
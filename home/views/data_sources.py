@@ -1,11 +1,45 @@
-from django.http import JsonResponse
+from collections import defaultdict
+
 from django.db.models import Sum
+from django.http import JsonResponse
 from django.views import View
 from django.urls import reverse
 
-from home.models import Professor, Grade, Course, Gened
-from home.utils import ttl_cache, Semester
-
+from home.models import (Professor, Grade, Course, Gened, CourseGradeRollup,
+    GPA_FIELDS, gpa_from_totals)
+from home.utils import ttl_cache, cache_tag, Semester
+
+
+def _grade_data_tags(professor, course, _semester, _section, _pf_semesters):
+    tags = []
+    # a grade change emits tags for both its course and its professor, so
+    # depending on either one is enough.
+    if course:
+        tags.append(cache_tag("grade", "course", course))
+    elif professor:
+        tags.append(cache_tag("grade", "professor", professor))
+    else:
+        tags.append(cache_tag("grade"))
+
+    if professor:
+        tags.append(cache_tag("professor", "slug", professor))
+    return tags
+
+
+def _course_grade_data_tags(professor, _pf_semesters):
+    # `professor` is a name, but grade and professor changes emit tags by slug.
+    # Depend on just this professor, so eg a grade import doesn't recompute
+    # every professor's breakdown.
+    slug = (
+        Professor.verified
+        .filter(name=professor)
+        .values_list("slug", flat=True)
+        .first()
+    )
+    return [
+        cache_tag("grade", "professor", slug),
+        cache_tag("professor", "slug", slug)
+    ]
 
 class GradeData(View):
     def get(self, request):
@@ -18,34 +52,22 @@ class GradeData(View):
         pf_semesters = data.get("pf_semesters", False) == "true"
 
         if professor_courses:
-            grade_data = GradeData._course_grade_data(professor, pf_semesters)
-            data = {
-                "professor_slug": grade_data.pop("professor_slug"),
-                "average_gpa": grade_data.pop("average_gpa"),
-                "num_students": grade_data.pop("num_students"),
-                "data": {}
-            }
-
-            for course_name, course_data in grade_data.items():
-                (course_average_gpa, course_num_students, course_grades) = course_data
-
-                if course_num_students and course_average_gpa:
-                    data['data'][course_name] = GradeData._get_data(
-                        course_average_gpa, course_num_students, course_grades)
+            data = GradeData.compose_course_grade_data(professor, pf_semesters)
         else:
-            (average_gpa, num_students, grades) = GradeData._grade_data(professor,
-                course, semester, section, pf_semesters)
-
-            data = GradeData._get_data(average_gpa, num_students, grades)
+            data = GradeData.compose_grade_data(professor, course, semester,
+                section, pf_semesters)
 
         return JsonResponse(data)
 
     @staticmethod
-    def _get_data(average_gpa, num_students, grades):
+    def _get_data(summary):
+        average_gpa = summary["average_gpa"]
+        num_students = summary["num_students"]
+
         def _statistic(name):
             if not num_students:
                 return 0
-            return round((grades[name] / num_students) * 100, 2)
+            return round((summary[name] / num_students) * 100, 2)
 
         return {
             "average_gpa": average_gpa,
@@ -74,41 +96,45 @@ class GradeData(View):
         }
 
     @staticmethod
+    @ttl_cache(24 * 60 * 60 * 7, depends_on=_course_grade_data_tags)
     def _course_grade_data(professor, pf_semesters):
         professor = Professor.verified.filter(name=professor).first()
-        courses = professor.course_set.all().order_by("name")
-        grades = professor.grade_set(manager="recent").all()
+        grades = professor.coursegraderollup_set(manager="recent").all()
 
         if not pf_semesters:
             grades = grades.exclude_pf()
 
-        grade_data = {
+        summary = grades.summary()
+        # compute every course at once with a single grouped query instead of
+        # a query per course; long-tenured professors and TAs can have dozens
+        # of courses.
+        course_summaries = (
+            grades
+            .filter(course__in=professor.course_set.all())
+            .summary_by("course__name")
+        )
+
+        return {
             "professor_slug": professor.slug,
-            "average_gpa": grades.average_gpa(),
-            "num_students": grades.num_students()
+            "average_gpa": summary["average_gpa"],
+            "num_students": summary["num_students"],
+            "courses": course_summaries
         }
-        for course in courses:
-            course_grades = grades
-            course_grades = course_grades.filter(course=course)
-
-            average_course_gpa = course_grades.average_gpa()
-            num_course_students = course_grades.num_students()
-            course_grades = course_grades.grade_totals_aggregate()
-
-            grade_data[course.name] = (average_course_gpa, num_course_students, course_grades)
-
-        return grade_data
 
     @staticmethod
-    @ttl_cache(24 * 60 * 60 * 7)
+    @ttl_cache(24 * 60 * 60 * 7, depends_on=_grade_data_tags)
     def _grade_data(professor, course, semester, section, pf_semesters):
+        # rollups are summed over sections, so we can only read from them if
+        # we don't need a specific section.
+        model = Grade if section else CourseGradeRollup
+
         # if we want a specific semester, grab all grades to start; we'll filter
         # down to that specific semester later, and don't want to return no data
         # for a request for an old (non-recent) semester.
         if semester:
-            grades = Grade.unfiltered.all()
+            grades = model.unfiltered.all()
         else:
-            grades = Grade.recent.all()
+            grades = model.recent.all()
 
         if professor:
             professor = Professor.verified.filter(slug=professor).first()
@@ -123,35 +149,27 @@ class GradeData(View):
         if not pf_semesters:
             grades = grades.exclude_pf()
 
-        average_gpa = grades.average_gpa()
-        num_students = grades.num_students()
-        grades = grades.grade_totals_aggregate()
-
-        return (average_gpa, num_students, grades)
+        return grades.summary()
 
     @staticmethod
     def compose_grade_data(professor, course, semester, section, pf_semesters):
-        (average_gpa, num_students, grades) = GradeData._grade_data(professor,
-        course, semester, section, pf_semesters)
-
-        return GradeData._get_data(average_gpa, num_students, grades)
+        summary = GradeData._grade_data(professor, course, semester, section,
+            pf_semesters)
+        return GradeData._get_data(summary)
 
     @staticmethod
     def compose_course_grade_data(professor, pf_semesters):
         grade_data = GradeData._course_grade_data(professor, pf_semesters)
         data = {
-            "professor_slug": grade_data.pop("professor_slug"),
-            "average_gpa": grade_data.pop("average_gpa"),
-            "num_students": grade_data.pop("num_students"),
+            "professor_slug": grade_data["professor_slug"],
+            "average_gpa": grade_data["average_gpa"],
+            "num_students": grade_data["num_students"],
             "data": {}
         }
 
-        for course_name, course_data in grade_data.items():
-            (course_average_gpa, course_num_students, course_grades) = course_data
-
-            if course_num_students and course_average_gpa:
-                data['data'][course_name] = GradeData._get_data(
-                    course_average_gpa, course_num_students, course_grades)
+        for course_name, summary in grade_data["courses"].items():
+            if summary["num_students"] and summary["average_gpa"]:
+                data['data'][course_name] = GradeData._get_data(summary)
         return data
 
 
@@ -166,21 +184,58 @@ class CourseDifficultyData(View):
         return JsonResponse({"data": data})
 
     @staticmethod
-    @ttl_cache(24 * 60 * 60 * 7)
-    def _course_data():
-        data = []
-
-        values = (
-            Grade.recent
+    @ttl_cache(24 * 60 * 60 * 7, depends_on=[cache_tag("grade")])
+    def difficulty_table():
+        """
+        `(name, num_students, average_gpa)` for every course (under
+        `"courses"`) and department (under `"departments"`) with recent,
+        non pass/fail grades, ordered by name.
+
+        Computed from a single grouped query over the course rollups, with
+        department totals summed from the course totals in python, so both
+        tables come from the same pull.
+        """
+        rows = (
+            CourseGradeRollup.recent
             .exclude_pf()
-            .values("course__name", total_students=Sum("num_students"))
-            .filter(total_students__gte=100)
-            .average_gpa_annotate()
+            .values_list("course__name", "course__department")
+            .annotate(Sum("num_students"),
+                *(Sum(field) for field in GPA_FIELDS))
+            .order_by("course__name")
         )
 
+        courses = []
+        department_totals = {}
+        for (name, department, *totals) in rows:
+            (num_students, *gpa_totals) = totals
+            totals_by_field = dict(zip(GPA_FIELDS, gpa_totals))
+            courses.append((name, num_students,
+                gpa_from_totals(totals_by_field)))
+
+            if department not in department_totals:
+                department_totals[department] = [0] * len(totals)
+            department_total = department_totals[department]
+            for i, total in enumerate(totals):
+                department_total[i] += total
+
+        departments = []
+        for department in sorted(department_totals):
+            (num_students, *gpa_totals) = department_totals[department]
+            totals_by_field = dict(zip(GPA_FIELDS, gpa_totals))
+            departments.append((department, num_students,
+                gpa_from_totals(totals_by_field)))
+
+        return {"courses": courses, "departments": departments}
+
+    @staticmethod
+    @ttl_cache(24 * 60 * 60 * 7, depends_on=[cache_tag("grade")])
+    def _course_data():
         data = []
-        for value in values:
-            average_gpa = value["average_gpa"]
+        for (course_name, num_students, average_gpa) in (
+            CourseDifficultyData.difficulty_table()["courses"]):
+            if num_students < 100:
+                continue
+
             # some courses with entirely "other" graded students have a gpa of
             # 0. Other courses with weirder circumstances (citation needed)
             # return an undefined gpa. Skip both of these; 0 gpa courses are
@@ -190,7 +245,6 @@ class CourseDifficultyData(View):
                 continue
 
             average_gpa = f"{average_gpa:.2f}"
-            course_name = value["course__name"]
             # We're sacrificing access to the `course` object
             # itself for the sake of performance in the above query, so we have
             # to construct its location manually instead of with
@@ -198,7 +252,6 @@ class CourseDifficultyData(View):
             # tradeoff.
             href = reverse("course", kwargs={"name": course_name})
             course_name = f"<a href='{href}' target='_blank'>{course_name}</a>"
-            num_students = value["total_students"]
 
             entry = [course_name, average_gpa, num_students]
             data.append(entry)
@@ -206,28 +259,17 @@ class CourseDifficultyData(View):
         return data
 
     @staticmethod
-    @ttl_cache(24 * 60 * 60 * 7)
+    @ttl_cache(24 * 60 * 60 * 7, depends_on=[cache_tag("grade")])
     def _departments_data():
-        departments = (
-            Grade.recent
-            .exclude_pf()
-            .values("course__department").distinct()
-            .annotate(num_students=Sum("num_students"))
-            .filter(num_students__gte=100)
-        )
-
         data = []
-        for department in departments:
-            department_name = department["course__department"]
-            average_gpa = (
-                Grade.recent
-                .filter(course__department=department_name)
-                .exclude_pf()
-                .average_gpa()
-            )
+        for (department_name, num_students, average_gpa) in (
+            CourseDifficultyData.difficulty_table()["departments"]):
+            if num_students < 100 or average_gpa is None:
+                continue
+
             href = reverse("search") + f"?query={department_name}"
             dep_link = f"<a href='{href}' target='_blank'>{department_name}</a>"
-            entry = [dep_link, f"{average_gpa:.2f}", department["num_students"]]
+            entry = [dep_link, f"{average_gpa:.2f}", num_students]
             data.append(entry)
         return data
 
@@ -240,22 +282,59 @@ class GenedData(View):
         if not geneds:
             return JsonResponse({"data": []})
 
-        geneds = tuple(geneds)
-        courses = Course.recent.raw("""
-            SELECT GROUP_CONCAT(name) AS geneds, course_id AS id
-            FROM home_gened
-            GROUP BY course_id
-            HAVING SUM(name IN %s) = %s
-            """, [geneds, len(geneds)])
+        index = GenedData._gened_index()
+        # intersect starting from the smallest set, which bounds the size of
+        # every intermediate result.
+        course_sets = sorted((index["courses"].get(gened, frozenset())
+            for gened in geneds), key=len)
+        course_ids = frozenset.intersection(*course_sets)
 
-        data = []
-        for course in courses:
-            geneds = course.geneds.replace(",", ", ")
-            average_gpa = course.average_gpa()
+        data = [index["rows"][course_id] for course_id in sorted(course_ids)]
+        return JsonResponse({"data": data})
+
+    @staticmethod
+    @ttl_cache(24 * 60 * 60, depends_on=[cache_tag("gened"),
+        cache_tag("course"), cache_tag("grade")])
+    def _gened_index():
+        """
+        The ids of the courses with each gened (under `"courses"`), and the
+        table row of every course with at least one gened, by id (under
+        `"rows"`). Courses matching several geneds are then a set
+        intersection, without touching the database.
+        """
+        geneds = Gened.objects.values_list("course_id", "name").order_by("pk")
+        course_geneds = defaultdict(list)
+        courses = defaultdict(set)
+        for (course_id, name) in geneds:
+            course_geneds[course_id].append(name)
+            courses[name].add(course_id)
+
+        gened_course_ids = Gened.objects.values("course_id")
+        average_gpas = (
+            CourseGradeRollup.recent
+            .filter(course__in=gened_course_ids)
+            .values("course_id")
+            .average_gpa_annotate()
+            .order_by()
+        )
+        average_gpas = {row["course_id"]: row["average_gpa"]
+            for row in average_gpas}
+
+        rows = {}
+        gened_courses = (
+            Course.unfiltered
+            .filter(pk__in=gened_course_ids)
+            .only("name", "title", "credits")
+        )
+        for course in gened_courses:
+            average_gpa = average_gpas.get(course.pk)
             average_gpa = f"{average_gpa:.2f}" if average_gpa else "No grade data available"
             course_name = f"<a href='{course.get_absolute_url()}'>{course.name}</a>"
-            entry = [course_name, course.title, course.credits, average_gpa,
-                geneds]
-            data.append(entry)
+            geneds = ", ".join(course_geneds[course.pk])
+            rows[course.pk] = [course_name, course.title, course.credits,
+                average_gpa, geneds]
 
-        return JsonResponse({"data": data})
+        return {
+            "courses": {name: frozenset(ids) for name, ids in courses.items()},
+            "rows": rows
+        }
@@ -1,7 +1,7 @@
 from django.http import JsonResponse
 from django.views import View
 
-from home import queries
+from home.search_index import get_search_index, SearchResult
 
 class Autocomplete(View):
     def get(self, request):
@@ -11,10 +11,17 @@ class Autocomplete(View):
         professors = "professor" in types
         courses = "course" in types
         return_attrs = data.getlist("return_attrs[]")
-        search_results = queries.search(query, 10, professors=professors,
-            courses=courses)
+        # answered entirely from memory; see `home.search_index`.
+        search_results = get_search_index().complete(query, 10,
+            professors=professors, courses=courses)
         results = []
 
+        # only professors have a different label for staff, so don't load the
+        # user (and their session) unless we need to.
+        is_staff = False
+        if any(r.type == SearchResult.PROFESSOR for r in search_results):
+            is_staff = request.user.is_staff
+
         for result in search_results:
             value_dict = {}
             if "url" in return_attrs:
@@ -25,7 +32,7 @@ class Autocomplete(View):
                 value_dict['name'] = result.name
 
             data = {
-                "label": f"{result}" if request.user.is_staff else f"{result.name}",
+                "label": f"{result}" if is_staff else f"{result.name}",
                 "result": value_dict
             }
 
@@ -2,8 +2,8 @@ from django.shortcuts import redirect, render
 from django.views import View
 from django.http import HttpResponse
 
-from home.models import Course
 from home import queries
+from home.search_index import SearchResult
 
 class Search(View):
     def get(self, request):
@@ -31,7 +31,8 @@ class Search(View):
         # page if the search matches exactly
         if results:
             result = results[0]
-            if isinstance(result, Course) and result.name.upper() == query.upper():
+            if (result.type == SearchResult.COURSE and
+                result.name.upper() == query.upper()):
                 return redirect(result)
 
         context = {
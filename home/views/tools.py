@@ -1,13 +1,18 @@
+from collections import defaultdict
+from bisect import bisect_left
 import math
 
 from django.http import HttpResponseBadRequest, JsonResponse
-from django.db.models import Count, Sum, Q, FloatField
+from django.db.models import Count, Sum, FloatField
+from django.db.models.functions import ExtractWeek, Cast
 from django.views.generic import TemplateView
 from django.shortcuts import render
 from django.views import View
+from django.utils import timezone
 
-from home.models import Grade, Course, Review, Professor
-from home.utils import ttl_cache
+from home.models import (Course, Review, Professor, CourseGradeRollup,
+    DepartmentGradeRollup, GPA_FIELDS, gpa_from_totals)
+from home.utils import ttl_cache, cache_tag
 
 class Tools(TemplateView):
     template_name = "tools.html"
@@ -29,23 +34,62 @@ class ToolPopularCourses(TemplateView):
             return HttpResponseBadRequest("Your search must be at least 3 "
                 "characters.")
 
+        matches = ToolPopularCourses.matching_courses(query)
+        if not matches:
+            return HttpResponseBadRequest("No results.")
+
+        matches.sort(key=lambda match: (-match[1], match[0]))
+        data = [[], []]
+        for (name, num_students) in matches:
+            data[0].append(num_students)
+            data[1].append(name)
+
+        return JsonResponse(data, safe=False)
+
+    @staticmethod
+    @ttl_cache(24 * 60 * 60 * 7, depends_on=[cache_tag("grade")])
+    def enrollment_index():
+        """
+        `(name, num_students)` for every course with recent grades, summed
+        over every recent semester, grouped by department and sorted by name
+        within each department.
+        """
         values = (
-            Grade.recent
-            .filter(course__name__icontains=query)
-            .values("course__name")
+            CourseGradeRollup.recent
+            .values_list("course__department", "course__name")
             .annotate(num_students=Sum("num_students"))
-            .order_by("-num_students")
+            .order_by("course__name")
         )
 
-        if not values:
-            return HttpResponseBadRequest("No results.")
+        index = defaultdict(list)
+        for (department, name, num_students) in values:
+            index[department].append((name, num_students))
+        return dict(index)
 
-        data = [[], []]
-        for value in values:
-            data[0].append(value["num_students"])
-            data[1].append(value["course__name"])
+    @staticmethod
+    def matching_courses(query):
+        """
+        `(name, num_students)` for every course whose name contains `query`,
+        ignoring case.
+        """
+        query = query.upper()
+        index = ToolPopularCourses.enrollment_index()
 
-        return JsonResponse(data, safe=False)
+        # course numbers start with a digit, so a query starting with a full
+        # department can only match at the start of a name; find those with a
+        # range lookup in that department.
+        if len(query) >= 4 and query[:4].isalpha():
+            courses = index.get(query[:4], [])
+            start = bisect_left(courses, (query,))
+            matches = []
+            for (name, num_students) in courses[start:]:
+                if not name.startswith(query):
+                    break
+                matches.append((name, num_students))
+            return matches
+
+        return [(name, num_students) for courses in index.values()
+            for (name, num_students) in courses if query in name]
 
 class ToolGradeInflation(TemplateView):
     template_name = "gradeinflation.html"
@@ -60,30 +104,83 @@ class ToolGradeInflation(TemplateView):
         if len(search) not in [0, 4, 5, 6, 7, 8]:
             return HttpResponseBadRequest("Invalid department or course.")
 
-        grades = Grade.unfiltered.all()
-        if len(search) == 4:
-            grades = grades.filter(course__department=search)
         if len(search) > 4:
             course = Course.recent.filter(name=search).first()
             if not course:
                 return HttpResponseBadRequest("Course does not exist.")
+            dist = ToolGradeInflation.course_series(course.name)
+        else:
+            # an empty search is the whole university. Departments are
+            # matched case insensitively, like mysql's default collation does.
+            series = ToolGradeInflation.department_series()
+            dist = series.get(search.upper() or None, [[], []])
 
-            grades = course.grade_set.all()
+        return JsonResponse(dist, safe=False)
 
-        values = (
-            grades
-            .values("semester")
-            .average_gpa_annotate()
-            .order_by("semester")
-        )
-        # [labels, data]
+    @staticmethod
+    def _series(semester_totals):
+        """
+        `[labels, gpas]` for a dict mapping semesters to a totals dict (see
+        `gpa_from_totals`), in the format the grade inflation graph expects.
+        Semesters without a gpa are skipped.
+        """
         dist = [[], []]
-        for value in values:
-            semester = value["semester"].name(short=True, year_first=True)
-            dist[0].append(semester)
-            average_gpa = value["average_gpa"]
+        for semester, totals in semester_totals.items():
+            average_gpa = gpa_from_totals(totals)
+            if average_gpa is None:
+                continue
+            dist[0].append(semester.name(short=True, year_first=True))
             dist[1].append(f"{average_gpa:0.2f}")
-        return JsonResponse(dist, safe=False)
+        return dist
+
+    @staticmethod
+    @ttl_cache(24 * 60 * 60 * 7, depends_on=[cache_tag("grade")])
+    def department_series():
+        """
+        The grade inflation series of every department, plus the whole
+        university under `None`, built from a single pass over the department
+        rollups.
+        """
+        rows = (
+            DepartmentGradeRollup.unfiltered
+            .values_list("department", "semester", *GPA_FIELDS)
+            .order_by("semester", "department")
+        )
+
+        department_totals = defaultdict(dict)
+        university_totals = {}
+        for (department, semester, *totals) in rows:
+            department_totals[department][semester] = dict(zip(GPA_FIELDS,
+                totals))
+
+            if semester not in university_totals:
+                university_totals[semester] = dict.fromkeys(GPA_FIELDS, 0)
+            semester_totals = university_totals[semester]
+            for field, total in zip(GPA_FIELDS, totals):
+                semester_totals[field] += total
+
+        series = {department: ToolGradeInflation._series(totals)
+            for department, totals in department_totals.items()}
+        series[None] = ToolGradeInflation._series(university_totals)
+        return series
+
+    @staticmethod
+    @ttl_cache(24 * 60 * 60 * 7,
+        depends_on=lambda name: [cache_tag("grade", "course", name)])
+    def course_series(name):
+        # there are far too many courses to precompute every series like
+        # `department_series`, so these are computed when first requested and
+        # left to the ttl cache's size limits.
+        rollups = (
+            CourseGradeRollup.unfiltered
+            .filter(course__name=name)
+            .values_list("semester")
+            .annotate(*(Sum(field) for field in GPA_FIELDS))
+            .order_by("semester")
+        )
+        semester_totals = {semester: dict(zip(GPA_FIELDS, totals))
+            for (semester, *totals) in rollups}
+        return ToolGradeInflation._series(semester_totals)
 
 
 class ToolGeneds(TemplateView):
@@ -103,27 +200,41 @@ class ToolStatistics(View):
         return render(request, "statistics.html", context)
 
     @staticmethod
-    @ttl_cache(24 * 60 * 60)
+    @ttl_cache(24 * 60 * 60,
+        depends_on=[cache_tag("review"), cache_tag("professor")])
     def graph_data():
-        reviews = Review.verified.all()
-        professors = (
-            Professor.verified
+        # everything here is counted by the database, so memory use doesn't
+        # grow with the number of reviews.
+        rating_counts = (
+            Review.verified
+            .values_list("rating")
+            .annotate(count=Count("*"))
+            .order_by()
+        )
+        # `created_at` is stored in utc, so this matches
+        # `created_at.isocalendar()[1]`.
+        week_counts = (
+            Review.verified
+            .annotate(week=ExtractWeek("created_at", tzinfo=timezone.utc))
+            .values_list("week")
+            .annotate(count=Count("*"))
+            .order_by()
+        )
+        # one row per reviewed professor
+        professor_average_ratings = (
+            Review.verified
+            .filter(professor__status=Professor.Status.VERIFIED)
+            .values("professor")
             .annotate(
                 # TODO consolidate this with the Professor#average_rating
                 # method, will likely require a new Professors queryset
-                average_rating_= (
-                    Sum(
-                        "review__rating",
-                        output_field=FloatField(),
-                        filter=Q(review__status=Review.Status.VERIFIED)
-                    )
-                    /
-                    Count(
-                        "review",
-                        filter=Q(review__status=Review.Status.VERIFIED)
-                    )
+                # cast so that sqlite doesn't do integer division
+                average_rating=(
+                    Sum(Cast("rating", FloatField())) / Count("*")
                 )
             )
+            .order_by()
+            .values_list("average_rating", flat=True)
         )
 
         review_ratings = [0] * 5
@@ -134,15 +245,13 @@ class ToolStatistics(View):
         # We need one additional bucket to deal with inclusivity on both ends.
         professor_ratings = [0] * (10 * 4 + 1)
 
-        for review in reviews:
-            review_ratings[review.rating - 1] += 1
-            week = review.created_at.isocalendar()[1]
-            review_dates[week - 1] += 1
+        for (rating, count) in rating_counts:
+            review_ratings[rating - 1] += count
 
-        for professor in professors:
-            rating = professor.average_rating_
-            if rating is None:
-                continue
+        for (week, count) in week_counts:
+            review_dates[week - 1] += count
+
+        for rating in professor_average_ratings.iterator():
             # careful: due to floating point errors, (rating - 1) // 0.1 is
             # incorrect. Try evaluating `5.0 // 0.1` in a terminal yourself if
             # you don't believe me!
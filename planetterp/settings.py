@@ -66,6 +66,7 @@ MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'home.middleware.CorsMiddleware',
+    'home.middleware.HttpCacheMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -105,6 +106,29 @@ REST_FRAMEWORK = {
 
 WSGI_APPLICATION = 'planetterp.wsgi.application'
 
+# Caching
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+#
+# `ttl_cache` keeps its values in each worker process's memory by default
+# ("local"). Set `TTL_CACHE_BACKEND = "django"` in your config to store them in
+# the django cache named by `TTL_CACHE_ALIAS` instead, so that every worker
+# shares computed values and invalidations. Rendered api responses are only
+# cached for a minute with the local backend, since other workers' changes
+# don't invalidate them (see `api.utils.cache_response`).
+CACHES = getattr(config, "CACHES", {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    }
+})
+TTL_CACHE_BACKEND = getattr(config, "TTL_CACHE_BACKEND", "local")
+TTL_CACHE_ALIAS = getattr(config, "TTL_CACHE_ALIAS", "default")
+
+# Search
+#
+# workers load the search index from this file (written by `python manage.py
+# buildsearchindex`) if it exists, instead of building it from the database.
+SEARCH_INDEX_PATH = getattr(config, "SEARCH_INDEX_PATH", None)
+
 
 # Database
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
@@ -7,10 +7,22 @@ For more information on this file, see
 https://docs.djangoproject.com/en/3.2/howto/deployment/wsgi/
 """
 
+import logging
 import os
 
 from django.core.wsgi import get_wsgi_application
 
+from home.search_index import get_search_index
+
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'planetterp.settings')
 
 application = get_wsgi_application()
+
+# build the search and autocomplete indexes before serving any requests, so the
+# first searches don't have to wait for them. If that fails, eg because the
+# database isn't reachable or migrated yet, the indexes are built by the first
+# search instead.
+try:
+    get_search_index()
+except Exception:
+    logging.getLogger(__name__).exception("Couldn't build the search index")